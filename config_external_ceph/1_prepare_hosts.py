@@ -1,11 +1,20 @@
 import argparse
-import paramiko
+import fanout
+import known_hosts
+import logs
+import ssh_keys
+import ssh_pool
+import timing
+import state
+import steps
+import wait
 import socket
-import os
-import multiprocessing
-import subprocess
+import statistics
+import time
 import sys
 
+BOOT_ID_COMMAND = 'cat /proc/sys/kernel/random/boot_id'
+
 
 def reboot_remote_host(host, user, password):
     """
@@ -17,152 +26,156 @@ def reboot_remote_host(host, user, password):
     password (str): The password to use for SSH authentication.
 
     Returns:
-    None
+    str: The boot ID of the host before the reboot, None if it is the local host and was not rebooted.
     """
-    try:
-        # Skip rebooting if the host is the same as the current host
-        if host == socket.gethostname():
-            print("Skipping reboot for the local host.")
-            return
+    # Skip rebooting if the host is the same as the current host
+    if host == socket.gethostname():
+        print("Skipping reboot for the local host.")
+        return None
 
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
+    try:
+        # Remember the boot ID to tell the rebooted system from the old one
+        exit_status, boot_id, error = ssh_pool.pool.exec_command(host, BOOT_ID_COMMAND, user, password)
+        if exit_status != 0 or not boot_id.strip():
+            raise RuntimeError(f"reading the boot ID failed: {error.strip()}")
+        ssh = ssh_pool.pool.get_client(host, user, password)
 
         # Execute the reboot command on the remote host
         ssh.exec_command("sudo reboot")
 
-        ssh.close()
+        ssh_pool.pool.drop(host)
 
         print(f"Successfully initiated reboot for remote host '{host}'")
+        return boot_id.strip()
     except Exception as e:
         print(f"Error rebooting remote host '{host}': {str(e)}")
+        raise
+
+def wait_for_rebooted_hosts(boot_ids, timeout):
+    """
+    Waits until every rebooted host is reachable over SSH with a new boot ID and
+    systemd finished starting, printing the number of hosts back as they return.
+
+    Parameters:
+    boot_ids (dict): The boot ID before the reboot and the time of the reboot for each host.
+    timeout (float): The number of seconds to wait for the slowest host.
+
+    Returns:
+    list: The hosts that did not come back in time.
+    """
+    hosts = list(boot_ids)
+
+    def is_back(host):
+        # Short timeouts, a host that is still down should not hold a poll for long
+        try:
+            exit_status, output, error = ssh_pool.pool.exec_command(host, f'{BOOT_ID_COMMAND}; systemctl is-system-running', timeout=10)
+        except Exception:
+            # A connection opened while the old system was shutting down is dead, reconnect on the next poll
+            ssh_pool.pool.drop(host)
+            raise
+        lines = output.split()
+        return len(lines) == 2 and lines[0] != boot_ids[host][0] and lines[1] in ('running', 'degraded')
+
+    started = time.monotonic()
+    ready, stragglers = wait.wait_for(is_back, hosts, timeout, interval=5, max_interval=15,
+                                      progress=lambda ready, hosts: print(f'{len(ready)}/{len(hosts)} hosts back after reboot'),
+                                      step='reboot_wait')
+
+    # Time to return counts from each host's own reboot, the pipeline reboots hosts at different times
+    durations = {host: started + seconds - boot_ids[host][1] for host, seconds in ready.items()}
+    if durations:
+        slowest = max(durations, key=durations.get)
+        print(f"Hosts back after reboot in min {min(durations.values()):.0f}s, median {statistics.median(durations.values()):.0f}s, "
+              f"max {durations[slowest]:.0f}s ({slowest})")
+    for host in stragglers:
+        print(f"Host '{host}' did not come back within {timeout} seconds after reboot")
+    return stragglers
 
 def run_command_on_remote_host(hostname, command, username, password):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname, username=username, password=password)
-    stdin, stdout, stderr = client.exec_command(command)
-    output = stdout.read().decode()
-    client.close()
+    exit_status, output, error = ssh_pool.pool.exec_command(hostname, command, username, password, stream=True)
     return output
 
-def add_host_to_known_hosts(hostname):
-    try:
-        # Add host to local known_hosts file
-        os.system(f'ssh-keyscan -H {hostname} >> ~/.ssh/known_hosts')
-        return f'{hostname} added to known_hosts file'
-    except Exception as e:
-        print(f'Error adding {hostname} to known_hosts file: {str(e)}')
-        return ''
+def add_hosts_to_known_hosts(hosts):
+    """
+    Scans the host keys of all hosts in parallel and merges them into the local
+    known_hosts file in one write, without duplicating the hosts already there.
 
-def add_ssh_key_to_remote_host(hostname, username, password):
-    try:
-        # Copy SSH key to remote host
-        os.system(f'sshpass -p "{password}" ssh-copy-id {username}@{hostname}')
-        return f'SSH key added to {hostname}'
-    except Exception as e:
-        print(f'Error adding SSH key to {hostname}: {str(e)}')
-        return ''
+    Parameters:
+    hosts (list): The hostnames or IP addresses of the hosts.
 
-def generate_ssh_key_on_remote_host(hostname, username, password):
-    try:
-        # Generate SSH key on remote host
-        os.system(f'sshpass -p "{password}" ssh {username}@{hostname} "if [ ! -f /root/.ssh/id_rsa.pub ]; then ssh-keygen -t rsa -b 2048 -N \'\' -f ~/.ssh/id_rsa ; fi"')
-        return f'SSH key generated on {hostname}'
-    except Exception as e:
-        print(f'Error generating SSH key on {hostname}: {str(e)}')
-        return ''
+    Returns:
+    dict: For each host, what happened to its known_hosts entry, or the exception of a failed scan.
+    """
+    results = known_hosts.update_known_hosts(hosts)
+    return {host: result if isinstance(result, Exception) else f'{host} {result} in known_hosts file'
+            for host, result in results.items()}
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Setup Ceph on a set of hosts')
     parser.add_argument('-hf', '--hosts_file', required=True, help='The file containing the hosts to setup')
     parser.add_argument('-u', '--user', required=True, help='The SSH username to use for connecting to the hosts')
     parser.add_argument('-p', '--password', required=True, help='The SSH password to use for connecting to the hosts')
+    fanout.add_arguments(parser)
+    logs.add_arguments(parser)
+    state.add_arguments(parser, '1_prepare_hosts.state')
+    parser.add_argument('--reboot-timeout', type=float, default=1800, help='The number of seconds to wait for the hosts to come back after the reboot')
+    timing.add_arguments(parser)
     args = parser.parse_args()
+    timing.start(args)
+    ssh_pool.pool.configure(args.user, args.password, args.timeout)
+    fanout.engine.configure(args.max_workers, args.timeout)
+    logs.host_logs.configure(args.log_dir, not args.quiet)
 
 # Read hosts from file
     with open(args.hosts_file) as f:
         hosts = f.read().splitlines()
 
-    # Add each host to local known_hosts file
-    for host in hosts:
-        output = add_host_to_known_hosts(host)
-        print(f'{output} ({host})')
-
-    # Copy SSH key to each host
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(add_ssh_key_to_remote_host, (host, args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-    for r in results:
-        output = r.get()
-        print(f'{output} ({r.get()})')
-
-    # Generate SSH key on each host, if not already present
-    for host in hosts:
-        output = generate_ssh_key_on_remote_host(host, args.user, args.password)
-        print(f'{output} ({host})')
-
-    #register subscription-manager
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "subscription-manager register --username user --password password --auto-attach", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-    for r in results:
-        output = r.get()
-        print(f'{output} ({r.get()})')
-
-
-    #update rhel hosts
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "~/./update-latest-rhel-release.sh 8.7;dnf update -y", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-    for r in results:
-        output = r.get()
-        print(f'{output} ({r.get()})')
-
-    #attach needed repos
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "subscription-manager repos --enable=rhel-8-for-x86_64-baseos-rpms --enable=ansible-2.9-for-rhel-8-x86_64-rpms --enable=rhceph-5-tools-for-rhel-8-x86_64-rpms --enable rhel-8-for-x86_64-appstream-rpms", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-    for r in results:
-        output = r.get()
-        print(f'{output} ({r.get()})')
-
-    #install required packages
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "dnf install podman ansible cephadm-ansible cephadm gdisk -y", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-    for r in results:
-        output = r.get()
-        print(f'{output} ({r.get()})')
-
-
-    #disable ip tables
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "systemctl stop iptables ; systemctl disable iptables", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-    for r in results:
-        output = r.get()
-        print(f'{output} ({r.get()})')
-
-
-    #login to podman
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "podman login -u user -p password registry.redhat.io", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-    for r in results:
-        output = r.get()
-        print(f'{output} ({r.get()})')
-
-    #reboot remote hosts
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(reboot_remote_host, (host, args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
+    try:
+        public_key = ssh_keys.local_public_key()
+    except (OSError, ValueError) as e:
+        sys.exit(f'Error reading the local SSH key: {str(e)}')
+    boot_ids = {}
+
+    def reboot(host):
+        boot_id = reboot_remote_host(host, args.user, args.password)
+        if boot_id:
+            boot_ids[host] = (boot_id, time.monotonic())
+
+    # Every host walks through its own chain, only the known_hosts scan is fleet wide
+    setup_steps = [
+        # Add each host to local known_hosts file, on every run as it is cheap and catches reinstalled hosts
+        steps.Step('known_hosts', add_hosts_to_known_hosts, barrier=True, resumable=False),
+        # Copy the local SSH key to each host and generate SSH key on each host, if not already present
+        steps.Step('ssh_keys', lambda host: ssh_keys.deploy_keys(host, [public_key], generate=True), requires=['known_hosts']),
+        #register subscription-manager
+        steps.Step('register', steps.remote_command("subscription-manager register --username user --password password --auto-attach"),
+                   probe="subscription-manager identity"),
+        #update rhel hosts
+        steps.Step('update', steps.remote_command("~/./update-latest-rhel-release.sh 8.7;dnf update -y"), requires=['register']),
+        #attach needed repos
+        steps.Step('repos', steps.remote_command("subscription-manager repos --enable=rhel-8-for-x86_64-baseos-rpms --enable=ansible-2.9-for-rhel-8-x86_64-rpms --enable=rhceph-5-tools-for-rhel-8-x86_64-rpms --enable rhel-8-for-x86_64-appstream-rpms"), requires=['update'],
+                   probe="subscription-manager repos --list-enabled | grep -q rhceph-5-tools-for-rhel-8-x86_64-rpms"),
+        #install required packages
+        steps.Step('packages', steps.remote_command("dnf install podman ansible cephadm-ansible cephadm gdisk -y"), requires=['repos'],
+                   probe="rpm -q podman ansible cephadm-ansible cephadm gdisk"),
+        #disable ip tables
+        steps.Step('iptables', steps.remote_command("systemctl stop iptables ; systemctl disable iptables"),
+                   probe="! systemctl is-active -q iptables && ! systemctl is-enabled -q iptables"),
+        #login to podman
+        steps.Step('podman_login', steps.remote_command("podman login -u user -p password registry.redhat.io"), requires=['packages'],
+                   probe="podman login --get-login registry.redhat.io"),
+        #reboot remote hosts
+        steps.Step('reboot', reboot,
+                   requires=['ssh_keys', 'packages', 'iptables', 'podman_login']),
+    ]
+    status = steps.run_steps(setup_steps, hosts, state.StateStore(args.state_file, args.fresh))
+    steps.print_summary(status)
+
+    # Wait for the rebooted hosts, the next script can start once this returns
+    if boot_ids:
+        wait_for_rebooted_hosts(boot_ids, args.reboot_timeout)
+
+    timing.finish(args)
+    fanout.engine.shutdown()
+    ssh_pool.pool.close_all()
+    logs.host_logs.close_all()
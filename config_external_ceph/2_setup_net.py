@@ -1,102 +1,193 @@
 import argparse
-import paramiko
-import multiprocessing
+import distribute
+import fanout
+import inventory
+import logs
+import net_mesh
+import nic_tuning
+import ssh_pool
+import timing
+import tuned_profile
+import state
+import steps
+import wait
+import shlex
 import time
-import os
-timeout_seconds = 3
+TUNED_PROFILE_PATH = '/etc/tuned/rhcs/tuned.conf'
+
+# The sysctls of the profile rendered for each host, for the readback after tuned applied it
+rendered_sysctls = {}
+
+# bond0 has carrier, an IPv4 address and every slave reports MII status up
+BOND_READY_PROBE = ("test \"$(cat /sys/class/net/bond0/carrier 2>/dev/null)\" = 1"
+                    " && ip -4 -o addr show dev bond0 | grep -q inet"
+                    " && grep -A1 '^Slave Interface' /proc/net/bonding/bond0 | grep -q 'MII Status: up'"
+                    " && ! grep -A1 '^Slave Interface' /proc/net/bonding/bond0 | grep 'MII Status' | grep -qv up"
+                    " # scale-tools: bond_ready")
+
+# Applies the whole bond on the host, detached from the SSH session that started it,
+# and puts the previous connections back if bond0 has no connectivity in time
+BOND_APPLY_SCRIPT = r"""
+# scale-tools: bond_apply
+bond={bond}
+slaves=({slaves})
+options={options}
+active_slave={active_slave}
+timeout={timeout}
+status={status}
+
+gateway=$(ip -4 route show default | awk '{{print $3; exit}}')
+mapfile -t previous < <(for slave in "${{slaves[@]}}"; do nmcli -g GENERAL.CONNECTION device show "$slave" 2>/dev/null; done | grep -v '^$' | sort -u)
+ports=()
+for i in "${{!slaves[@]}}"; do
+    ports+=("$bond-port$((i + 1))")
+done
+
+rollback() {{
+    echo "rolling back: $1"
+    nmcli connection delete "${{ports[@]}}" "$bond" 2>/dev/null
+    for connection in "${{previous[@]}}"; do
+        nmcli connection up "$connection"
+    done
+    echo "rolled-back: $1" > "$status"
+    exit 1
+}}
+
+# Leftovers of an earlier attempt would clash with the new profiles
+nmcli connection delete "${{ports[@]}}" "$bond" 2>/dev/null
+nmcli connection add type bond con-name "$bond" ifname "$bond" bond.options "$options" || rollback "adding $bond failed"
+for i in "${{!slaves[@]}}"; do
+    nmcli connection add type ethernet slave-type bond con-name "${{ports[$i]}}" ifname "${{slaves[$i]}}" master "$bond" \
+        || rollback "adding ${{slaves[$i]}} to $bond failed"
+done
+nmcli connection reload
+nmcli connection up "$bond" || rollback "activating $bond failed"
+for port in "${{ports[@]}}"; do
+    nmcli connection up "$port" || rollback "activating $port failed"
+done
+if [ -n "$active_slave" ]; then
+    nmcli dev mod "$bond" +bond.options "active_slave=$active_slave"
+fi
+
+deadline=$((SECONDS + timeout))
+until [ "$(cat /sys/class/net/$bond/carrier 2>/dev/null)" = 1 ] && ip -4 -o addr show dev "$bond" | grep -q inet \
+        && {{ [ -z "$gateway" ] || ping -c 1 -W 1 -I "$bond" "$gateway" > /dev/null; }}; do
+    if [ $SECONDS -ge $deadline ]; then
+        rollback "no connectivity on $bond after $timeout seconds"
+    fi
+    sleep 2
+done
+echo applied > "$status"
+"""
+
+
+def build_bond_script(interfaces, bond_name='bond0', mode='balance-alb', rollback_timeout=60):
+    """
+    Builds the script that creates the bond, its ports and options in one go.
+
+    Parameters:
+    interfaces (list): The interfaces to enslave, the first one is the primary.
+    bond_name (str): The name of the bond interface.
+    mode (str): The bonding mode.
+    rollback_timeout (float): The number of seconds the bond may take to get connectivity before it is rolled back.
 
-def create_network_bond_on_remote_host(host, user, password):
+    Returns:
+    str: The script.
+    """
+    if not interfaces:
+        raise ValueError('no interfaces to bond')
+    options = f'mode={mode},primary={interfaces[0]}' if len(interfaces) > 1 else f'mode={mode}'
+    return BOND_APPLY_SCRIPT.format(bond=shlex.quote(bond_name),
+                                    slaves=' '.join(shlex.quote(interface) for interface in interfaces),
+                                    options=shlex.quote(options),
+                                    active_slave=shlex.quote(interfaces[1] if len(interfaces) > 1 else ''),
+                                    timeout=int(rollback_timeout),
+                                    status=shlex.quote(f'/var/tmp/{bond_name}-apply.status'))
+
+
+def create_network_bond_on_remote_host(host, user, password, mode='balance-alb', rollback_timeout=60):
     """
     Creates a network bond on the specified remote host using the NetworkManager command-line tool.
 
+    The bond is applied by one script started in the background on the host, so a
+    management link that drops while the interfaces move into the bond cannot leave
+    the host half configured. The script rolls back to the previous connections
+    when bond0 gets no carrier, address and gateway within rollback_timeout.
+
     Parameters:
     host (str): The hostname or IP address of the remote host.
     user (str): The username to use for SSH authentication.
     password (str): The password to use for SSH authentication.
+    mode (str): The bonding mode.
+    rollback_timeout (float): The number of seconds bond0 may take to get connectivity before it is rolled back.
 
     Returns:
-    None
+    str: The interfaces bonded.
     """
     # Define bond name and options
     bond_name = 'bond0'
-    bond_options = 'mode=balance-alb'
+    apply_path = f'/var/tmp/{bond_name}-apply'
 
     # Get list of network interfaces starting with 'ens'
-    command = 'ls /sys/class/net | grep ^ens'
-    interfaces = run_command_on_remote_host(host, command, user, password)
-    interfaces = interfaces.strip().split('\n')
-
-    # Add bond to NetworkManager
-    print(f'nmcli connection add type bond ifname {bond_name} bond.options "{bond_options}"')
-    command = f'nmcli connection add type bond ifname {bond_name} bond.options "{bond_options}"'
-    output = run_command_on_remote_host(host, command, user, password)
-    print(f'{output} ({host})')
-
-    # Add interfaces to bond
-    for i, interface in enumerate(interfaces):
-        command = f'nmcli connection add type ethernet slave-type bond con-name {bond_name}-port{i+1} ifname {interface} master {bond_name}'
-        output = run_command_on_remote_host(host, command, user, password)
-        print(f'{output} ({host})')
-
-    # Set primary interface
-    command = f'nmcli dev mod {bond_name} +bond.options "primary={interfaces[0]}"'
-    output = run_command_on_remote_host(host, command, user, password)
-    print(f'{output} ({host})')
-
-    # Set active slave interface and reload NetworkManager
-    command = f'nmcli dev mod {bond_name} +bond.options "active_slave={interfaces[1]}"'
-    output = run_command_on_remote_host(host, command, user, password)
-    print(f'{output} ({host})')
-
-    command = 'nmcli con reload'
-    output = run_command_on_remote_host(host, command, user, password)
-    print(f'{output} ({host})')
-
-    # Run ifdown on ens interfaces and ifup on bond
-    for interface in interfaces:
-        command = f'sudo ifdown {interface}'
-        output = run_command_on_remote_host(host, command, user, password)
-        print(f'{output} ({host})')
-
-    command = f'sudo ifup {bond_name}'
-    output = run_command_on_remote_host(host, command, user, password)
-    print(f'{output} ({host})')
-
-def copy_file_to_remote_hosts(host, user, password, file_name, file_path):
+    facts = inventory.cache.get(host)
+    interfaces = sorted(interface.name for interface in facts.interfaces if interface.name.startswith('ens'))
+    if not interfaces:
+        raise RuntimeError('no ens* interfaces to bond')
+    script = build_bond_script(interfaces, bond_name, mode, rollback_timeout)
+
+    # Upload and start the script in one round trip, it keeps running if the session drops
+    print(f'Creating {bond_name} ({mode}) from {", ".join(interfaces)} on host {host}')
+    command = (f"echo running > {apply_path}.status && printf '%s' {shlex.quote(script)} > {apply_path}.sh"
+               f" && (setsid nohup bash {apply_path}.sh > {apply_path}.log 2>&1 < /dev/null &)")
+    exit_status, output, error = ssh_pool.pool.exec_command(host, command, user, password)
+    if exit_status != 0:
+        raise RuntimeError(f'starting the bond script failed: {error.strip()}')
+
+    # The interfaces and addresses change
+    inventory.cache.invalidate(host)
+
+    # Poll for the outcome, reconnecting whenever the move to the bond broke the connection
+    deadline = time.monotonic() + rollback_timeout + 120
+    while time.monotonic() < deadline:
+        time.sleep(2)
+        try:
+            exit_status, status, error = ssh_pool.pool.exec_command(host, f'cat {apply_path}.status', user, password, timeout=10)
+        except Exception:
+            ssh_pool.pool.drop(host)
+            continue
+        status = status.strip()
+        if status == 'applied':
+            return f'{bond_name} created from {", ".join(interfaces)}'
+        if status.startswith('rolled-back'):
+            raise RuntimeError(f'{bond_name} {status}, see {apply_path}.log on the host')
+    raise TimeoutError(f'no outcome of the {bond_name} script after {rollback_timeout + 120} seconds, see {apply_path}.log on the host')
+
+def render_tuned_profile(host, template, rtt_ms=tuned_profile.DEFAULT_RTT_MS):
     """
-    Copies a file to a remote host using SSH and SFTP.
+    Renders the rhcs tuned profile for the hardware of a remote host and installs it
+    when it differs from the one on the host. A changed profile is applied right away
+    when rhcs is already the active profile.
 
     Parameters:
     host (str): The hostname or IP address of the remote host.
-    user (str): The username to use for SSH authentication.
-    password (str): The password to use for SSH authentication.
-    file_name (str): The name of the file to copy.
-    file_path (str): The path where the file should be copied to.
+    template (str): The content of the baseline tuned.conf.
+    rtt_ms (float): The round trip time between the hosts in milliseconds.
 
     Returns:
-    None
+    str: What changed on the host.
     """
-    try:
-        local_file_path = os.path.abspath(file_name)
-        if not os.path.isfile(local_file_path):
-            print(f"Source file '{file_name}' does not exist or is not a file.")
-            return
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
-
-        # Create the destination directory if it doesn't exist
-        ssh.exec_command(f'mkdir -p {file_path}')
-
-        sftp = ssh.open_sftp()
-        sftp.put(local_file_path, os.path.join(file_path, os.path.basename(file_name)))
-        sftp.close()
-        ssh.close()
-
-        print(f"Successfully copied file '{file_name}' to remote host '{host}'")
-    except Exception as e:
-        print(f"Error copying file '{file_name}' to remote host '{host}': {str(e)}")
+    facts = inventory.cache.get(host)
+    profile, sysctls = tuned_profile.render_profile(template, facts, rtt_ms)
+    rendered_sysctls[host] = sysctls
+
+    # Only sent when the remote copy differs, written atomically
+    changes = distribute.push_to_host(host, [distribute.from_data(TUNED_PROFILE_PATH, profile)])
+    if changes[TUNED_PROFILE_PATH] == 'copied':
+        exit_status, output, error = ssh_pool.pool.exec_command(
+            host, "if tuned-adm active | grep -q 'profile: rhcs$'; then tuned-adm profile rhcs; fi")
+        if exit_status != 0:
+            raise RuntimeError(f'applying the rhcs profile failed: {error.strip()}')
+    return f'{TUNED_PROFILE_PATH}: {distribute.summarize(changes)}'
 
 def generate_dhcp_record(host, user, password):
     """
@@ -110,30 +201,19 @@ def generate_dhcp_record(host, user, password):
     Returns:
     str: The DHCP record.
     """
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(host, username=user, password=password)
-
-    # Retrieve IP address and MAC address from remote host
-    stdin, stdout, stderr = ssh.exec_command("ip -f inet addr show bond0 | awk '/inet / {split($2, a, \"/\"); print a[1]}'")
-    ip_address = stdout.read().decode().strip()
-
-    stdin, stdout, stderr = ssh.exec_command("ip -f link addr show bond0 | awk '/link\/ether/ {print $2}'")
-    mac_address = stdout.read().decode().strip()
+    # Retrieve IP address and MAC address from remote host, the bond may have come up after the last collection
+    facts = inventory.cache.collect(host)
+    bond = next((interface for interface in facts.interfaces if interface.name == 'bond0'), None)
+    ip_address = bond.addresses[0].split('/')[0] if bond and bond.addresses else ''
+    mac_address = bond.mac if bond else ''
 
     # Generate DHCP record
     dhcp_record = f"dhcp-host={mac_address},{ip_address},{host},infinite"
-    ssh.close()
     return dhcp_record
 
 
 def run_command_on_remote_host(hostname, command, username, password):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname, username=username, password=password)
-    stdin, stdout, stderr = client.exec_command(command)
-    output = stdout.read().decode()
-    client.close()
+    exit_status, output, error = ssh_pool.pool.exec_command(hostname, command, username, password, stream=True)
     return output
 
 if __name__ == '__main__':
@@ -141,52 +221,79 @@ if __name__ == '__main__':
     parser.add_argument('-hf', '--hosts_file', required=True, help='The file containing the hosts to setup')
     parser.add_argument('-u', '--user', required=True, help='The SSH username to use for connecting to the hosts')
     parser.add_argument('-p', '--password', required=True, help='The SSH password to use for connecting to the hosts')
+    fanout.add_arguments(parser)
+    logs.add_arguments(parser)
+    state.add_arguments(parser, '2_setup_net.state')
+    inventory.add_arguments(parser)
+    parser.add_argument('--bond-mode', default='balance-alb', help='The bonding mode of bond0')
+    parser.add_argument('--rollback-timeout', type=float, default=60, help='The number of seconds bond0 may take to reach the gateway before a host goes back to its previous connections')
+    parser.add_argument('--ready-timeout', type=float, default=300, help='The number of seconds to wait for bond0 to come up on all hosts')
+    parser.add_argument('--rtt-ms', type=float, default=tuned_profile.DEFAULT_RTT_MS, help='The round trip time between the hosts in milliseconds, the socket buffers are sized for it')
+    net_mesh.add_arguments(parser)
+    timing.add_arguments(parser)
     args = parser.parse_args()
+    timing.start(args)
+    ssh_pool.pool.configure(args.user, args.password, args.timeout)
+    fanout.engine.configure(args.max_workers, args.timeout)
+    logs.host_logs.configure(args.log_dir, not args.quiet)
+    inventory.cache.configure(args.inventory_ttl)
 
 # Read hosts from file
     with open(args.hosts_file) as f:
         hosts = f.read().splitlines()
 
-    # clear uneeded NICs
-    for host in hosts:
-        print(f'Running on host {host}')
-        output = run_command_on_remote_host(host, "for intf in $(nmcli conn show | grep '\.10' | awk '{ print $1 }') ; do nmcli conn down $intf; nmcli conn del $intf ; done", args.user, args.password)
-        print(f'{output} ({host})')
-
-    #create network bond
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(create_network_bond_on_remote_host, (host , args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-
-#prevent ens interfaces to come up after reboot
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "sed -i 's/ONBOOT=yes/ONBOOT=no/g' /etc/sysconfig/network-scripts/ifcfg-ens*", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-
-    #install tuned
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "dnf install tuned -y; systemctl start tuned; systemctl enable tuned", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-
-   #copy rhcs conf file
-    file_name = 'tuned.conf'
-    file_path = '/etc/tuned/rhcs'
+    #baseline of the rhcs profile, rendered per host
+    with open('tuned.conf') as f:
+        template = f.read()
+
+    setup_steps = [
+        # clear uneeded NICs
+        steps.Step('clear_nics', steps.remote_command("for intf in $(nmcli conn show | grep '\.10' | awk '{ print $1 }') ; do nmcli conn down $intf; nmcli conn del $intf ; done"),
+                   probe="! nmcli conn show | grep -q '\.10'"),
+        #create network bond
+        steps.Step('bond', lambda host: create_network_bond_on_remote_host(host, args.user, args.password, args.bond_mode, args.rollback_timeout), requires=['clear_nics'],
+                   probe="ip link show bond0"),
+        #prevent ens interfaces to come up after reboot
+        steps.Step('onboot', steps.remote_command("sed -i 's/ONBOOT=yes/ONBOOT=no/g' /etc/sysconfig/network-scripts/ifcfg-ens*"), requires=['bond'],
+                   probe="! grep -qs ONBOOT=yes /etc/sysconfig/network-scripts/ifcfg-ens*"),
+        #pin the slave NIC queues and IRQs to their NUMA node, reapplied at boot by a systemd unit
+        steps.Step('nic_tuning', nic_tuning.tune_host, requires=['bond'],
+                   probe=f"systemctl is-enabled -q {nic_tuning.UNIT_NAME}"),
+        #install tuned
+        steps.Step('tuned', steps.remote_command("dnf install tuned -y; systemctl start tuned; systemctl enable tuned"),
+                   probe="rpm -q tuned && systemctl is-active -q tuned && systemctl is-enabled -q tuned"),
+        # the profile is rendered on every run so local edits and hardware changes are picked up
+        steps.Step('tuned_conf', lambda host: render_tuned_profile(host, template, args.rtt_ms), resumable=False),
+        #setup tuned to use rhcs profile
+        steps.Step('tuned_profile', steps.remote_command("tuned-adm profile rhcs"), requires=['tuned', 'tuned_conf'],
+                   probe="tuned-adm active | grep -q 'profile: rhcs$'"),
+        #check the rendered values are live
+        steps.Step('tuned_verify', lambda host: tuned_profile.verify_sysctls(host, rendered_sysctls[host]), requires=['tuned_conf', 'tuned_profile'],
+                   resumable=False),
+    ]
+    status = steps.run_steps(setup_steps, hosts, state.StateStore(args.state_file, args.fresh))
+    steps.print_summary(status)
+
+    #wait for bond0 to be up with an address before collecting dhcp info for DHCP conf, on the hosts where it was set up
+    bonded = [host for host in hosts if status[host].get('bond') == 'done']
     for host in hosts:
-        copy_file_to_remote_hosts(host, args.user, args.password, file_name, file_path)
-
-    #setup tuned to use rhcs profile
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(run_command_on_remote_host, (host, "tuned-adm profile rhcs", args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-
-    #sleep before collection dhcp info for DHCP conf
-    time.sleep(20)
+        if host not in bonded:
+            print(f"bond0 was not set up on host '{host}' ({status[host].get('bond', 'not run')}), no DHCP record generated")
+    ready, stragglers = wait.wait_for(wait.remote_probe(BOND_READY_PROBE), bonded, args.ready_timeout,
+                                      progress=lambda ready, hosts: print(f'bond0 ready on {len(ready)}/{len(hosts)} hosts'), step='bond_ready')
+    for host in stragglers:
+        print(f"bond0 on host '{host}' did not come up within {args.ready_timeout} seconds, no DHCP record generated")
 
     #generate dhcp records
-    for host in hosts:
-        output = generate_dhcp_record(host, args.user, args.password)
+    records = fanout.engine.run(generate_dhcp_record, list(ready), args.user, args.password, step='dhcp_record')
+    for host, output in records.items():
         print(f'{output}')
+
+    #check the bandwidth and latency between the bonded hosts
+    if args.mesh_pattern != 'none' and len(ready) > 1:
+        net_mesh.validate([host for host in hosts if host in ready], args)
+
+    timing.finish(args)
+    fanout.engine.shutdown()
+    ssh_pool.pool.close_all()
+    logs.host_logs.close_all()
@@ -1,69 +1,52 @@
 import argparse
-import paramiko
-import multiprocessing
-import time
-import os
-import socket
-timeout_seconds = 3
-
-def add_ssh_key_to_remote_host(hostname, username, password):
+import distribute
+import fanout
+import inventory
+import logs
+import osd_spec
+import ssh_keys
+import ssh_pool
+import timing
+
+def add_ssh_key_to_remote_host(hostname, public_key):
     try:
-        # Copy SSH key to remote host
-        os.system(f'sshpass -p "{password}" ssh-copy-id -f -i /etc/ceph/ceph.pub {username}@{hostname}')
-        return f'SSH key added to {hostname}'
+        # Authorize the cephadm SSH key over the pooled session, unless it already is
+        return ssh_keys.deploy_keys(hostname, [public_key])
     except Exception as e:
         print(f'Error adding SSH key to {hostname}: {str(e)}')
         return ''
 
-def copy_file_to_remote_hosts(host, user, password, file_name, file_path):
+def plan_osds(hosts, options):
     """
-    Copies a file to a remote host using SSH and SFTP.
+    Plans the OSDs of every host from its drives, prints the plan for review and
+    writes the cephadm OSD service spec.
 
     Parameters:
-    host (str): The hostname or IP address of the remote host.
-    user (str): The username to use for SSH authentication.
-    password (str): The password to use for SSH authentication.
-    file_name (str): The name of the file to copy.
-    file_path (str): The path where the file should be copied to.
+    hosts (list): The hostnames or IP addresses of the hosts.
+    options (argparse.Namespace): The parsed options, see osd_spec.add_arguments.
 
     Returns:
-    None
+    list: The specs written.
     """
-    try:
-        local_file_path = os.path.abspath(file_name)
-        if not os.path.isfile(local_file_path):
-            print(f"Source file '{file_name}' does not exist or is not a file.")
-            return
-
-        # Skip file copying if the host is the same as the current host
-        if host == socket.gethostname():
-            print("Skipping file copying for the local host.")
-            return
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
-
-        # Create the destination directory if it doesn't exist
-        ssh.exec_command(f'mkdir -p {file_path}')
-
-        sftp = ssh.open_sftp()
-        sftp.put(local_file_path, os.path.join(file_path, os.path.basename(file_name)))
-        sftp.close()
-        ssh.close()
-
-        print(f"Successfully copied file '{file_name}' to remote host '{host}'")
-    except Exception as e:
-        print(f"Error copying file '{file_name}' to remote host '{host}': {str(e)}")
-
+    # The spec selects drives on the hosts as they are now, so never plan from older facts
+    facts = fanout.engine.run(inventory.cache.collect, hosts, step='osd_plan')
+    plans = []
+    for host, host_facts in facts.items():
+        if isinstance(host_facts, Exception):
+            print(f"Error collecting the drives of remote host '{host}': {str(host_facts)}")
+        else:
+            plans.append(osd_spec.plan_host(host_facts, int(options.large_nvme_tb * 1e12), options.osds_per_nvme))
+    osd_spec.print_plan(plans)
+    specs = osd_spec.build_specs(plans)
+    if specs:
+        with open(options.osd_spec, 'w') as f:
+            f.write(osd_spec.render_specs(specs))
+        print(f'{len(specs)} OSD service spec(s) for {len(plans)} hosts written to {options.osd_spec}, '
+              f'review it with ceph orch apply -i {options.osd_spec} --dry-run')
+    return specs
 
 def run_command_on_remote_host(hostname, command, username, password):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(hostname, username=username, password=password)
-    stdin, stdout, stderr = client.exec_command(command)
-    output = stdout.read().decode()
-    client.close()
+    exit_status, output, error = ssh_pool.pool.exec_command(hostname, command, username, password, stream=True)
     return output
 
 if __name__ == '__main__':
@@ -71,30 +54,50 @@ if __name__ == '__main__':
     parser.add_argument('-hf', '--hosts_file', required=True, help='The file containing the hosts to setup')
     parser.add_argument('-u', '--user', required=True, help='The SSH username to use for connecting to the hosts')
     parser.add_argument('-p', '--password', required=True, help='The SSH password to use for connecting to the hosts')
+    fanout.add_arguments(parser)
+    logs.add_arguments(parser)
+    distribute.add_arguments(parser)
+    osd_spec.add_arguments(parser)
+    timing.add_arguments(parser)
     args = parser.parse_args()
+    timing.start(args)
+    ssh_pool.pool.configure(args.user, args.password, args.timeout)
+    fanout.engine.configure(args.max_workers, args.timeout)
+    logs.host_logs.configure(args.log_dir, not args.quiet)
 
 # Read hosts from file
     with open(args.hosts_file) as f:
         hosts = f.read().splitlines()
 
-   #copy ceph conf file to all the hosts
-    file_name = '/etc/ceph/ceph.conf'
-    file_path = '/etc/ceph/'
-    for host in hosts:
-        #print("copying file " + file_name + " to remote host " + host)
-        copy_file_to_remote_hosts(host, args.user, args.password, file_name, file_path)
-
-   #copy ceph key file to all the hosts
-    file_name = '/etc/ceph/ceph.client.admin.keyring'
-    file_path = '/etc/ceph/'
-    for host in hosts:
-        copy_file_to_remote_hosts(host, args.user, args.password, file_name, file_path)
+    #copy ceph conf and key file to all the hosts, only where they differ
+    ceph_files = [('/etc/ceph/ceph.conf', '/etc/ceph/ceph.conf', 0o644),
+                  ('/etc/ceph/ceph.client.admin.keyring', '/etc/ceph/ceph.client.admin.keyring', 0o600)]
+    try:
+        files = distribute.load_files(ceph_files)
+    except OSError as e:
+        print(f'Error reading the Ceph configuration: {str(e)}')
+    else:
+        results = distribute.distribute(hosts, files, args.relay)
+        for host, changes in results.items():
+            if isinstance(changes, Exception):
+                print(f"Error copying the Ceph configuration to remote host '{host}': {str(changes)}")
+            else:
+                print(f'Ceph configuration on {host}: {distribute.summarize(changes)}')
 
     # Copy SSH key to each host
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(add_ssh_key_to_remote_host, (host, args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-    for r in results:
-        output = r.get()
-        print(f'{output} ({r.get()})')
+    try:
+        ceph_public_key = ssh_keys.read_public_key('/etc/ceph/ceph.pub')
+    except (OSError, ValueError) as e:
+        print(f'Error reading the cephadm SSH key: {str(e)}')
+    else:
+        results = fanout.engine.run(add_ssh_key_to_remote_host, hosts, ceph_public_key, step='copy_ssh_key')
+        for host, output in results.items():
+            print(f'{output} ({host})')
+
+    # Data on the bulk media, DB/WAL on the fast media of every host
+    plan_osds(hosts, args)
+
+    timing.finish(args)
+    fanout.engine.shutdown()
+    ssh_pool.pool.close_all()
+    logs.host_logs.close_all()
@@ -1,198 +1,167 @@
 import argparse
-import paramiko
-import multiprocessing
-
-def get_disk_list(host, user, password):
+import base64
+import fanout
+import inventory
+import shlex
+import ssh_pool
+import timing
+
+# How a disk is wiped, zap only clears the partition tables and signatures while
+# discard also trims the whole device so the next OSD starts from clean flash
+WIPE_COMMANDS = {
+    'zap': 'sgdisk -Z "/dev/$1" 2>&1 && wipefs -a "/dev/$1" 2>&1',
+    'discard': 'sgdisk -Z "/dev/$1" 2>&1 && wipefs -a "/dev/$1" 2>&1 && blkdiscard "/dev/$1" 2>&1',
+}
+
+TEARDOWN_SCRIPT = """
+# scale-tools: teardown
+result() {{ printf '%s\\t%s\\t%s\\t%s\\t%s\\n' "$1" "$2" "$3" "$4" "$(printf '%s' "$5" | base64 -w0)"; }}
+for lvm in {lvm_names}; do out=$(lvremove "$lvm" -y 2>&1); result lvm "$lvm" $? - "$out"; done
+for pv in {pv_names}; do out=$(pvremove "$pv" --force --force -y 2>&1); result pv "$pv" $? - "$out"; done
+results=$(mktemp -d)
+wipe() {{
+    method={wipe_mode}
+    # Devices without discard support fall back to zapping
+    if [ "$method" = discard ] && [ "$(cat /sys/block/$1/queue/discard_max_bytes 2>/dev/null || echo 0)" -eq 0 ]; then
+        method=zap
+    fi
+    if [ "$method" = discard ]; then
+        out=$({discard_command})
+    else
+        out=$({zap_command})
+    fi
+    result disk "$1" $? "$method" "$out" > "$results/$1"
+}}
+for disk in {disks}; do
+    while [ "$(jobs -rp | wc -l)" -ge {parallel_devices} ]; do wait -n; done
+    wipe "$disk" &
+done
+wait
+cat "$results"/* 2>/dev/null
+rm -rf "$results"
+"""
+
+
+def get_disk_inventory(host):
     """
-    Retrieves the list of disks on a remote host using SSH and the lsblk command.
+    Retrieves the ceph LVMs, the ceph PVs and the disks of a remote host from a fresh inventory collection.
 
     Parameters:
     host (str): The hostname or IP address of the remote host.
-    user (str): The username to use for SSH authentication.
-    password (str): The password to use for SSH authentication.
 
     Returns:
-    list: A list of disk names on the remote host.
+    tuple: The lists of LVM names, PV names and disk names on the remote host, and the reason
+           for every system disk left out of the disks.
     """
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
+    # The teardown acts on what is on the host right now, so never reuse older facts
+    facts = inventory.cache.collect(host)
 
-        command = "lsblk -nd -I 8,259 -o name"
-        stdin, stdout, stderr = ssh.exec_command(command)
-        disk_list = stdout.read().decode().split()
-        ssh.close()
+    lvm_names = [name for name in facts.volume_groups if 'ceph' in name]
+    pv_names = [pv.name for pv in facts.physical_volumes if 'ceph' in pv.vg_name]
+    # The disks the host boots and runs from are never wiped
+    system = inventory.system_disks(facts)
+    disk_list = [disk.name for disk in facts.disks if disk.name not in system]
 
-        return disk_list
-    except Exception as e:
-        print(f"Error connecting to host '{host}': {str(e)}")
-        return []
+    return lvm_names, pv_names, disk_list, system
 
-def wipe_disks_on_remote_hosts(host, user, password):
+def build_teardown_script(lvm_names, pv_names, disks, wipe_mode='zap', parallel_devices=0):
     """
-    Wipes disks on a remote host using SSH and the sgdisk command.
+    Builds the shell script removing the LVMs and PVs and then wiping the disks in parallel.
 
     Parameters:
-    host (str): The hostname or IP address of the host.
-    user (str): The username to use for SSH authentication.
-    password (str): The password to use for SSH authentication.
+    lvm_names (list): The LVM names to remove.
+    pv_names (list): The PV names to remove.
+    disks (list): The disk names to wipe.
+    wipe_mode (str): 'zap' to clear partition tables and signatures, 'discard' to also discard the whole device where supported.
+    parallel_devices (int): The maximum number of disks wiped at the same time, 0 for all of them.
 
     Returns:
-    None
+    str: The script, printing one tab separated line per device with its kind, name, exit status, wipe method and base64 encoded output.
     """
-    try:
-        disks = get_disk_list(host, user, password)
-
-        if not disks:
-            print(f"No disks found on host '{host}'.")
-            return
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
-
-        for disk in disks:
-            command = f'sgdisk -Z /dev/{disk}'
-            stdin, stdout, stderr = ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status == 0:
-                print(f"Successfully wiped disk '{disk}' on host '{host}'")
-            else:
-                print(f"Error wiping disk '{disk}' on host '{host}': {stderr.read().decode()}")
-
-        ssh.close()
-    except Exception as e:
-        print(f"Error connecting to host '{host}': {str(e)}")
-
-def get_lvm_names(host, user, password):
+    return TEARDOWN_SCRIPT.format(lvm_names=' '.join(shlex.quote(name) for name in lvm_names),
+                                  pv_names=' '.join(shlex.quote(name) for name in pv_names),
+                                  disks=' '.join(shlex.quote(name) for name in disks),
+                                  wipe_mode=shlex.quote(wipe_mode),
+                                  zap_command=WIPE_COMMANDS['zap'],
+                                  discard_command=WIPE_COMMANDS['discard'],
+                                  parallel_devices=parallel_devices or max(len(disks), 1))
+
+def parse_teardown_results(output):
     """
-    Retrieves the list of LVM names on a remote host using SSH and the vgdisplay command with awk.
+    Parses the per device lines printed by the teardown script.
 
     Parameters:
-    host (str): The hostname or IP address of the remote host.
-    user (str): The username to use for SSH authentication.
-    password (str): The password to use for SSH authentication.
+    output (str): The output of the teardown script.
 
     Returns:
-    list: A list of LVM names on the remote host.
+    list: A (kind, name, exit status, wipe method, output) tuple per device.
     """
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
-
-        command = "vgdisplay -s | awk -F'\"' '/ceph/ { print $2 }'"
-        stdin, stdout, stderr = ssh.exec_command(command)
-        lvm_names = stdout.read().decode().split()
-        ssh.close()
-
-        return lvm_names
-    except Exception as e:
-        print(f"Error connecting to host '{host}': {str(e)}")
-        return []
-
-def remove_lvm_on_remote_hosts(host, user, password):
+    results = []
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 5:
+            continue
+        kind, name, exit_status, method, message = fields
+        results.append((kind, name, int(exit_status), method, base64.b64decode(message).decode(errors='replace')))
+    return results
+
+def clean_disks_on_remote_host(host, user, password, wipe_mode='zap', parallel_devices=0):
     """
-    Removes LVMs on a remote host using SSH and the lvremove command.
+    Removes the ceph LVMs and PVs and wipes every disk but the system disks on a
+    remote host, with one inventory query and one teardown script run in a single
+    round trip.
 
     Parameters:
     host (str): The hostname or IP address of the host.
     user (str): The username to use for SSH authentication.
     password (str): The password to use for SSH authentication.
+    wipe_mode (str): 'zap' or 'discard', see build_teardown_script.
+    parallel_devices (int): The maximum number of disks wiped at the same time, 0 for all of them.
 
     Returns:
-    None
+    list: A (kind, name, exit status, wipe method, output) tuple per device.
     """
     try:
-        lvm_names = get_lvm_names(host, user, password)
+        lvm_names, pv_names, disks, system = get_disk_inventory(host)
+        for name, reason in system.items():
+            print(f"Skipping system disk '{name}' on host '{host}': {reason}")
 
         if not lvm_names:
             print(f"No LVMs found on host '{host}'.")
-            return
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
-
-        for lvm_name in lvm_names:
-            command = f'lvremove {lvm_name} -y'
-            stdin, stdout, stderr = ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status == 0:
-                print(f"Successfully removed LVM '{lvm_name}' on host '{host}'")
-            else:
-                print(f"Error removing LVM '{lvm_name}' on host '{host}': {stderr.read().decode()}")
-
-        ssh.close()
-    except Exception as e:
-        print(f"Error connecting to host '{host}': {str(e)}")
-
-def get_pv_names(host, user, password):
-    """
-    Retrieves the list of PV names on a remote host using SSH and the pvdisplay command with awk.
-
-    Parameters:
-    host (str): The hostname or IP address of the remote host.
-    user (str): The username to use for SSH authentication.
-    password (str): The password to use for SSH authentication.
-
-    Returns:
-    list: A list of PV names on the remote host.
-    """
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
-
-        command = "pvdisplay|grep -B1 ceph|grep PV|awk '{print $3}'"
-        stdin, stdout, stderr = ssh.exec_command(command)
-        pv_names = stdout.read().decode().split()
-        ssh.close()
-
-        return pv_names
-    except Exception as e:
-        print(f"Error connecting to host '{host}': {str(e)}")
-        return []
-
-
-def remove_pv_on_remote_hosts(host, user, password):
-    """
-    Removes PVs on a remote host using SSH and the pvremove command.
-
-    Parameters:
-    host (str): The hostname or IP address of the host.
-    user (str): The username to use for SSH authentication.
-    password (str): The password to use for SSH authentication.
-
-    Returns:
-    None
-    """
-    try:
-        pv_names = get_pv_names(host, user, password)
-
         if not pv_names:
             print(f"No PVs found on host '{host}'.")
-            return
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, password=password)
-
-        for pv_name in pv_names:
-            command = f'pvremove {pv_name} --force --force -y'
-            stdin, stdout, stderr = ssh.exec_command(command)
-            exit_status = stdout.channel.recv_exit_status()
-            if exit_status == 0:
-                print(f"Successfully removed PV '{pv_name}' on host '{host}'")
+        if not disks:
+            print(f"No disks found on host '{host}'.")
+        if not (lvm_names or pv_names or disks):
+            return []
+
+        command = f'bash -c {shlex.quote(build_teardown_script(lvm_names, pv_names, disks, wipe_mode, parallel_devices))}'
+        exit_status, output, error = ssh_pool.pool.exec_command(host, command, user, password)
+        results = parse_teardown_results(output)
+        inventory.cache.invalidate(host)
+        if exit_status != 0:
+            print(f"Error running the teardown on host '{host}': exit status {exit_status}: {error.strip()}")
+        reported = {(kind, name) for kind, name, status, method, message in results}
+        for kind, names in (('lvm', lvm_names), ('pv', pv_names), ('disk', disks)):
+            for name in names:
+                if (kind, name) not in reported:
+                    # The script stopped before it got to the device
+                    results.append((kind, name, -1, '-', 'no result from the teardown script'))
+
+        actions = {'lvm': ('removed', 'removing', 'LVM'), 'pv': ('removed', 'removing', 'PV'), 'disk': ('wiped', 'wiping', 'disk')}
+        for kind, name, status, method, message in results:
+            done, doing, label = actions[kind]
+            if status == 0 and kind == 'disk':
+                print(f"Successfully {done} {label} '{name}' on host '{host}' ({method})")
+            elif status == 0:
+                print(f"Successfully {done} {label} '{name}' on host '{host}'")
             else:
-                print(f"Error removing PV '{pv_name}' on host '{host}': {stderr.read().decode()}")
+                print(f"Error {doing} {label} '{name}' on host '{host}': {message}")
 
-        ssh.close()
+        return results
     except Exception as e:
         print(f"Error connecting to host '{host}': {str(e)}")
-
-
+        return []
 
 
 if __name__ == '__main__':
@@ -200,25 +169,21 @@ if __name__ == '__main__':
     parser.add_argument('-hf', '--hosts_file', required=True, help='The file containing the hosts to wipe disks')
     parser.add_argument('-u', '--user', required=True, help='The SSH username to use for connecting to the hosts')
     parser.add_argument('-p', '--password', required=True, help='The SSH password to use for connecting to the hosts')
+    parser.add_argument('-m', '--wipe-mode', choices=sorted(WIPE_COMMANDS), default='zap', help='zap clears partition tables and signatures, discard also discards the whole device on drives that support it')
+    parser.add_argument('-d', '--parallel-devices', type=int, default=0, help='The maximum number of disks wiped at the same time on a host, 0 for all of them')
+    fanout.add_arguments(parser)
+    timing.add_arguments(parser)
     args = parser.parse_args()
+    timing.start(args)
+    ssh_pool.pool.configure(args.user, args.password, args.timeout)
+    fanout.engine.configure(args.max_workers, args.timeout)
 
     with open(args.hosts_file, 'r') as file:
         hosts = file.read().splitlines()
 
-    # Remove LVMs on each host
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(remove_lvm_on_remote_hosts, (host, args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-
-    # Remove PVs on each host
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(remove_pv_on_remote_hosts, (host, args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
-
-    # wipe disks on each host
-    pool = multiprocessing.Pool(processes=len(hosts))
-    results = [pool.apply_async(wipe_disks_on_remote_hosts, (host, args.user, args.password)) for host in hosts]
-    pool.close()
-    pool.join()
+    # Remove LVMs and PVs and wipe disks on each host
+    fanout.engine.run(clean_disks_on_remote_host, hosts, args.user, args.password, args.wipe_mode, args.parallel_devices, step='clean_disks')
+
+    timing.finish(args)
+    fanout.engine.shutdown()
+    ssh_pool.pool.close_all()
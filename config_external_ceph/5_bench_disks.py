@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import distribute
+import fanout
+import inventory
+import ssh_pool
+import timing
+
+TESTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'disk_tester.py')
+TESTER_PATH = '/var/tmp/disk_tester.py'
+# RHEL 8 hosts without the python3 package still have the platform Python
+PYTHON = '$(command -v python3 || echo /usr/libexec/platform-python)'
+# Fleets with more devices than this only list the flagged ones
+MAX_TABLE_DEVICES = 256
+
+
+def get_disks(host):
+    """
+    Retrieves the disks of a remote host and the ones that must not be written to,
+    from a fresh inventory collection, like 4_clean_disks.py: the system disks and
+    the disks of ceph OSDs.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+
+    Returns:
+    tuple: The disks of the host and the reason for every disk in use, by disk name.
+    """
+    facts = inventory.cache.collect(host)
+    in_use = inventory.system_disks(facts)
+    for disk in facts.disks:
+        for pv in facts.physical_volumes:
+            if disk.name not in in_use and inventory.on_disk(disk, pv.name):
+                in_use[disk.name] = f'LVM PV of {pv.vg_name}'
+    return facts.disks, in_use
+
+
+def build_command(devices, options):
+    """
+    Builds the command running the tester on the devices of a host.
+
+    Parameters:
+    devices (list): The device paths.
+    options (argparse.Namespace): The benchmark options, see add_arguments.
+
+    Returns:
+    str: The command.
+    """
+    command = (f'{PYTHON} {TESTER_PATH} --seconds {options.seconds} --jobs {options.jobs}'
+               f' --parallel {options.parallel_devices}')
+    if options.write:
+        command += ' --write'
+    return f"{command} {' '.join(shlex.quote(device) for device in devices)}"
+
+
+def parse_results(output):
+    """
+    Parses the JSON lines printed by the tester.
+
+    Parameters:
+    output (str): The output of the tester.
+
+    Returns:
+    dict: The result of every device path.
+    """
+    results = {}
+    for line in output.splitlines():
+        if line.startswith('{'):
+            result = json.loads(line)
+            results[result['device']] = result
+    return results
+
+
+def expected_seconds(devices, options):
+    waves = -(-devices // options.parallel_devices) if options.parallel_devices else 1
+    return waves * options.seconds * (4 if options.write else 2)
+
+
+def bench_disks_on_remote_host(host, user, password, options):
+    """
+    Copies the tester to a remote host and runs it on all of its disks in one command.
+
+    Parameters:
+    host (str): The hostname or IP address of the host.
+    user (str): The username to use for SSH authentication.
+    password (str): The password to use for SSH authentication.
+    options (argparse.Namespace): The benchmark options, see add_arguments.
+
+    Returns:
+    list: A (disk, result) tuple per disk, the result being the tester output or an error message.
+    """
+    try:
+        disks, in_use = get_disks(host)
+        if not disks:
+            print(f"No disks found on host '{host}'.")
+            return []
+        if options.write and in_use:
+            # The tester also refuses them, this keeps them out of the report's medians
+            print(f"Not writing to {', '.join(f'{name} ({in_use[name]})' for name in sorted(in_use))} on host '{host}', "
+                  f"system disks are never written and ceph OSDs only after 4_clean_disks.py")
+            disks = [disk for disk in disks if disk.name not in in_use]
+
+        with open(TESTER, 'rb') as f:
+            distribute.push_to_host(host, [distribute.from_data(TESTER_PATH, f.read(), 0o755)])
+        command = build_command([f'/dev/{disk.name}' for disk in disks], options)
+        exit_status, output, error = ssh_pool.pool.exec_command(host, command, user, password,
+                                                                timeout=expected_seconds(len(disks), options) + 120)
+        results = parse_results(output)
+        if exit_status != 0 and not results:
+            raise RuntimeError(f'the tester exited with status {exit_status}: {error.strip()}')
+        return [(disk, results.get(f'/dev/{disk.name}', {'error': 'no result'})) for disk in disks]
+    except Exception as e:
+        print(f"Error benchmarking disks on host '{host}': {str(e)}")
+        return []
+
+
+def bench_loopback(hosts, options):
+    """
+    Runs the tester on files standing in for the disks of simulated hosts, to try the
+    benchmark and its report on any Linux box.
+
+    Parameters:
+    hosts (list): The simulated host names.
+    options (argparse.Namespace): The benchmark options, see add_arguments.
+
+    Returns:
+    dict: A list of (disk, result) tuples for every host.
+    """
+    directory = tempfile.mkdtemp(prefix='bench_disks.', dir='/var/tmp')
+    size = options.loopback_size * 1024 * 1024
+    try:
+        disks = {}
+        for host in hosts:
+            disks[host] = []
+            for n in range(options.loopback_devices):
+                path = os.path.join(directory, f'{host}-disk{n}')
+                # Written out, the holes of a sparse file read back without any I/O
+                with open(path, 'wb') as f:
+                    for offset in range(0, size, 1024 * 1024):
+                        f.write(os.urandom(1024 * 1024))
+                disks[host].append(inventory.Disk(name=os.path.basename(path), size=size, rotational=False, model='LOOPBACK FILE',
+                                                  serial=f'{host}-{n}', numa_node=-1, discard=False, mountpoints=[]))
+
+        def run(host):
+            command = [sys.executable, TESTER, '--seconds', str(options.seconds), '--jobs', str(options.jobs),
+                       '--parallel', str(options.parallel_devices)] + (['--write'] if options.write else [])
+            completed = subprocess.run(command + [os.path.join(directory, disk.name) for disk in disks[host]],
+                                       capture_output=True, text=True)
+            results = parse_results(completed.stdout)
+            return [(disk, results.get(os.path.join(directory, disk.name), {'error': completed.stderr.strip() or 'no result'}))
+                    for disk in disks[host]]
+
+        return fanout.engine.run(run, hosts, step='bench_disks')
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def find_outliers(results, slow_fraction=0.7, latency_factor=3.0):
+    """
+    Compares every drive to the median of the drives of the same model and flags the
+    ones well below it, as a single slow drive later shows up as the tail latency of
+    the whole cluster.
+
+    Parameters:
+    results (dict): A list of (disk, result) tuples for every host.
+    slow_fraction (float): Drives below this fraction of their model's median throughput or IOPS are slow.
+    latency_factor (float): Drives above this multiple of their model's median p99 latency are slow.
+
+    Returns:
+    tuple: The medians of every model, and the reasons of every flagged (host, disk name).
+    """
+    by_model = {}
+    for host, disks in results.items():
+        for disk, result in disks if not isinstance(disks, Exception) else []:
+            if 'error' not in result:
+                by_model.setdefault(disk.model, []).append(result)
+
+    metrics = (('seq_read', 'mb_per_second', 'MB/s'), ('rand_read', 'iops', 'IOPS'),
+               ('seq_write', 'mb_per_second', 'MB/s'), ('rand_write', 'iops', 'IOPS'))
+    medians = {}
+    for model, model_results in by_model.items():
+        medians[model] = {}
+        for test, key, unit in metrics:
+            values = [result[test][key] for result in model_results if test in result]
+            latencies = [result[test]['lat_us']['p99'] for result in model_results if test in result and 'lat_us' in result[test]]
+            if values:
+                medians[model][test] = statistics.median(values)
+            if latencies:
+                medians[model][f'{test}_p99'] = statistics.median(latencies)
+
+    flagged = {}
+    for host, disks in results.items():
+        if isinstance(disks, Exception):
+            continue
+        for disk, result in disks:
+            reasons = []
+            if 'error' in result:
+                reasons.append(f"failed: {result['error']}")
+            else:
+                model = medians[disk.model]
+                for test, key, unit in metrics:
+                    if test not in result:
+                        continue
+                    if result[test][key] < slow_fraction * model[test]:
+                        reasons.append(f'{test} {result[test][key]:.0f} {unit}, median {model[test]:.0f}')
+                    p99 = result[test].get('lat_us', {}).get('p99')
+                    if p99 and model.get(f'{test}_p99') and p99 > latency_factor * model[f'{test}_p99']:
+                        reasons.append(f"{test} p99 {p99:.0f} us, median {model[f'{test}_p99']:.0f}")
+                if not result['seq_read'].get('direct', True):
+                    reasons.append('page cache not bypassed')
+            if reasons:
+                flagged[(host, disk.name)] = reasons
+    return medians, flagged
+
+
+def print_report(results, medians, flagged):
+    """
+    Prints the throughput, IOPS and latency of every drive (only the flagged drives
+    on large fleets), the medians of every model and the outliers.
+
+    Parameters:
+    results (dict): A list of (disk, result) tuples for every host.
+    medians (dict): The medians of every model.
+    flagged (dict): The reasons of every flagged (host, disk name).
+
+    Returns:
+    None
+    """
+    rows = [(host, disk, result) for host, disks in results.items() if not isinstance(disks, Exception) for disk, result in disks]
+    show_all = len(rows) <= MAX_TABLE_DEVICES
+    print(f"{'host':<24} {'disk':<10} {'model':<24} {'size GB':>8} {'seq MB/s':>9} {'4k IOPS':>8} {'p50 us':>7} {'p99 us':>7}"
+          f" {'wr MB/s':>8} {'wr IOPS':>8}  flag")
+    for host, disk, result in rows:
+        if not show_all and (host, disk.name) not in flagged:
+            continue
+        mark = '*' if (host, disk.name) in flagged else ''
+        if 'error' in result:
+            print(f"{host[:24]:<24} {disk.name:<10} {disk.model[:24]:<24} {disk.size / 1e9:>8.0f} {'fail':>9}  {mark}")
+            continue
+        rand = result['rand_read']
+        write = (f"{result['seq_write']['mb_per_second']:>8.0f} {result['rand_write']['iops']:>8}" if 'seq_write' in result
+                 else f"{'-':>8} {'-':>8}")
+        print(f"{host[:24]:<24} {disk.name:<10} {disk.model[:24]:<24} {disk.size / 1e9:>8.0f} {result['seq_read']['mb_per_second']:>9.0f}"
+              f" {rand['iops']:>8} {rand['lat_us']['p50']:>7.0f} {rand['lat_us']['p99']:>7.0f} {write}  {mark}")
+
+    print(f"{'model':<24} {'drives':>6} {'seq MB/s':>9} {'4k IOPS':>8} {'p99 us':>7}")
+    for model, median in sorted(medians.items()):
+        count = sum(1 for host, disk, result in rows if disk.model == model and 'error' not in result)
+        print(f"{model[:24]:<24} {count:>6} {median.get('seq_read', 0):>9.0f} {median.get('rand_read', 0):>8.0f} {median.get('rand_read_p99', 0):>7.0f}")
+
+    for (host, name), reasons in flagged.items():
+        print(f"Outlier {name} on host '{host}': {', '.join(reasons)}")
+    if not flagged:
+        print(f'No outliers in {len(rows)} tested drives')
+
+
+def add_arguments(parser):
+    """
+    Adds the benchmark options.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('-s', '--seconds', type=float, default=5, help='The number of seconds of every test on every drive')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='The number of parallel jobs of every test, the queue depth of the random tests')
+    parser.add_argument('-d', '--parallel-devices', type=int, default=0, help='The maximum number of drives tested at the same time on a host, 0 for all of them')
+    parser.add_argument('--write', action='store_true', help='Also run the write tests, this destroys the data on every drive that is not in use')
+    parser.add_argument('--slow-fraction', type=float, default=0.7, help="Drives below this fraction of their model's median are outliers")
+    parser.add_argument('--loopback', type=int, default=0, help='Test files of this many simulated hosts on this machine instead of the hosts file')
+    parser.add_argument('--loopback-devices', type=int, default=2, help='The number of files per simulated host')
+    parser.add_argument('--loopback-size', type=int, default=256, help='The size of every file in MiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the throughput, IOPS and latency of every drive before it becomes an OSD')
+    parser.add_argument('-hf', '--hosts_file', help='The file containing the hosts to benchmark')
+    parser.add_argument('-u', '--user', help='The SSH username to use for connecting to the hosts')
+    parser.add_argument('-p', '--password', help='The SSH password to use for connecting to the hosts')
+    add_arguments(parser)
+    fanout.add_arguments(parser)
+    timing.add_arguments(parser)
+    args = parser.parse_args()
+    if not args.loopback and not (args.hosts_file and args.user and args.password):
+        parser.error('-hf/--hosts_file, -u/--user and -p/--password are required without --loopback')
+    timing.start(args)
+    fanout.engine.configure(args.max_workers, args.timeout)
+
+    if args.loopback:
+        results = bench_loopback([f'loop{n}' for n in range(args.loopback)], args)
+    else:
+        ssh_pool.pool.configure(args.user, args.password, args.timeout)
+        with open(args.hosts_file, 'r') as file:
+            hosts = file.read().splitlines()
+        mode = 'read and write' if args.write else 'read-only'
+        print(f'Benchmarking the drives of {len(hosts)} hosts, {args.seconds} seconds per test ({mode})')
+        results = fanout.engine.run(bench_disks_on_remote_host, hosts, args.user, args.password, args, step='bench_disks')
+
+    medians, flagged = find_outliers(results, args.slow_fraction)
+    print_report(results, medians, flagged)
+
+    timing.finish(args)
+    fanout.engine.shutdown()
+    ssh_pool.pool.close_all()
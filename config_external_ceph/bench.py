@@ -0,0 +1,123 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import known_hosts
+from fake_fleet import FakeFleet
+
+SCRIPTS = {
+    'prepare_hosts': ['1_prepare_hosts.py', '--fresh', '--reboot-timeout', '60'],
+    'setup_net': ['2_setup_net.py', '--fresh', '--inventory-ttl', '0', '--ready-timeout', '60'],
+    'setup_ceph': ['3_setup_ceph.py'],
+    'clean_disks': ['4_clean_disks.py'],
+    'bench_disks': ['5_bench_disks.py', '--seconds', '1'],
+}
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_script(name, hosts_file, work_dir, max_workers, timeout):
+    """
+    Runs one of the config_external_ceph scripts against the fake hosts and measures it.
+
+    Parameters:
+    name (str): The key of the script in SCRIPTS.
+    hosts_file (str): The hosts file listing the fake hosts.
+    work_dir (str): The directory for the output, logs, state and inventory cache of the run.
+    max_workers (int): The fan-out concurrency cap passed to the script.
+    timeout (float): The number of seconds the script may run before it is killed.
+
+    Returns:
+    dict: The exit status, wall time, user and system CPU seconds and peak RSS in MiB of the script.
+    """
+    script, *extra = SCRIPTS[name]
+    command = [sys.executable, os.path.join(SCRIPT_DIR, script), '-hf', hosts_file, '-u', 'root', '-p', 'password',
+               '-w', str(max_workers), *extra]
+    if script not in ('4_clean_disks.py', '5_bench_disks.py'):
+        command += ['-q', '-l', os.path.join(work_dir, 'logs')]
+    if '--fresh' in extra:
+        command += ['-s', os.path.join(work_dir, f'{name}.state')]
+    if script == '3_setup_ceph.py':
+        command += ['--osd-spec', os.path.join(work_dir, 'osd_spec.yml')]
+    command += ['--trace', os.path.join(work_dir, f'{name}.trace.json')]
+
+    # A private HOME keeps the inventory cache and known_hosts of the run away from the real ones
+    env = dict(os.environ, HOME=work_dir)
+    with open(os.path.join(work_dir, f'{name}.out'), 'w') as output:
+        start = time.monotonic()
+        process = subprocess.Popen(command, cwd=SCRIPT_DIR, env=env, stdout=output, stderr=subprocess.STDOUT)
+        deadline = start + timeout
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                process.kill()
+            time.sleep(0.05)
+        wall = time.monotonic() - start
+
+    return {'exit': os.waitstatus_to_exitcode(status),
+            'wall': wall,
+            'user': usage.ru_utime,
+            'system': usage.ru_stime,
+            # ru_maxrss is in KiB on Linux
+            'rss': usage.ru_maxrss / 1024}
+
+
+def print_report(results):
+    """
+    Prints the measurements of every script at every fleet size as a table.
+
+    Parameters:
+    results (list): (hosts, script, measurements) tuples.
+
+    Returns:
+    None
+    """
+    print(f"{'hosts':>6} {'script':<14} {'exit':>4} {'wall s':>8} {'user s':>8} {'sys s':>8} {'ms/host':>8} {'peak MiB':>9}")
+    for hosts, name, result in results:
+        print(f"{hosts:>6} {name:<14} {result['exit']:>4} {result['wall']:>8.2f} {result['user']:>8.2f} {result['system']:>8.2f} "
+              f"{1000 * result['wall'] / hosts:>8.1f} {result['rss']:>9.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the config_external_ceph scripts against a fleet of simulated SSH hosts on localhost')
+    parser.add_argument('-n', '--hosts', default='10,100', help='Comma separated fleet sizes to run, e.g. 10,100,1000')
+    parser.add_argument('-s', '--scripts', default=','.join(SCRIPTS), help=f'Comma separated scripts to run, out of {", ".join(SCRIPTS)}')
+    parser.add_argument('--latency', type=float, default=0.01, help='The number of seconds every simulated command takes')
+    parser.add_argument('--jitter', type=float, default=0.5, help='The random variation of the latency, as a fraction of it')
+    parser.add_argument('--output-lines', type=int, default=50, help='The number of output lines of every simulated dnf command')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='The fraction of simulated commands that fail')
+    parser.add_argument('--disks', type=int, default=4, help='The number of disks of every simulated host')
+    parser.add_argument('--seed', type=int, default=None, help='The random seed of the latency and failures, for repeatable runs')
+    parser.add_argument('-w', '--max-workers', type=int, default=64, help='The fan-out concurrency cap passed to the scripts')
+    parser.add_argument('--script-timeout', type=float, default=1800, help='The number of seconds a script may run before it is killed')
+    parser.add_argument('-k', '--keep', action='store_true', help='Keep the output, logs and traces of the runs')
+    args = parser.parse_args()
+
+    results = []
+    for count in [int(size) for size in args.hosts.split(',')]:
+        work_dir = tempfile.mkdtemp(prefix=f'bench.{count}.')
+        with FakeFleet(count, latency=args.latency, jitter=args.jitter, output_lines=args.output_lines,
+                       failure_rate=args.failure_rate, disks=args.disks, seed=args.seed) as fleet:
+            hosts_file = os.path.join(work_dir, 'hosts')
+            with open(hosts_file, 'w') as f:
+                f.write('\n'.join(fleet.hosts) + '\n')
+            # The scripts only connect to hosts whose keys are in known_hosts
+            known_hosts.update_known_hosts(fleet.hosts, os.path.join(work_dir, '.ssh', 'known_hosts'))
+            # and install the local key of the private HOME
+            with open(os.path.join(work_dir, '.ssh', 'id_rsa.pub'), 'w') as f:
+                f.write(f'ssh-rsa {fleet.key.get_base64()} bench\n')
+
+            for name in args.scripts.split(','):
+                print(f'Running {name} against {count} hosts', flush=True)
+                results.append((count, name, run_script(name, hosts_file, work_dir, args.max_workers, args.script_timeout)))
+
+        if args.keep:
+            print(f'Output, logs and traces of {count} hosts kept in {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(results)
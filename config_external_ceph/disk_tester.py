@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+A self-contained drive tester, copied to the hosts by 5_bench_disks.py. It only uses
+the standard library and runs with the platform Python of any host.
+
+    disk_tester.py --seconds 5 --jobs 4 --parallel 0 /dev/nvme0n1 /dev/nvme1n1
+
+Every device gets a sequential throughput test in 1 MiB blocks and a random 4 KiB
+IOPS and latency test, both with O_DIRECT so the page cache is not measured. The
+tests only read unless --write is given, which overwrites the devices. Every device
+runs in its own process, at most --parallel devices at the same time, and prints
+one JSON line when it is done.
+"""
+import argparse
+import concurrent.futures
+import json
+import mmap
+import os
+import random
+import sys
+import threading
+import time
+
+SEQUENTIAL_BLOCK = 1024 * 1024
+RANDOM_BLOCK = 4096
+
+
+def percentile(values, fraction):
+    """
+    Returns a percentile of sorted values, by the nearest rank.
+
+    Parameters:
+    values (list): The sorted values.
+    fraction (float): The percentile as a fraction, e.g. 0.99.
+
+    Returns:
+    float: The value, 0 when there are no values.
+    """
+    if not values:
+        return 0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def in_use(path):
+    """
+    Tells why a block device must not be written to: a mounted partition, a swap
+    area or a holder such as LVM or md. Regular files are never in use.
+
+    Parameters:
+    path (str): The device, e.g. /dev/nvme0n1.
+
+    Returns:
+    str: The reason, None if the device is free.
+    """
+    name = os.path.basename(os.path.realpath(path))
+    if not os.path.exists(f'/sys/class/block/{name}'):
+        return None
+    for table in ('/proc/mounts', '/proc/swaps'):
+        with open(table) as f:
+            for line in f:
+                device = line.split()[0]
+                base = os.path.basename(os.path.realpath(device))
+                # The device itself or one of its partitions, sda1 or nvme0n1p1
+                if device.startswith('/dev/') and base.startswith(name) and base[len(name):].lstrip('p').isdigit() | (base == name):
+                    return f'{device} is in {table}'
+    holders = os.listdir(f'/sys/class/block/{name}/holders')
+    for partition in os.listdir(f'/sys/class/block/{name}'):
+        if partition.startswith(name):
+            holders += os.listdir(f'/sys/class/block/{name}/{partition}/holders')
+    if holders:
+        return f"held by {', '.join(sorted(holders))}"
+    return None
+
+
+def open_device(path, write):
+    """
+    Opens a device or file with O_DIRECT, or without it where the file system does
+    not support it (e.g. tmpfs in loopback mode).
+
+    Parameters:
+    path (str): The device or file.
+    write (bool): Open for writing as well.
+
+    Returns:
+    tuple: The file descriptor and whether it bypasses the page cache.
+    """
+    flags = os.O_RDWR if write else os.O_RDONLY
+    try:
+        return os.open(path, flags | os.O_DIRECT), True
+    except OSError as e:
+        if e.errno != 22:
+            raise
+        return os.open(path, flags), False
+
+
+def _run_jobs(jobs, job):
+    results = [None] * jobs
+    errors = []
+
+    def run(index):
+        try:
+            results[index] = job(index)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def sequential(path, size, seconds, jobs, write):
+    """
+    Reads or writes the device in 1 MiB blocks, every job through its own slice, for
+    a fixed time.
+
+    Parameters:
+    path (str): The device or file.
+    size (int): The size of the device.
+    seconds (float): The number of seconds to run for.
+    jobs (int): The number of parallel streams.
+    write (bool): Write instead of read.
+
+    Returns:
+    dict: The MB/s and whether the page cache was bypassed.
+    """
+    slice_size = size // jobs // SEQUENTIAL_BLOCK * SEQUENTIAL_BLOCK
+    deadline = time.monotonic() + seconds
+
+    def job(index):
+        fd, direct = open_device(path, write)
+        buffer = mmap.mmap(-1, SEQUENTIAL_BLOCK)
+        buffer.write(b'\xa5' * SEQUENTIAL_BLOCK)
+        start, done = index * slice_size, 0
+        try:
+            while time.monotonic() < deadline:
+                os.lseek(fd, start + done % slice_size, os.SEEK_SET)
+                done += os.writev(fd, [buffer]) if write else os.readv(fd, [buffer])
+            if write:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        return done, direct
+
+    start = time.monotonic()
+    results = _run_jobs(jobs, job)
+    elapsed = time.monotonic() - start
+    return {'mb_per_second': round(sum(done for done, direct in results) / elapsed / 1e6, 1),
+            'direct': all(direct for done, direct in results)}
+
+
+def random_4k(path, size, seconds, jobs, write):
+    """
+    Reads or writes 4 KiB blocks at random offsets for a fixed time, one outstanding
+    request per job, and times every request.
+
+    Parameters:
+    path (str): The device or file.
+    size (int): The size of the device.
+    seconds (float): The number of seconds to run for.
+    jobs (int): The number of parallel jobs, i.e. the queue depth.
+    write (bool): Write instead of read.
+
+    Returns:
+    dict: The IOPS, the latency percentiles in microseconds and whether the page cache was bypassed.
+    """
+    blocks = size // RANDOM_BLOCK
+    deadline = time.monotonic() + seconds
+
+    def job(index):
+        fd, direct = open_device(path, write)
+        buffer = mmap.mmap(-1, RANDOM_BLOCK)
+        buffer.write(b'\x5a' * RANDOM_BLOCK)
+        generator = random.Random(index)
+        latencies = []
+        try:
+            while time.monotonic() < deadline:
+                os.lseek(fd, generator.randrange(blocks) * RANDOM_BLOCK, os.SEEK_SET)
+                started = time.perf_counter()
+                if write:
+                    os.writev(fd, [buffer])
+                else:
+                    os.readv(fd, [buffer])
+                latencies.append((time.perf_counter() - started) * 1e6)
+        finally:
+            os.close(fd)
+        return latencies, direct
+
+    start = time.monotonic()
+    results = _run_jobs(jobs, job)
+    elapsed = time.monotonic() - start
+    latencies = sorted(latency for job_latencies, direct in results for latency in job_latencies)
+    return {'iops': int(len(latencies) / elapsed),
+            'lat_us': {name: round(percentile(latencies, fraction), 1)
+                       for name, fraction in (('p50', 0.5), ('p99', 0.99), ('max', 1.0))},
+            'direct': all(direct for job_latencies, direct in results)}
+
+
+def test_device(path, seconds, jobs, write):
+    """
+    Runs the sequential and random tests on one device, reads first, then writes.
+
+    Parameters:
+    path (str): The device or file.
+    seconds (float): The number of seconds of every test.
+    jobs (int): The number of parallel jobs of every test.
+    write (bool): Also run the write tests, destroying the data on the device.
+
+    Returns:
+    dict: The result, as printed.
+    """
+    result = {'device': path}
+    try:
+        if write:
+            reason = in_use(path)
+            if reason:
+                raise RuntimeError(f'not writing, {reason}')
+        fd, direct = open_device(path, False)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+        if size < SEQUENTIAL_BLOCK * jobs:
+            raise RuntimeError(f'{size} bytes is too small to test')
+        result['size'] = size
+        result['seq_read'] = sequential(path, size, seconds, jobs, False)
+        result['rand_read'] = random_4k(path, size, seconds, jobs, False)
+        if write:
+            result['seq_write'] = sequential(path, size, seconds, jobs, True)
+            result['rand_write'] = random_4k(path, size, seconds, jobs, True)
+    except (OSError, RuntimeError) as e:
+        result['error'] = str(e)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drive throughput, IOPS and latency tester')
+    parser.add_argument('devices', nargs='+', help='The devices or files to test')
+    parser.add_argument('--seconds', type=float, default=5, help='The number of seconds of every test')
+    parser.add_argument('--jobs', type=int, default=4, help='The number of parallel jobs per test and device')
+    parser.add_argument('--parallel', type=int, default=0, help='The number of devices tested at the same time, 0 for all of them')
+    parser.add_argument('--write', action='store_true', help='Also run write tests, this destroys the data on the devices')
+    args = parser.parse_args(argv)
+
+    # A process per device, so the devices do not share one interpreter lock
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.parallel or len(args.devices)) as executor:
+        futures = [executor.submit(test_device, device, args.seconds, args.jobs, args.write) for device in args.devices]
+        for future in concurrent.futures.as_completed(futures):
+            print(json.dumps(future.result()), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
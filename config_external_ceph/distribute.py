@@ -0,0 +1,329 @@
+import collections
+import hashlib
+import shlex
+import fanout
+import ssh_keys
+import ssh_pool
+from timing import tracer
+
+LocalFile = collections.namedtuple('LocalFile', ['source', 'destination', 'mode', 'data', 'sha256'])
+
+# Prints the hash, mode and path of every destination, '-' for files that do not
+# exist yet, and creates the missing directories on the way
+CHECK_SCRIPT = r"""
+# scale-tools: checksums
+for f in {destinations}; do
+    mkdir -p "$(dirname "$f")"
+    if [ -f "$f" ]; then
+        echo "$(sha256sum "$f" | cut -d' ' -f1) $(stat -c %a "$f") $f"
+    else
+        echo "- - $f"
+    fi
+done
+"""
+
+# The key a relay host authenticates to its children with
+RELAY_KEY_COMMAND = "test -f ~/.ssh/id_rsa.pub || ssh-keygen -q -t rsa -b 2048 -N '' -f ~/.ssh/id_rsa; cat ~/.ssh/id_rsa.pub"
+
+# Runs on a host that has the files and copies them to its children over its own
+# SSH connections, trusting only the host keys the bastion knows for them; each
+# child unpacks into a temporary directory and renames the files into place
+RELAY_SCRIPT = r"""
+# scale-tools: relay
+known=$(mktemp)
+trap 'rm -f "$known"' EXIT
+printf '%s\n' {known_hosts} > "$known"
+for child in {children}; do
+    name=${{child% *}}
+    port=${{child#* }}
+    if tar -C / -cf - {paths} | ssh -p "$port" -o BatchMode=yes -o StrictHostKeyChecking=yes -o UserKnownHostsFile="$known" \
+            -o GlobalKnownHostsFile=/dev/null -o ConnectTimeout=10 "$name" {receive}; then
+        echo "ok $child"
+    else
+        echo "failed $child"
+    fi
+done
+"""
+RECEIVE_SCRIPT = r"""
+set -e
+tmp=$(mktemp -d /var/tmp/distribute.XXXXXX)
+trap 'rm -rf "$tmp"' EXIT
+tar -C "$tmp" -xpf -
+for f in {paths}; do
+    mkdir -p "$(dirname "/$f")"
+    cp -p "$tmp/$f" "/$f.distribute.tmp"
+    mv -f "/$f.distribute.tmp" "/$f"
+done
+"""
+
+
+def load_files(files):
+    """
+    Reads the local files to distribute once, for every host.
+
+    Parameters:
+    files (list): (source, destination, mode) tuples, e.g. ('/etc/ceph/ceph.conf', '/etc/ceph/ceph.conf', 0o644).
+
+    Returns:
+    list: The LocalFile records with their content and SHA-256.
+    """
+    local_files = []
+    for source, destination, mode in files:
+        with open(source, 'rb') as f:
+            data = f.read()
+        local_files.append(LocalFile(source, destination, mode, data, hashlib.sha256(data).hexdigest()))
+    return local_files
+
+
+def from_data(destination, data, mode=0o644):
+    """
+    Builds the record of a file generated here rather than read from disk, e.g. a
+    per-host rendered configuration.
+
+    Parameters:
+    destination (str): The path of the file on the host.
+    data (bytes or str): The content of the file.
+    mode (int): The mode of the file on the host.
+
+    Returns:
+    LocalFile: The file record.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    return LocalFile(None, destination, mode, data, hashlib.sha256(data).hexdigest())
+
+
+def check_host(host, files):
+    """
+    Reads the hash and mode of the destination files on a host in one round trip.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    files (list): The LocalFile records.
+
+    Returns:
+    dict: The (sha256, mode) of every destination, None for the ones that do not exist.
+    """
+    script = CHECK_SCRIPT.format(destinations=' '.join(shlex.quote(f.destination) for f in files))
+    exit_status, output, error = ssh_pool.pool.exec_command(host, f'bash -c {shlex.quote(script)}')
+    remote = {}
+    for line in output.splitlines():
+        sha256, mode, destination = line.split(' ', 2)
+        remote[destination] = None if sha256 == '-' else (sha256, int(mode, 8))
+    return remote
+
+
+def _changes(files, remote):
+    changes = {}
+    for f in files:
+        current = remote.get(f.destination)
+        if current is None or current[0] != f.sha256:
+            changes[f.destination] = 'copied'
+        elif current[1] != f.mode:
+            changes[f.destination] = 'mode'
+        else:
+            changes[f.destination] = 'unchanged'
+    return changes
+
+
+def push_to_host(host, files, remote=None):
+    """
+    Sends the files that differ to a host over one SFTP session of the pooled
+    connection. Each file is written to a temporary name that gets its mode before
+    any data is written, then renamed into place, so readers never see a partial
+    file and a private file is never readable by others. Files whose content
+    matches only get their mode fixed, identical files are left alone.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    files (list): The LocalFile records.
+    remote (dict): The result of check_host, checked first if not given.
+
+    Returns:
+    dict: 'copied', 'mode' or 'unchanged' for every destination.
+    """
+    if remote is None:
+        remote = check_host(host, files)
+    changes = _changes(files, remote)
+    if all(change == 'unchanged' for change in changes.values()):
+        return changes
+
+    sftp = ssh_pool.pool.open_sftp(host)
+    try:
+        for f in files:
+            if changes[f.destination] == 'copied':
+                tmp_path = f'{f.destination}.distribute.tmp'
+                with tracer.span('transfer', host, file=f.destination, size=len(f.data)):
+                    try:
+                        with sftp.open(tmp_path, 'wb') as remote_file:
+                            remote_file.chmod(f.mode)
+                            remote_file.set_pipelined(True)
+                            remote_file.write(f.data)
+                        sftp.posix_rename(tmp_path, f.destination)
+                    except Exception:
+                        # No copy of the file may stay behind under the temporary name
+                        try:
+                            sftp.remove(tmp_path)
+                        except OSError:
+                            pass
+                        raise
+            elif changes[f.destination] == 'mode':
+                sftp.chmod(f.destination, f.mode)
+    finally:
+        sftp.close()
+    return changes
+
+
+def sync_host(host, files):
+    """
+    Checks a host and sends it the files that differ, for use as a per-host step.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    files (list): The LocalFile records.
+
+    Returns:
+    str: A summary of what changed on the host.
+    """
+    return summarize(push_to_host(host, files))
+
+
+def summarize(changes):
+    """
+    Describes the per-file results of a host in one line.
+
+    Parameters:
+    changes (dict): 'copied', 'mode' or 'unchanged' for every destination.
+
+    Returns:
+    str: The summary.
+    """
+    counts = collections.Counter(changes.values())
+    return ', '.join(f'{counts[change]} {change}' for change in ('copied', 'mode', 'unchanged') if counts[change])
+
+
+def _endpoint(host):
+    name, port = ssh_pool.split_host(host)
+    return f'{name} {port}'
+
+
+def _relay_key(host):
+    exit_status, public_key, error = ssh_pool.pool.exec_command(host, RELAY_KEY_COMMAND)
+    if exit_status != 0 or not public_key.strip():
+        raise RuntimeError(f'no SSH key on relay host {host}: {error.strip()}')
+    return public_key.strip()
+
+
+def _relay(parent, children, files):
+    paths = ' '.join(shlex.quote(f.destination.lstrip('/')) for f in files)
+    receive = RECEIVE_SCRIPT.format(paths=paths)
+    known_hosts = [line for child in children for line in ssh_pool.pool.known_host_lines(child)]
+    script = RELAY_SCRIPT.format(children=' '.join(shlex.quote(_endpoint(child)) for child in children), paths=paths,
+                                 known_hosts=' '.join(shlex.quote(line) for line in known_hosts),
+                                 receive=shlex.quote(f'bash -c {shlex.quote(receive)}'))
+    exit_status, output, error = ssh_pool.pool.exec_command(parent, f'bash -c {shlex.quote(script)}')
+    relayed = {line[len('ok '):] for line in output.splitlines() if line.startswith('ok ')}
+    return {child: _endpoint(child) in relayed for child in children}
+
+
+def distribute(hosts, files, relay=0):
+    """
+    Brings the files on all hosts up to date in parallel. Every host is checked
+    first and only hosts with changed files get data. With relay, the bastion only
+    sends to the first relay hosts and every updated host passes the files on to
+    relay more hosts over its own connections, level by level, so the bastion's
+    uplink carries the files relay times instead of once per host. A parent's key
+    is only authorized on its children while it relays to them, and it only trusts
+    the host keys the bastion knows. A host the relay could not reach, or that is
+    not in the bastion's known_hosts, gets the files from the bastion instead.
+
+    Parameters:
+    hosts (list): The hostnames or IP addresses of the hosts.
+    files (list): The LocalFile records.
+    relay (int): The number of hosts each host passes the files on to, 0 to send to every host from here.
+
+    Returns:
+    dict: For every host, the per-file results of push_to_host, or the exception of a failed host.
+    """
+    checked = fanout.engine.run(check_host, hosts, files, step='check_files')
+    results = {host: remote for host, remote in checked.items() if isinstance(remote, Exception)}
+    changes = {host: _changes(files, remote) for host, remote in checked.items() if host not in results}
+    needs = [host for host in hosts if host in changes and 'copied' in changes[host].values()]
+
+    # Hosts that only need a mode fixed, and every host when not relaying, are served directly
+    if relay <= 0 or len(needs) <= relay:
+        needs = []
+    direct = [host for host in changes if host not in needs]
+    for host, result in fanout.engine.run(lambda host: push_to_host(host, files, checked[host]), direct, step='push_files').items():
+        results[host] = result
+
+    def children_of(position):
+        return range(relay * (position + 1), min(relay * (position + 2), len(needs)))
+
+    level = list(range(min(relay, len(needs))))
+    for host, result in fanout.engine.run(lambda host: push_to_host(host, files, checked[host]), [needs[p] for p in level], step='push_files').items():
+        results[host] = result
+
+    while level:
+        relays = {}
+        fallback = []
+        next_level = []
+        for position in level:
+            children = [needs[child] for child in children_of(position)]
+            next_level.extend(children_of(position))
+            if not children:
+                continue
+            if isinstance(results[needs[position]], Exception):
+                fallback.extend(children)
+            else:
+                # A child the bastion has no host key for cannot be verified by its parent either
+                fallback.extend(child for child in children if not ssh_pool.pool.known_host_lines(child))
+                relays[needs[position]] = [child for child in children if ssh_pool.pool.known_host_lines(child)]
+
+        # Every parent authenticates to its children with its own key
+        keys = fanout.engine.run(_relay_key, [parent for parent in relays if relays[parent]], step='relay_files')
+        for parent, key in keys.items():
+            if isinstance(key, Exception):
+                fallback.extend(relays.pop(parent))
+        relays = {parent: children for parent, children in relays.items() if children}
+        pairs = {child: keys[parent] for parent, children in relays.items() for child in children}
+        authorized = fanout.engine.run(lambda child: ssh_keys.add_keys(child, [pairs[child]])[0], list(pairs), step='relay_files')
+        for parent, children in relays.items():
+            fallback.extend(child for child in children if isinstance(authorized[child], Exception))
+            relays[parent] = [child for child in children if not isinstance(authorized[child], Exception)]
+
+        try:
+            relayed = fanout.engine.run(lambda parent: _relay(parent, relays[parent], files), [parent for parent in relays if relays[parent]],
+                                        step='relay_files')
+        finally:
+            # The parents' keys were only needed for the relay, keys that were there before stay
+            added = [child for child, count in authorized.items() if not isinstance(count, Exception) and count]
+            removed = fanout.engine.run(lambda child: ssh_keys.remove_keys(child, [pairs[child]]), added, step='relay_files')
+            for child, outcome in removed.items():
+                if isinstance(outcome, Exception):
+                    print(f"Error removing the relay key from host '{child}': {str(outcome)}")
+        for parent, outcome in relayed.items():
+            for child in relays[parent]:
+                if not isinstance(outcome, Exception) and outcome.get(child):
+                    results[child] = changes[child]
+                else:
+                    fallback.append(child)
+
+        for host, result in fanout.engine.run(lambda host: push_to_host(host, files, checked[host]), fallback, step='push_files').items():
+            results[host] = result
+        level = next_level
+
+    return {host: results[host] for host in hosts}
+
+
+def add_arguments(parser):
+    """
+    Adds the file distribution options.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('--relay', type=int, default=0, help='Send the files to this many hosts and let every host pass them on to this many more, 0 to send them to every host directly')
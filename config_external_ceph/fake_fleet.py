@@ -0,0 +1,455 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import selectors
+import shlex
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+import paramiko
+
+# The '# scale-tools: <name>' comment every remote script of the tools carries
+MARKER = re.compile(r'# scale-tools: (\w+)')
+# Where the tools install their scripts on the hosts
+NIC_TUNING_PATH = '/usr/local/sbin/nic-tuning.sh'
+NET_TESTER_PATH = '/var/tmp/net_tester.py'
+DISK_TESTER_PATH = '/var/tmp/disk_tester.py'
+
+# Clients going away on a simulated reboot are expected, keep paramiko from reporting them
+logging.getLogger('fake_fleet.transport').addHandler(logging.NullHandler())
+
+
+class FakeHost:
+    """
+    The state of one simulated host: its boot ID, disks, NICs and files.
+    """
+
+    def __init__(self, index, root, disks, nics):
+        self.index = index
+        self.root = root
+        self.boot_id = str(uuid.uuid4())
+        self.disks = [f'nvme{n}n1' for n in range(disks)]
+        self.nics = [f'ens{n // 2 + 1}f{n % 2}' for n in range(nics)]
+        self.volume_groups = {disk: f'ceph-{uuid.uuid4()}' for disk in self.disks}
+        self.bond = False
+        self.authorized_keys = set()
+        self.ssh_key = False
+        self.transports = []
+        self.lock = threading.Lock()
+
+    def address(self, subnet):
+        return f'10.{subnet}.{self.index // 250}.{self.index % 250 + 1}'
+
+    def inventory(self):
+        # The system disk the host runs from, next to the NVMe drives for the OSDs
+        blockdevices = [{'name': 'sda', 'size': 480103981056, 'rota': False, 'model': 'FAKE SATA SSD',
+                         'serial': f'FAKE{self.index:05d}SYS'}]
+        blockdevices += [{'name': disk, 'size': 3840755982336, 'rota': False, 'model': 'FAKE NVME 3.84TB',
+                          'serial': f'FAKE{self.index:05d}{n:02d}'} for n, disk in enumerate(self.disks)]
+        links = [{'ifname': 'lo', 'address': '00:00:00:00:00:00', 'operstate': 'UNKNOWN',
+                  'addr_info': [{'family': 'inet', 'local': '127.0.0.1', 'prefixlen': 8}]}]
+        for n, nic in enumerate(self.nics):
+            link = {'ifname': nic, 'address': f'52:54:00:{self.index // 65536 % 256:02x}:{self.index // 256 % 256:02x}:{(self.index + n) % 256:02x}',
+                    'operstate': 'UP', 'addr_info': []}
+            if self.bond:
+                link['master'] = 'bond0'
+            elif n == 0:
+                link['addr_info'] = [{'family': 'inet', 'local': self.address(0), 'prefixlen': 16}]
+            links.append(link)
+        if self.bond:
+            links.append({'ifname': 'bond0', 'address': links[1]['address'], 'operstate': 'UP',
+                          'addr_info': [{'family': 'inet', 'local': self.address(1), 'prefixlen': 16}]})
+
+        lines = ['@@host@@', '64', '2', f'fake{self.index:05d}', '@@lsblk@@', json.dumps({'blockdevices': blockdevices}), '@@disks@@']
+        lines += ['sda 0 0'] + [f'{disk} {n % 2} 2199023255040' for n, disk in enumerate(self.disks)]
+        lines += ['@@mounts@@', 'sda /boot/efi /boot [SWAP] /'] + self.disks
+        lines += ['@@ip@@', json.dumps(links), '@@nics@@', 'lo -1 -1 1 1']
+        lines += [f'{nic} 25000 {n % 2} 16 16' for n, nic in enumerate(self.nics)]
+        if self.bond:
+            lines.append('bond0 50000 -1 16 16')
+        lines += ['@@vgs@@', json.dumps({'report': [{'vg': [{'vg_name': vg} for vg in self.volume_groups.values()]}]})]
+        lines += ['@@pvs@@', json.dumps({'report': [{'pv': [{'pv_name': f'/dev/{disk}', 'vg_name': vg}
+                                                            for disk, vg in self.volume_groups.items()]}]})]
+        return '\n'.join(lines) + '\n'
+
+    def reboot(self):
+        with self.lock:
+            self.boot_id = str(uuid.uuid4())
+            transports, self.transports = self.transports, []
+        for transport in transports:
+            transport.close()
+
+
+class FakeFleet:
+    """
+    Runs simulated SSH hosts inside the current process, each listening on its own
+    localhost port, for benchmarking the orchestration code without lab hardware.
+
+    Commands are not executed, they are answered from the simulated host state after
+    a configurable latency: lsblk/ip/vgs/pvs inventory, nmcli, dnf, disk teardown,
+    probes, reboot and boot IDs, and SFTP uploads into a per-host directory.
+    """
+
+    def __init__(self, count, latency=0.01, jitter=0.5, output_lines=50, failure_rate=0.0, disks=4, nics=2, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.output_lines = output_lines
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.root = tempfile.mkdtemp(prefix='fake_fleet.')
+        self.key = paramiko.RSAKey.generate(2048)
+        self.fake_hosts = {}
+        self._selector = selectors.DefaultSelector()
+        self._running = False
+        self._thread = None
+
+        for index in range(count):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(64)
+            listener.setblocking(False)
+            host_root = os.path.join(self.root, str(index))
+            os.makedirs(host_root)
+            fake_host = FakeHost(index, host_root, disks, nics)
+            self.fake_hosts[f'127.0.0.1:{listener.getsockname()[1]}'] = fake_host
+            self._selector.register(listener, selectors.EVENT_READ, fake_host)
+
+    @property
+    def hosts(self):
+        """
+        Returns the hosts file entries of the simulated hosts.
+
+        Returns:
+        list: One '127.0.0.1:port' entry per host.
+        """
+        return list(self.fake_hosts)
+
+    def start(self):
+        """
+        Starts accepting SSH connections.
+
+        Returns:
+        FakeFleet: The fleet itself.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._accept_loop, name='fake-fleet', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops accepting connections, closes every session and removes the host directories.
+
+        Returns:
+        None
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
+        for fake_host in self.fake_hosts.values():
+            fake_host.reboot()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept_loop(self):
+        while self._running:
+            for key, events in self._selector.select(timeout=0.2):
+                try:
+                    connection, peer = key.fileobj.accept()
+                except OSError:
+                    continue
+                connection.setblocking(True)
+                threading.Thread(target=self._serve, args=(connection, key.data), daemon=True).start()
+
+    def _serve(self, connection, fake_host):
+        transport = paramiko.Transport(connection)
+        transport.set_log_channel('fake_fleet.transport')
+        transport.add_server_key(self.key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _FakeSFTP, fake_host)
+        with fake_host.lock:
+            fake_host.transports.append(transport)
+        try:
+            transport.start_server(server=_FakeServer(self, fake_host))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def respond(self, fake_host, command):
+        """
+        Answers a command as the simulated host would. Scripts are told apart by their
+        '# scale-tools: <name>' marker, the @@section@@ headers of the inventory or the
+        path of an installed script, and other commands by the programs they run.
+
+        Parameters:
+        fake_host (FakeHost): The host the command runs on.
+        command (str): The command.
+
+        Returns:
+        tuple: The exit status, stdout and stderr.
+        """
+        self._delay()
+        if command.startswith('bash -c '):
+            command = shlex.split(command)[2]
+        markers = set(MARKER.findall(command))
+        programs = {part.split()[0] for part in re.split(r'[;&|\n()]+', command) if part.split()}
+
+        if '/proc/sys/kernel/random/boot_id' in command:
+            return 0, f'{fake_host.boot_id}\nrunning\n' if 'is-system-running' in command else f'{fake_host.boot_id}\n', ''
+        if command.startswith('cat /var/tmp/bond0-apply.status'):
+            return 0, 'applied\n' if fake_host.bond else 'running\n', ''
+        if 'bond_ready' in markers:
+            return (0 if fake_host.bond else 1), '', ''
+        if 'cat ~/.ssh/id_rsa.pub' in command:
+            return 0, f'ssh-rsa {self.key.get_base64()} root@fake{fake_host.index}\n', ''
+        # A fresh fake host never has the work of a step done
+        if 'probe' in markers:
+            return 1, '', ''
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            return 1, '', f'simulated failure of {command[:60]}\n'
+
+        if '@@host@@' in command:
+            return 0, fake_host.inventory(), ''
+        if 'teardown' in markers:
+            return 0, self._teardown(fake_host, command), ''
+        if command.split() in (['reboot'], ['sudo', 'reboot']):
+            threading.Timer(0.1, fake_host.reboot).start()
+            return 0, '', ''
+        if 'deploy_keys' in markers:
+            blobs = self._key_blobs(command)
+            added = len(blobs - fake_host.authorized_keys)
+            generated = int(bool(re.search(r'^generate=1$', command, re.M)) and not fake_host.ssh_key)
+            fake_host.authorized_keys |= blobs
+            fake_host.ssh_key = fake_host.ssh_key or bool(generated)
+            return 0, f'{added} {generated}\n', ''
+        if 'remove_keys' in markers:
+            blobs = self._key_blobs(command) & fake_host.authorized_keys
+            fake_host.authorized_keys -= blobs
+            return 0, f'{len(blobs)}\n', ''
+        if 'checksums' in markers:
+            return 0, self._checksums(fake_host, command), ''
+        if 'relay' in markers:
+            return 0, self._relay(fake_host, command), ''
+        if NIC_TUNING_PATH in command:
+            return 0, ''.join(f'nic {nic} node={n % 2} cores=16 irqs=16/16 channels=16 rings=4096/4096 rps=16 xps=16\n'
+                              for n, nic in enumerate(fake_host.nics)), ''
+        if f'{NET_TESTER_PATH} client' in command:
+            rtt = self.random.uniform(40, 60)
+            result = {'target': shlex.split(command)[shlex.split(command).index('--target') + 1], 'bytes': 6250000000, 'seconds': 2.0,
+                      'bits_per_second': int(self.random.uniform(22e9, 24e9)),
+                      'rtt_us': {'p50': rtt, 'p90': rtt * 1.3, 'p99': rtt * 2, 'max': rtt * 4}}
+            return 0, json.dumps(result) + '\n', ''
+        if DISK_TESTER_PATH in command:
+            lines = []
+            for device in (word for word in shlex.split(command) if word.startswith('/dev/')):
+                latency = self.random.uniform(80, 100)
+                result = {'device': device, 'size': 3840755982336,
+                          'seq_read': {'mb_per_second': round(self.random.uniform(3000, 3300), 1), 'direct': True},
+                          'rand_read': {'iops': int(4 * 1e6 / latency), 'lat_us': {'p50': latency, 'p99': latency * 2, 'max': latency * 5},
+                                        'direct': True}}
+                lines.append(json.dumps(result))
+            return 0, ''.join(f'{line}\n' for line in lines), ''
+        if command.startswith('sysctl '):
+            return 0, self._sysctls(fake_host, shlex.split(command)[1:]), ''
+        if command.startswith('mkdir -p '):
+            for path in command.split()[2:]:
+                os.makedirs(os.path.join(fake_host.root, path.lstrip('/')), exist_ok=True)
+            return 0, '', ''
+        if 'bond_apply' in markers:
+            fake_host.bond = True
+            return 0, '', ''
+        if 'dnf' in programs:
+            lines = [f'  Installing : fake-package-{n}-1.0-1.el8.x86_64    {n + 1}/{self.output_lines}' for n in range(self.output_lines)]
+            return 0, '\n'.join(lines + ['Complete!']) + '\n', ''
+        if 'nmcli' in programs:
+            return 0, 'Connection successfully added.\n', ''
+        return 0, '', ''
+
+    def _key_blobs(self, command):
+        match = re.search(r'for key in (.*?); do', command)
+        keys = shlex.split(match.group(1)) if match else []
+        return {key.split()[1] for key in keys if len(key.split()) > 1}
+
+    def _checksums(self, fake_host, command):
+        match = re.search(r'for f in (.*?); do', command)
+        lines = []
+        for destination in shlex.split(match.group(1)) if match else []:
+            path = os.path.join(fake_host.root, destination.lstrip('/'))
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                lines.append(f'{digest} {os.stat(path).st_mode & 0o777:o} {destination}')
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                lines.append(f'- - {destination}')
+        return ''.join(f'{line}\n' for line in lines)
+
+    def _sysctls(self, fake_host, names):
+        # The simulated kernel runs with the values of the installed tuned profile
+        values = {}
+        try:
+            with open(os.path.join(fake_host.root, 'etc/tuned/rhcs/tuned.conf')) as f:
+                section = None
+                for line in f:
+                    if line.startswith('['):
+                        section = line.strip()
+                    elif section == '[sysctl]' and '=' in line and not line.startswith('#'):
+                        name, value = (field.strip() for field in line.split('=', 1))
+                        values[name] = ' '.join(value.split())
+        except FileNotFoundError:
+            pass
+        return ''.join(f'{name} = {values[name]}\n' for name in names if name in values)
+
+    def _relay(self, fake_host, command):
+        children = re.search(r'for child in (.*?); do', command)
+        paths = re.search(r'tar -C / -cf - (.*?) \|', command)
+        output = []
+        for child in shlex.split(children.group(1)) if children else []:
+            name, port = child.split()
+            target = self.fake_hosts.get(f'{name}:{port}')
+            if target is None:
+                output.append(f'failed {child}')
+                continue
+            for path in shlex.split(paths.group(1)) if paths else []:
+                os.makedirs(os.path.dirname(os.path.join(target.root, path)), exist_ok=True)
+                shutil.copy2(os.path.join(fake_host.root, path), os.path.join(target.root, path))
+            output.append(f'ok {child}')
+        return ''.join(f'{line}\n' for line in output)
+
+    def _teardown(self, fake_host, command):
+        lines = []
+        for kind, message in (('lvm', b'Logical volume removed'), ('pv', b'Labels on physical volume wiped.'),
+                              ('disk', b'GPT data structures destroyed!')):
+            match = re.search(rf'for {kind} in ([^;]*); do', command)
+            encoded = base64.b64encode(message).decode()
+            lines += [f"{kind}\t{name}\t0\t{'zap' if kind == 'disk' else '-'}\t{encoded}"
+                      for name in (shlex.split(match.group(1)) if match else [])]
+        fake_host.volume_groups = {}
+        return ''.join(f'{line}\n' for line in lines)
+
+
+class _FakeServer(paramiko.ServerInterface):
+    def __init__(self, fleet, fake_host):
+        self.fleet = fleet
+        self.fake_host = fake_host
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            try:
+                exit_status, output, error = self.fleet.respond(self.fake_host, command.decode(errors='replace'))
+                channel.sendall(output.encode())
+                channel.sendall_stderr(error.encode())
+                channel.send_exit_status(exit_status)
+                channel.shutdown_write()
+            except (OSError, EOFError, paramiko.SSHException):
+                pass
+            # The reply to the exec request is sent after this method returns, closing
+            # right away could overtake it and fail the command on the client
+            threading.Timer(1, channel.close).start()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+
+class _FakeHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        if attr.st_mode is not None:
+            os.fchmod(self.readfile.fileno(), attr.st_mode & 0o7777)
+        return paramiko.SFTP_OK
+
+
+class _FakeSFTP(paramiko.SFTPServerInterface):
+    """
+    SFTP into the simulated host's directory, remote absolute paths map below it.
+    """
+
+    def __init__(self, server, fake_host, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.fake_host = fake_host
+
+    def _path(self, path):
+        return os.path.join(self.fake_host.root, os.path.normpath('/' + path).lstrip('/'))
+
+    def _status(self, action, *args):
+        try:
+            action(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        mode = 'rb' if not flags & (os.O_WRONLY | os.O_RDWR) else ('ab' if flags & os.O_APPEND else 'r+b' if flags & os.O_RDWR else 'wb')
+        handle = _FakeHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        try:
+            path = self._path(path)
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name) for name in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        return self._status(os.remove, self._path(path))
+
+    def rename(self, oldpath, newpath):
+        return self._status(os.replace, self._path(oldpath), self._path(newpath))
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        return self._status(os.makedirs, self._path(path), 0o755, True)
+
+    def rmdir(self, path):
+        return self._status(os.rmdir, self._path(path))
+
+    def chattr(self, path, attr):
+        if attr.st_mode is not None:
+            return self._status(os.chmod, self._path(path), attr.st_mode & 0o7777)
+        return paramiko.SFTP_OK
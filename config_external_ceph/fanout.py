@@ -0,0 +1,122 @@
+import concurrent.futures
+import contextlib
+import threading
+import time
+import ssh_pool
+from timing import tracer
+
+DEFAULT_MAX_WORKERS = 64
+
+
+class FanOut:
+    """
+    Runs a per-host function across the fleet on one shared, bounded set of
+    worker threads, instead of forking a process per host for every stage.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, timeout=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = None
+
+    def configure(self, max_workers, timeout=None):
+        """
+        Sets the concurrency cap and the per-host timeout for the run.
+
+        Parameters:
+        max_workers (int): The maximum number of hosts worked on at the same time.
+        timeout (float): Seconds the call of a single host may take in every run, None for no limit.
+
+        Returns:
+        None
+        """
+        self.shutdown()
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                   thread_name_prefix='fanout')
+        return self._executor
+
+    def run(self, func, hosts, *args, step=None):
+        """
+        Calls func(host, *args) for every host and waits for all of them.
+
+        A host's timeout starts when its call starts, not when it is queued. A host
+        that fails or times out gets the exception as its result, so one bad host
+        never stops the others. The SSH transport of a host that times out is
+        closed, so its call fails instead of holding a worker thread for good.
+
+        Parameters:
+        func (callable): The function to run, called with the host as first argument.
+        hosts (list): The hostnames or IP addresses to run on.
+        *args: Extra arguments passed to func after the host.
+        step (str): Optional step name the calls are timed and traced under.
+
+        Returns:
+        dict: The result (or exception) for each host, in the order of hosts.
+        """
+        executor = self._get_executor()
+        started = {}
+
+        def task(host):
+            started[host] = time.monotonic()
+            with tracer.step(step, host) if step else contextlib.nullcontext():
+                return func(host, *args)
+
+        futures = {executor.submit(task, host): host for host in hosts}
+        results = {}
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=1 if self.timeout else None,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                host = futures[future]
+                try:
+                    results[host] = future.result()
+                except Exception as e:
+                    results[host] = e
+
+            if self.timeout:
+                now = time.monotonic()
+                for future in list(pending):
+                    host = futures[future]
+                    if host in started and now - started[host] > self.timeout:
+                        pending.discard(future)
+                        results[host] = TimeoutError(f"no result after {self.timeout} seconds")
+                        # Not cancellable once started, closing the transport aborts the blocked
+                        # read; in a thread, the call may hold the host lock while it connects
+                        threading.Thread(target=ssh_pool.pool.drop, args=(host,), daemon=True).start()
+
+        return {host: results[host] for host in hosts}
+
+    def shutdown(self):
+        """
+        Stops the worker threads once their current calls are done.
+
+        Returns:
+        None
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+# Fan-out shared by every stage of the config_external_ceph scripts
+engine = FanOut()
+
+
+def add_arguments(parser):
+    """
+    Adds the fan-out options shared by the config_external_ceph scripts.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('-w', '--max-workers', type=int, default=DEFAULT_MAX_WORKERS, help='The maximum number of hosts to work on at the same time')
+    parser.add_argument('-t', '--timeout', type=float, default=None, help='The number of seconds the call of a single host may take in every stage, its SSH connection is closed when it runs over')
@@ -0,0 +1,367 @@
+import collections
+import json
+import os
+import re
+import shlex
+import threading
+import time
+import ssh_pool
+
+DEFAULT_TTL = 600
+CACHE_DIR = os.path.expanduser('~/.cache/scale-tools/inventory')
+
+Disk = collections.namedtuple('Disk', ['name', 'size', 'rotational', 'model', 'serial', 'numa_node', 'discard', 'mountpoints'])
+Interface = collections.namedtuple('Interface', ['name', 'mac', 'operstate', 'master', 'addresses', 'speed', 'numa_node', 'rx_queues', 'tx_queues'])
+PhysicalVolume = collections.namedtuple('PhysicalVolume', ['name', 'vg_name'])
+HostInventory = collections.namedtuple('HostInventory', ['host', 'collected_at', 'hostname', 'cpus', 'numa_nodes', 'disks', 'interfaces', 'volume_groups', 'physical_volumes'])
+
+# Every fact in one round trip, each section starts with a marker line; the script
+# fails when one of the commands the disk and network facts come from fails
+COLLECT_SCRIPT = r"""
+failed=
+echo '@@host@@'
+nproc
+ls -d /sys/devices/system/node/node* 2>/dev/null | wc -l
+hostname -s
+echo '@@lsblk@@'
+lsblk -J -b -d -I 8,259 -o NAME,SIZE,ROTA,MODEL,SERIAL || failed="$failed lsblk"
+echo '@@disks@@'
+for disk in /sys/block/*; do
+    name=${disk##*/}
+    numa=$(cat $disk/device/numa_node 2>/dev/null || cat $disk/device/device/numa_node 2>/dev/null || echo -1)
+    echo "$name $numa $(cat $disk/queue/discard_max_bytes 2>/dev/null || echo 0)"
+done
+echo '@@mounts@@'
+disks=$(lsblk -d -n -r -I 8,259 -o NAME) || failed="$failed lsblk"
+for disk in $disks; do
+    mounts=$(lsblk -n -r -o MOUNTPOINT "/dev/$disk") || failed="$failed lsblk:$disk"
+    echo "$disk" $mounts
+done
+echo '@@ip@@'
+ip -j addr show || failed="$failed ip"
+echo '@@nics@@'
+for nic in /sys/class/net/*; do
+    name=${nic##*/}
+    speed=$(cat $nic/speed 2>/dev/null || echo -1)
+    numa=$(cat $nic/device/numa_node 2>/dev/null || echo -1)
+    echo "$name $speed $numa $(ls -d $nic/queues/rx-* 2>/dev/null | wc -l) $(ls -d $nic/queues/tx-* 2>/dev/null | wc -l)"
+done
+echo '@@vgs@@'
+vgs --reportformat json -o vg_name || failed="$failed vgs"
+echo '@@pvs@@'
+pvs --reportformat json -o pv_name,vg_name || failed="$failed pvs"
+if [ -n "$failed" ]; then
+    echo "failed:$failed" >&2
+    exit 1
+fi
+"""
+# The sections every collection has, and the ones holding a JSON document
+SECTIONS = ('host', 'lsblk', 'disks', 'mounts', 'ip', 'nics', 'vgs', 'pvs')
+JSON_SECTIONS = ('lsblk', 'ip', 'vgs', 'pvs')
+
+
+def _split_sections(output):
+    sections = {}
+    name = None
+    for line in output.splitlines():
+        if line.startswith('@@') and line.endswith('@@'):
+            name = line.strip('@')
+            sections[name] = []
+        elif name is not None:
+            sections[name].append(line)
+    return {name: '\n'.join(lines) for name, lines in sections.items()}
+
+
+def _load_json(text, default):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return default
+
+
+def _int(value, default=-1):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def check_output(output):
+    """
+    Checks that the output of the collect script is complete: every section is
+    there and the JSON sections parse, so a partial collection is never taken for
+    a host without disks, NICs or LVM.
+
+    Parameters:
+    output (str): The output of COLLECT_SCRIPT.
+
+    Returns:
+    None
+    """
+    sections = _split_sections(output)
+    missing = [name for name in SECTIONS if name not in sections]
+    if missing:
+        raise ValueError(f"incomplete inventory, missing {', '.join(missing)}")
+    broken = [name for name in JSON_SECTIONS if _load_json(sections[name], None) is None]
+    if broken:
+        raise ValueError(f"unreadable inventory, no JSON in {', '.join(broken)}")
+
+
+def parse_inventory(host, output, collected_at=None):
+    """
+    Parses the output of the collect script into typed records.
+
+    Parameters:
+    host (str): The hostname or IP address the output was collected from.
+    output (str): The output of COLLECT_SCRIPT.
+    collected_at (float): The collection time, now if not given.
+
+    Returns:
+    HostInventory: The facts of the host.
+    """
+    sections = _split_sections(output)
+
+    host_facts = sections.get('host', '').split()
+    cpus = _int(host_facts[0] if host_facts else None, 0)
+    numa_nodes = max(_int(host_facts[1] if len(host_facts) > 1 else None, 0), 1)
+    hostname = host_facts[2] if len(host_facts) > 2 else ''
+
+    disk_facts = {}
+    for line in sections.get('disks', '').splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            disk_facts[fields[0]] = (_int(fields[1]), _int(fields[2], 0) > 0)
+
+    # The file systems and swap on a disk, its partitions and the volumes on them
+    mounts = {}
+    for line in sections.get('mounts', '').splitlines():
+        fields = line.split()
+        if fields:
+            mounts[fields[0]] = fields[1:]
+
+    disks = []
+    for device in _load_json(sections.get('lsblk', ''), {}).get('blockdevices', []):
+        numa_node, discard = disk_facts.get(device['name'], (-1, False))
+        disks.append(Disk(name=device['name'],
+                          size=_int(device.get('size'), 0),
+                          rotational=str(device.get('rota')).lower() in ('1', 'true'),
+                          model=(device.get('model') or '').strip(),
+                          serial=(device.get('serial') or '').strip(),
+                          numa_node=numa_node,
+                          discard=discard,
+                          mountpoints=mounts.get(device['name'], [])))
+
+    nic_facts = {}
+    for line in sections.get('nics', '').splitlines():
+        fields = line.split()
+        if len(fields) == 5:
+            nic_facts[fields[0]] = [_int(field) for field in fields[1:]]
+
+    interfaces = []
+    for link in _load_json(sections.get('ip', ''), []):
+        speed, numa_node, rx_queues, tx_queues = nic_facts.get(link['ifname'], (-1, -1, 0, 0))
+        interfaces.append(Interface(name=link['ifname'],
+                                    mac=link.get('address', ''),
+                                    operstate=link.get('operstate', ''),
+                                    master=link.get('master', ''),
+                                    addresses=[f"{addr['local']}/{addr['prefixlen']}" for addr in link.get('addr_info', [])
+                                               if addr.get('family') == 'inet'],
+                                    speed=speed,
+                                    numa_node=numa_node,
+                                    rx_queues=rx_queues,
+                                    tx_queues=tx_queues))
+
+    volume_groups = []
+    for report in _load_json(sections.get('vgs', ''), {}).get('report', []):
+        volume_groups.extend(vg['vg_name'] for vg in report.get('vg', []))
+
+    physical_volumes = []
+    for report in _load_json(sections.get('pvs', ''), {}).get('report', []):
+        physical_volumes.extend(PhysicalVolume(pv['pv_name'], pv.get('vg_name', '')) for pv in report.get('pv', []))
+
+    return HostInventory(host=host,
+                         collected_at=collected_at if collected_at is not None else time.time(),
+                         hostname=hostname,
+                         cpus=cpus,
+                         numa_nodes=numa_nodes,
+                         disks=disks,
+                         interfaces=interfaces,
+                         volume_groups=volume_groups,
+                         physical_volumes=physical_volumes)
+
+
+def on_disk(disk, device):
+    """
+    Tells whether a device is a disk or one of its partitions, named like the kernel
+    does: sda1 for sda, nvme0n1p1 for nvme0n1, so sdaa1 is not on sda and nvme0n10
+    is not on nvme0n1.
+
+    Parameters:
+    disk (Disk): The disk.
+    device (str): The device path, e.g. the name of an LVM PV.
+
+    Returns:
+    bool: True if the device is the disk or one of its partitions.
+    """
+    partition = r'p\d+' if disk.name[-1:].isdigit() else r'\d+'
+    return re.fullmatch(rf'/dev/{re.escape(disk.name)}({partition})?', device) is not None
+
+
+def system_disks(facts):
+    """
+    Finds the disks the host itself uses: disks with a mounted file system or swap
+    on them, their partitions or their volumes, and disks carrying an LVM PV that
+    is not part of ceph. These are never OSD candidates and never wiped.
+
+    Parameters:
+    facts (HostInventory): The facts of the host.
+
+    Returns:
+    dict: The reason for every system disk, by disk name.
+    """
+    reasons = {}
+    for disk in facts.disks:
+        if disk.mountpoints:
+            reasons[disk.name] = f"mounted on {', '.join(disk.mountpoints)}"
+        else:
+            for pv in facts.physical_volumes:
+                if on_disk(disk, pv.name) and 'ceph' not in pv.vg_name:
+                    reasons[disk.name] = f"LVM PV of {pv.vg_name or 'no volume group'}"
+                    break
+    return reasons
+
+
+def _to_json(facts):
+    record = facts._asdict()
+    record['disks'] = [disk._asdict() for disk in facts.disks]
+    record['interfaces'] = [interface._asdict() for interface in facts.interfaces]
+    record['physical_volumes'] = [pv._asdict() for pv in facts.physical_volumes]
+    return record
+
+
+def _from_json(record):
+    record = dict(record)
+    record['disks'] = [Disk(**disk) for disk in record['disks']]
+    record['interfaces'] = [Interface(**interface) for interface in record['interfaces']]
+    record['physical_volumes'] = [PhysicalVolume(**pv) for pv in record['physical_volumes']]
+    return HostInventory(**record)
+
+
+class InventoryCache:
+    """
+    Collects the disk, network and LVM facts of a host in one round trip and keeps
+    them in memory and on disk, so every step of every script reads the same facts
+    instead of scraping its own command output over a new SSH call.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, ttl=DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._facts = {}
+        self._lock = threading.Lock()
+
+    def configure(self, ttl):
+        """
+        Sets how long collected facts stay valid.
+
+        Parameters:
+        ttl (float): The number of seconds facts are reused, 0 to always collect.
+
+        Returns:
+        None
+        """
+        self.ttl = ttl
+
+    def _path(self, host):
+        return os.path.join(self.cache_dir, f'{host}.json')
+
+    def _load(self, host):
+        try:
+            with open(self._path(host)) as f:
+                return _from_json(json.load(f))
+        except (OSError, ValueError, TypeError, KeyError):
+            return None
+
+    def _store(self, facts):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f'{self._path(facts.host)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(_to_json(facts), f)
+        os.replace(tmp_path, self._path(facts.host))
+
+    def get(self, host, max_age=None):
+        """
+        Returns the facts of a host, collecting them when the cached ones are too old.
+
+        Parameters:
+        host (str): The hostname or IP address of the remote host.
+        max_age (float): The maximum age in seconds of cached facts, the configured TTL if not given.
+
+        Returns:
+        HostInventory: The facts of the host.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            facts = self._facts.get(host)
+        if facts is None:
+            facts = self._load(host)
+        if facts is not None and time.time() - facts.collected_at <= max_age:
+            with self._lock:
+                self._facts[host] = facts
+            return facts
+        return self.collect(host)
+
+    def collect(self, host):
+        """
+        Collects the facts of a host in one round trip and caches them. A failed or
+        incomplete collection raises and is never cached.
+
+        Parameters:
+        host (str): The hostname or IP address of the remote host.
+
+        Returns:
+        HostInventory: The facts of the host.
+        """
+        exit_status, output, error = ssh_pool.pool.exec_command(host, f'bash -c {shlex.quote(COLLECT_SCRIPT)}')
+        if exit_status != 0:
+            raise RuntimeError(f'collecting the inventory exited with status {exit_status}: {error.strip()}')
+        check_output(output)
+        facts = parse_inventory(host, output)
+        with self._lock:
+            self._facts[host] = facts
+        self._store(facts)
+        return facts
+
+    def invalidate(self, host):
+        """
+        Forgets the facts of a host after a step changed them.
+
+        Parameters:
+        host (str): The hostname or IP address of the remote host.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._facts.pop(host, None)
+        try:
+            os.remove(self._path(host))
+        except OSError:
+            pass
+
+
+# Facts shared by every step of the config_external_ceph scripts
+cache = InventoryCache()
+
+
+def add_arguments(parser):
+    """
+    Adds the inventory options shared by the config_external_ceph scripts.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('--inventory-ttl', type=float, default=DEFAULT_TTL, help='The number of seconds collected host facts are reused, 0 to always collect them')
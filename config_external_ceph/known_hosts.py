@@ -0,0 +1,130 @@
+import os
+import socket
+import tempfile
+import fanout
+import paramiko
+import ssh_pool
+from timing import tracer
+
+DEFAULT_SCAN_TIMEOUT = 10
+
+
+def scan_host_key(host, timeout=DEFAULT_SCAN_TIMEOUT):
+    """
+    Fetches the host key a host presents, with a key exchange and no authentication.
+
+    Parameters:
+    host (str): The hostname or IP address of the host, optionally followed by ':port'.
+    timeout (float): The number of seconds to wait for the connection and the key exchange.
+
+    Returns:
+    paramiko.PKey: The host key, of the type the pooled clients negotiate.
+    """
+    address, port = ssh_pool.split_host(host)
+    with tracer.span('connect', host):
+        sock = socket.create_connection((address, port), timeout)
+    transport = paramiko.Transport(sock)
+    transport.banner_timeout = timeout
+    try:
+        with tracer.span('keyscan', host):
+            transport.start_client(timeout=timeout)
+        return transport.get_remote_server_key()
+    finally:
+        transport.close()
+
+
+def _names_host(line, name):
+    fields = line.split()
+    if len(fields) < 3 or line.startswith(('#', '@')):
+        return False
+    for pattern in fields[0].split(','):
+        if pattern.startswith('|1|'):
+            if paramiko.HostKeys.hash_host(name, pattern) == pattern:
+                return True
+        elif pattern == name:
+            return True
+    return False
+
+
+def _without_host(line, name):
+    patterns, rest = line.split(' ', 1)
+    others = [pattern for pattern in patterns.split(',') if not _names_host(f'{pattern} {rest}', name)]
+    return f"{','.join(others)} {rest}" if others else None
+
+
+def merge_host_keys(keys, path=ssh_pool.KNOWN_HOSTS):
+    """
+    Merges host keys into a known_hosts file, rewriting the file only when something
+    changed. A host that already has exactly this key is left alone, duplicate lines
+    of a host are dropped, and a host whose key changed (e.g. after a reinstall) loses
+    all its old lines. New lines are written with hashed hostnames.
+
+    Parameters:
+    keys (dict): The host key for each known_hosts name ('host' or '[host]:port').
+    path (str): The known_hosts file.
+
+    Returns:
+    dict: For each name, 'current', 'added' or 'replaced'.
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+
+    results = {}
+    changed = False
+    for name, key in keys.items():
+        matching = [index for index, line in enumerate(lines) if _names_host(line, name)]
+        same_type = [index for index in matching if lines[index].split()[1] == key.get_name()]
+        same = [index for index in same_type if lines[index].split()[2] == key.get_base64()]
+
+        if same and len(same) == len(same_type):
+            results[name] = 'current'
+            remove = same[1:]
+        else:
+            # A host with a new key was reinstalled, none of its old keys are valid
+            results[name] = 'replaced' if same_type else 'added'
+            remove = matching
+            lines.append(f'{paramiko.HostKeys.hash_host(name)} {key.get_name()} {key.get_base64()}')
+
+        for index in remove:
+            lines[index] = _without_host(lines[index], name)
+        lines = [line for line in lines if line is not None]
+        changed = changed or bool(remove) or results[name] != 'current'
+
+    if changed:
+        directory = os.path.dirname(path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.known_hosts.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join(f'{line}\n' for line in lines))
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    return results
+
+
+def update_known_hosts(hosts, path=ssh_pool.KNOWN_HOSTS, timeout=DEFAULT_SCAN_TIMEOUT):
+    """
+    Scans the host keys of all hosts concurrently and merges them into known_hosts
+    in one write.
+
+    Parameters:
+    hosts (list): The hostnames or IP addresses of the hosts, optionally followed by ':port'.
+    path (str): The known_hosts file.
+    timeout (float): The number of seconds a single host may take to present its key.
+
+    Returns:
+    dict: For each host, 'current', 'added' or 'replaced', or the exception of a failed scan.
+    """
+    scanned = fanout.engine.run(scan_host_key, hosts, timeout, step='keyscan')
+    keys = {ssh_pool.known_hosts_name(host): key for host, key in scanned.items() if not isinstance(key, Exception)}
+    merged = merge_host_keys(keys, path)
+    return {host: key if isinstance(key, Exception) else merged[ssh_pool.known_hosts_name(host)]
+            for host, key in scanned.items()}
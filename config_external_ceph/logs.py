@@ -0,0 +1,196 @@
+import collections
+import gzip
+import os
+import socket
+import threading
+import time
+
+CHUNK_SIZE = 32768
+# How much of the end of a command's output is kept in memory and returned
+TAIL_BYTES = 65536
+# Longer lines are cut so one line without a newline cannot grow without bound
+MAX_LINE_BYTES = 65536
+
+
+class _Lines:
+    """
+    Splits a byte stream into lines and keeps only the tail of it.
+    """
+
+    def __init__(self, emit, tail_bytes):
+        self.emit = emit
+        self.tail_bytes = tail_bytes
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.partial = b''
+
+    def feed(self, data):
+        self.partial += data
+        while b'\n' in self.partial or len(self.partial) > MAX_LINE_BYTES:
+            line, sep, rest = self.partial.partition(b'\n')
+            if not sep:
+                line, rest = self.partial[:MAX_LINE_BYTES], self.partial[MAX_LINE_BYTES:]
+            self.partial = rest
+            self._line(line)
+
+    def close(self):
+        if self.partial:
+            self._line(self.partial)
+            self.partial = b''
+
+    def _line(self, line):
+        text = line.decode(errors='replace')
+        self.emit(text)
+        self.tail.append(text)
+        self.tail_size += len(line) + 1
+        while self.tail_size > self.tail_bytes and len(self.tail) > 1:
+            self.tail_size -= len(self.tail.popleft().encode()) + 1
+
+    def text(self):
+        return ''.join(f'{line}\n' for line in self.tail)
+
+
+class HostLogs:
+    """
+    Streams the output of remote commands as it arrives: each line is printed live
+    with the host as prefix and written to a compressed log file per host, and only
+    the tail of the output is kept in memory, however chatty the command is.
+    """
+
+    def __init__(self, directory='logs', live=True, tail_bytes=TAIL_BYTES):
+        self.directory = directory
+        self.live = live
+        self.tail_bytes = tail_bytes
+        self._files = {}
+        self._lock = threading.Lock()
+        self._print_lock = threading.Lock()
+
+    def configure(self, directory, live=True):
+        """
+        Sets where the per-host logs are written and whether lines are printed live.
+
+        Parameters:
+        directory (str): The directory of the per-host log files.
+        live (bool): Print every output line as it arrives.
+
+        Returns:
+        None
+        """
+        self.close_all()
+        self.directory = directory
+        self.live = live
+
+    def _file(self, host):
+        with self._lock:
+            if host not in self._files:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f'{host}.log.gz')
+                self._files[host] = (gzip.open(path, 'ab'), threading.Lock())
+            return self._files[host]
+
+    def write(self, host, text):
+        """
+        Appends lines to the compressed log file of a host.
+
+        Parameters:
+        host (str): The hostname or IP address of the host.
+        text (str): The text to append.
+
+        Returns:
+        None
+        """
+        log_file, lock = self._file(host)
+        with lock:
+            log_file.write(text.encode())
+
+    def stream(self, host, command, channel, timeout=None):
+        """
+        Reads a running command's stdout and stderr until it exits.
+
+        Parameters:
+        host (str): The hostname or IP address of the host.
+        command (str): The command, for the log file.
+        channel (paramiko.Channel): The channel the command runs on.
+        timeout (float): Seconds the command may stay silent before it is given up on, None for no limit.
+
+        Returns:
+        tuple: The exit status and the tails of stdout and stderr.
+        """
+        tag = f'{threading.get_ident():x}'
+        self.write(host, f'### {time.strftime("%Y-%m-%d %H:%M:%S")} [{tag}] $ {command}\n')
+
+        def emitter(stream_name):
+            def emit(line):
+                self.write(host, f'[{tag}] {stream_name}| {line}\n')
+                if self.live:
+                    with self._print_lock:
+                        print(f'[{host}] {line}', flush=True)
+            return emit
+
+        stdout = _Lines(emitter('out'), self.tail_bytes)
+        stderr = _Lines(emitter('err'), self.tail_bytes)
+        last_data = time.monotonic()
+        idle = 0.01
+        while True:
+            received = False
+            while channel.recv_ready():
+                stdout.feed(channel.recv(CHUNK_SIZE))
+                received = True
+            while channel.recv_stderr_ready():
+                stderr.feed(channel.recv_stderr(CHUNK_SIZE))
+                received = True
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+
+            now = time.monotonic()
+            if received:
+                last_data = now
+                idle = 0.01
+            elif timeout and now - last_data > timeout:
+                channel.close()
+                raise socket.timeout(f'no output for {timeout} seconds')
+            else:
+                # stderr does not wake up a select on the channel, so poll with a
+                # delay that grows while the command is quiet
+                time.sleep(idle)
+                idle = min(idle * 2, 0.5)
+
+        stdout.close()
+        stderr.close()
+        exit_status = channel.recv_exit_status()
+        self.write(host, f'### [{tag}] exit status {exit_status}\n')
+        log_file, lock = self._file(host)
+        with lock:
+            log_file.flush()
+        return exit_status, stdout.text(), stderr.text()
+
+    def close_all(self):
+        """
+        Closes every per-host log file.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            for log_file, lock in self._files.values():
+                with lock:
+                    log_file.close()
+            self._files = {}
+
+
+# Logs shared by every remote command of the config_external_ceph scripts
+host_logs = HostLogs()
+
+
+def add_arguments(parser):
+    """
+    Adds the output options shared by the config_external_ceph scripts.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('-l', '--log-dir', default='logs', help='The directory of the compressed output log of each host')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not print the output of the remote commands as it arrives, only write it to the logs')
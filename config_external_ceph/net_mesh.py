@@ -0,0 +1,334 @@
+import argparse
+import json
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import distribute
+import fanout
+import inventory
+import ssh_pool
+
+TESTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'net_tester.py')
+TESTER_PATH = '/var/tmp/net_tester.py'
+DEFAULT_PORT = 5201
+# RHEL 8 hosts without the python3 package still have the platform Python
+PYTHON = '$(command -v python3 || echo /usr/libexec/platform-python)'
+# Matrices wider than this are summarized per host instead
+MAX_MATRIX_HOSTS = 32
+
+
+def schedule(hosts, pattern='full'):
+    """
+    Plans the test rounds so that in every round each host sends to exactly one
+    host and receives from exactly one host, and no link carries more than one
+    test per direction.
+
+    With the full pattern every pair is tested in both directions, in len(hosts) - 1
+    rounds (round robin, the two hosts of a pair send to each other at the same time).
+    With the ring pattern each host sends to the next one, in one round.
+
+    Parameters:
+    hosts (list): The hosts to test.
+    pattern (str): 'full' or 'ring'.
+
+    Returns:
+    list: The rounds, each a list of (sender, receiver) tuples.
+    """
+    if len(hosts) < 2:
+        return []
+    if pattern == 'ring':
+        return [[(hosts[i], hosts[(i + 1) % len(hosts)]) for i in range(len(hosts))]]
+
+    # The circle method, an odd number of hosts gets a bye in every round
+    players = list(hosts) + ([None] if len(hosts) % 2 else [])
+    rounds = []
+    for r in range(len(players) - 1):
+        pairs = []
+        for i in range(len(players) // 2):
+            a, b = players[i], players[-1 - i]
+            if a is not None and b is not None:
+                pairs += [(a, b), (b, a)]
+        rounds.append(pairs)
+        players = [players[0], players[-1]] + players[1:-1]
+    return rounds
+
+
+class RemoteRunner:
+    """
+    Runs the tester on the hosts over the SSH pool, against the bond0 addresses.
+    """
+
+    def __init__(self, port=DEFAULT_PORT):
+        self.port = port
+
+    def endpoint(self, host):
+        facts = inventory.cache.get(host)
+        bond = next((interface for interface in facts.interfaces if interface.name == 'bond0'), None)
+        if bond and bond.addresses:
+            return bond.addresses[0].split('/')[0], self.port
+        return ssh_pool.split_host(host)[0], self.port
+
+    def _start_server(self, host, idle):
+        command = (f"pkill -f '[n]et_tester.py server --port {self.port}'; "
+                   f"(setsid nohup {PYTHON} {TESTER_PATH} server --port {self.port} --idle {idle} > /dev/null 2>&1 < /dev/null &); "
+                   f"for i in $(seq 40); do ss -ltn | grep -q ':{self.port} ' && exit 0; sleep 0.25; done; exit 1")
+        exit_status, output, error = ssh_pool.pool.exec_command(host, command)
+        if exit_status != 0:
+            raise RuntimeError(f'the tester does not listen on port {self.port}: {error.strip()}')
+        return self.endpoint(host)
+
+    def start(self, hosts, idle):
+        """
+        Copies the tester to the hosts and starts a server on each of them.
+
+        Parameters:
+        hosts (list): The hosts to test.
+        idle (float): The number of seconds without a test after which a server exits.
+
+        Returns:
+        dict: For each host, its (address, port), or the exception of a host that could not be started.
+        """
+        with open(TESTER, 'rb') as f:
+            files = [distribute.from_data(TESTER_PATH, f.read(), 0o755)]
+        copied = distribute.distribute(hosts, files)
+        ready = [host for host, result in copied.items() if not isinstance(result, Exception)]
+        started = fanout.engine.run(self._start_server, ready, idle, step='mesh_start')
+        return {host: started.get(host, copied[host]) for host in hosts}
+
+    def run_client(self, sender, target, options):
+        address, port = target
+        command = (f'{PYTHON} {TESTER_PATH} client --target {shlex.quote(address)} --port {port} --seconds {options.mesh_seconds}'
+                   f' --streams {options.mesh_streams} --pings {options.mesh_pings}')
+        exit_status, output, error = ssh_pool.pool.exec_command(sender, command, timeout=options.mesh_seconds + 60)
+        if exit_status != 0:
+            raise RuntimeError(f'tester exited with status {exit_status}: {error.strip()}')
+        return json.loads(output.strip().splitlines()[-1])
+
+    def stop(self, hosts):
+        fanout.engine.run(lambda host: ssh_pool.pool.exec_command(host, f"pkill -f '[n]et_tester.py server --port {self.port}'"),
+                          hosts, step='mesh_stop')
+
+
+class LoopbackRunner:
+    """
+    Runs a tester server per simulated host on 127.0.0.1 and the clients as local
+    processes, to try the test and its report on any Linux box.
+    """
+
+    def __init__(self):
+        self.servers = {}
+
+    def start(self, hosts, idle):
+        endpoints = {}
+        for host in hosts:
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+            self.servers[host] = subprocess.Popen([sys.executable, TESTER, 'server', '--port', str(port), '--idle', str(idle)])
+            endpoints[host] = ('127.0.0.1', port)
+        for host, endpoint in endpoints.items():
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    socket.create_connection(endpoint, timeout=1).close()
+                    break
+                except OSError as e:
+                    if time.monotonic() > deadline:
+                        endpoints[host] = e
+                        break
+                    time.sleep(0.1)
+        return endpoints
+
+    def run_client(self, sender, target, options):
+        address, port = target
+        completed = subprocess.run([sys.executable, TESTER, 'client', '--target', address, '--port', str(port),
+                                    '--seconds', str(options.mesh_seconds), '--streams', str(options.mesh_streams),
+                                    '--pings', str(options.mesh_pings)],
+                                   capture_output=True, text=True, timeout=options.mesh_seconds + 60)
+        if completed.returncode != 0:
+            raise RuntimeError(f'tester exited with status {completed.returncode}: {completed.stderr.strip()}')
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    def stop(self, hosts):
+        for server in self.servers.values():
+            server.terminate()
+            server.wait()
+        self.servers = {}
+
+
+def run_mesh(runner, hosts, options):
+    """
+    Starts the testers and runs the planned rounds one after the other, the pairs
+    of a round in parallel.
+
+    Parameters:
+    runner (RemoteRunner or LoopbackRunner): Where the testers run.
+    hosts (list): The hosts to test.
+    options (argparse.Namespace): The mesh options, see add_arguments.
+
+    Returns:
+    dict: The tester result of every (sender, receiver) pair, or its exception.
+    """
+    rounds = schedule(hosts, options.mesh_pattern)
+    # The servers must outlive the longest gap between two tests they receive
+    endpoints = runner.start(hosts, idle=max(300, options.mesh_seconds * 4))
+    results = {}
+    try:
+        for number, pairs in enumerate(rounds, 1):
+            for sender, receiver in pairs:
+                if isinstance(endpoints[sender], Exception):
+                    results[(sender, receiver)] = endpoints[sender]
+                elif isinstance(endpoints[receiver], Exception):
+                    results[(sender, receiver)] = endpoints[receiver]
+            targets = {sender: receiver for sender, receiver in pairs if (sender, receiver) not in results}
+            outcomes = fanout.engine.run(lambda sender: runner.run_client(sender, endpoints[targets[sender]], options),
+                                         list(targets), step='mesh_test')
+            for sender, outcome in outcomes.items():
+                results[(sender, targets[sender])] = outcome
+            print(f'mesh round {number}/{len(rounds)} done')
+    finally:
+        runner.stop(hosts)
+    return results
+
+
+def find_outliers(results, slow_fraction=0.7, latency_factor=3.0):
+    """
+    Flags the pairs well below the median throughput or well above the median p99
+    round trip time, and the hosts involved in most of the flagged pairs, as a
+    degraded slave or cable shows up on every pair of its host.
+
+    Parameters:
+    results (dict): The tester result of every (sender, receiver) pair, or its exception.
+    slow_fraction (float): Pairs below this fraction of the median throughput are slow.
+    latency_factor (float): Pairs above this multiple of the median p99 round trip time have high latency.
+
+    Returns:
+    tuple: The reasons of every flagged pair, and the flagged hosts with the share of their pairs that was flagged.
+    """
+    ok = {pair: result for pair, result in results.items() if not isinstance(result, Exception)}
+    median_bps = statistics.median(result['bits_per_second'] for result in ok.values()) if ok else 0
+    median_p99 = statistics.median(result['rtt_us']['p99'] for result in ok.values()) if ok else 0
+
+    flagged = {}
+    for pair, result in results.items():
+        reasons = []
+        if isinstance(result, Exception):
+            reasons.append(f'failed: {result}')
+        else:
+            if result['bits_per_second'] < slow_fraction * median_bps:
+                reasons.append(f"{result['bits_per_second'] / 1e9:.2f} Gbit/s, median {median_bps / 1e9:.2f}")
+            if median_p99 and result['rtt_us']['p99'] > latency_factor * median_p99:
+                reasons.append(f"p99 {result['rtt_us']['p99']:.0f} us, median {median_p99:.0f}")
+        if reasons:
+            flagged[pair] = reasons
+
+    involved = {}
+    for sender, receiver in results:
+        for host in (sender, receiver):
+            total, bad = involved.get(host, (0, 0))
+            involved[host] = (total + 1, bad + ((sender, receiver) in flagged))
+    # A host is only suspect when most of its pairs are, otherwise blame stays with the pairs
+    hosts = {host: bad / total for host, (total, bad) in involved.items() if bad * 2 > total}
+    return flagged, hosts
+
+
+def print_report(hosts, results, flagged, degraded):
+    """
+    Prints the sender x receiver throughput matrix (or a per-host summary for large
+    fleets), the round trip times and the outliers.
+
+    Parameters:
+    hosts (list): The tested hosts.
+    results (dict): The tester result of every (sender, receiver) pair, or its exception.
+    flagged (dict): The reasons of every flagged pair.
+    degraded (dict): The flagged hosts with the share of their pairs that was flagged.
+
+    Returns:
+    None
+    """
+    def cell(pair):
+        result = results.get(pair)
+        if result is None:
+            return '    - '
+        if isinstance(result, Exception):
+            return ' fail '
+        return f"{result['bits_per_second'] / 1e9:5.1f}{'*' if pair in flagged else ' '}"
+
+    if len(hosts) <= MAX_MATRIX_HOSTS:
+        print('Throughput in Gbit/s, rows send to columns, * marks outliers')
+        print(f"{'':>4} {'':<24}" + ''.join(f'{column:>5} ' for column in range(len(hosts))))
+        for row, sender in enumerate(hosts):
+            print(f'{row:>4} {sender[:24]:<24}' + ''.join(cell((sender, receiver)) if sender != receiver else '    . '
+                                                         for receiver in hosts))
+
+    print(f"{'host':<24} {'send Gbit/s':>12} {'recv Gbit/s':>12} {'p50 us':>8} {'p99 us':>8} {'flagged':>8}")
+    for host in hosts:
+        sent = [result for (sender, receiver), result in results.items() if sender == host and not isinstance(result, Exception)]
+        received = [result for (sender, receiver), result in results.items() if receiver == host and not isinstance(result, Exception)]
+        count = sum(1 for pair in flagged if host in pair)
+        send = statistics.median(result['bits_per_second'] for result in sent) / 1e9 if sent else 0
+        recv = statistics.median(result['bits_per_second'] for result in received) / 1e9 if received else 0
+        p50 = statistics.median(result['rtt_us']['p50'] for result in sent) if sent else 0
+        p99 = statistics.median(result['rtt_us']['p99'] for result in sent) if sent else 0
+        print(f'{host[:24]:<24} {send:>12.2f} {recv:>12.2f} {p50:>8.0f} {p99:>8.0f} {count:>8}')
+
+    for (sender, receiver), reasons in flagged.items():
+        print(f"Outlier {sender} -> {receiver}: {', '.join(reasons)}")
+    for host, share in sorted(degraded.items(), key=lambda item: -item[1]):
+        print(f"Host '{host}' is involved in {share:.0%} of the outliers of its pairs, check its slaves and cabling")
+    if not flagged:
+        print(f'No outliers in {len(results)} tested pairs')
+
+
+def validate(hosts, options, runner=None):
+    """
+    Tests the network between the hosts and prints the report.
+
+    Parameters:
+    hosts (list): The hosts to test.
+    options (argparse.Namespace): The mesh options, see add_arguments.
+    runner (RemoteRunner or LoopbackRunner): Where the testers run, the hosts over SSH if not given.
+
+    Returns:
+    tuple: The flagged pairs and the flagged hosts.
+    """
+    runner = runner or RemoteRunner(options.mesh_port)
+    rounds = len(schedule(hosts, options.mesh_pattern))
+    print(f'Testing the network between {len(hosts)} hosts in {rounds} round(s) of {options.mesh_seconds} seconds ({options.mesh_pattern})')
+    results = run_mesh(runner, hosts, options)
+    flagged, degraded = find_outliers(results, options.mesh_slow_fraction)
+    print_report(hosts, results, flagged, degraded)
+    return flagged, degraded
+
+
+def add_arguments(parser):
+    """
+    Adds the network test options.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('--mesh-pattern', choices=['full', 'ring', 'none'], default='ring', help='Test each host to the next one, every pair of hosts (hosts - 1 rounds, long on a large fleet), or skip the network test')
+    parser.add_argument('--mesh-seconds', type=float, default=3, help='The number of seconds each pair sends for')
+    parser.add_argument('--mesh-streams', type=int, default=4, help='The number of parallel TCP streams per pair')
+    parser.add_argument('--mesh-pings', type=int, default=200, help='The number of round trips timed per pair')
+    parser.add_argument('--mesh-port', type=int, default=DEFAULT_PORT, help='The TCP port of the tester on the hosts')
+    parser.add_argument('--mesh-slow-fraction', type=float, default=0.7, help='Pairs below this fraction of the median throughput are outliers')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Test the network between simulated hosts on this machine')
+    parser.add_argument('-n', '--loopback', type=int, default=4, help='The number of simulated hosts')
+    add_arguments(parser)
+    fanout.add_arguments(parser)
+    args = parser.parse_args()
+    fanout.engine.configure(args.max_workers, args.timeout)
+    validate([f'loop{n}' for n in range(args.loopback)], args, LoopbackRunner())
+    fanout.engine.shutdown()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+A self-contained network tester, copied to the hosts by net_mesh.py. It only uses
+the standard library, so it runs with the platform Python of any host.
+
+    net_tester.py server --port 5201 --idle 300
+    net_tester.py client --target 10.1.0.2 --port 5201 --seconds 3 --streams 4 --pings 200
+
+The client sends for the given time over parallel TCP streams, then measures the
+round trip time of small messages on an idle connection, and prints one JSON line.
+"""
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+
+CHUNK = 256 * 1024
+PING_SIZE = 64
+THROUGHPUT = b'T'
+PING = b'P'
+
+
+def _recv_exact(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _handle(conn):
+    try:
+        kind = _recv_exact(conn, 1)
+        if kind == THROUGHPUT:
+            # Count until the client stops sending and tell it how much arrived
+            total = 0
+            while True:
+                data = conn.recv(CHUNK)
+                if not data:
+                    break
+                total += len(data)
+            conn.sendall(f'{total}\n'.encode())
+        elif kind == PING:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while True:
+                data = _recv_exact(conn, PING_SIZE)
+                if data is None:
+                    break
+                conn.sendall(data)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+def serve(port, idle):
+    """
+    Accepts test connections until no client connected for idle seconds.
+
+    Parameters:
+    port (int): The TCP port to listen on.
+    idle (float): The number of seconds without a new connection after which the server exits.
+
+    Returns:
+    None
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    listener.listen(128)
+    listener.settimeout(idle)
+    while True:
+        try:
+            conn, address = listener.accept()
+        except socket.timeout:
+            break
+        conn.settimeout(None)
+        threading.Thread(target=_handle, args=(conn,), daemon=True).start()
+    listener.close()
+
+
+def _stream(target, port, deadline, received, index):
+    conn = socket.create_connection((target, port), timeout=10)
+    try:
+        conn.sendall(THROUGHPUT)
+        chunk = b'\0' * CHUNK
+        while time.monotonic() < deadline:
+            conn.sendall(chunk)
+        conn.shutdown(socket.SHUT_WR)
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = conn.recv(64)
+            if not data:
+                break
+            reply += data
+        received[index] = int(reply or 0)
+    finally:
+        conn.close()
+
+
+def measure_throughput(target, port, seconds, streams):
+    """
+    Sends to a server over parallel streams and counts what arrived there.
+
+    Parameters:
+    target (str): The address of the server.
+    port (int): The port of the server.
+    seconds (float): The number of seconds to send for.
+    streams (int): The number of parallel TCP connections.
+
+    Returns:
+    tuple: The bytes the server received and the seconds it took.
+    """
+    received = [0] * streams
+    errors = []
+
+    def run(index):
+        try:
+            _stream(target, port, deadline, received, index)
+        except OSError as e:
+            errors.append(e)
+
+    start = time.monotonic()
+    deadline = start + seconds
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    if errors and len(errors) == streams:
+        raise errors[0]
+    return sum(received), elapsed
+
+
+def measure_rtt(target, port, pings):
+    """
+    Measures the round trip time of small messages on one connection.
+
+    Parameters:
+    target (str): The address of the server.
+    port (int): The port of the server.
+    pings (int): The number of round trips.
+
+    Returns:
+    list: The round trip times in microseconds, sorted.
+    """
+    conn = socket.create_connection((target, port), timeout=10)
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.sendall(PING)
+        message = b'\0' * PING_SIZE
+        rtts = []
+        for n in range(pings):
+            start = time.perf_counter()
+            conn.sendall(message)
+            if _recv_exact(conn, PING_SIZE) is None:
+                raise ConnectionError('server closed the connection')
+            rtts.append((time.perf_counter() - start) * 1e6)
+        return sorted(rtts)
+    finally:
+        conn.close()
+
+
+def percentile(values, fraction):
+    """
+    Returns a percentile of sorted values, by the nearest rank.
+
+    Parameters:
+    values (list): The sorted values.
+    fraction (float): The percentile as a fraction, e.g. 0.99.
+
+    Returns:
+    float: The value, 0 when there are no values.
+    """
+    if not values:
+        return 0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def run_client(target, port, seconds, streams, pings):
+    """
+    Runs the throughput and latency test against one server.
+
+    Parameters:
+    target (str): The address of the server.
+    port (int): The port of the server.
+    seconds (float): The number of seconds to send for.
+    streams (int): The number of parallel TCP connections.
+    pings (int): The number of round trips to time.
+
+    Returns:
+    dict: The result, as printed by the client.
+    """
+    total, elapsed = measure_throughput(target, port, seconds, streams)
+    rtts = measure_rtt(target, port, pings) if pings else []
+    return {
+        'target': target,
+        'bytes': total,
+        'seconds': round(elapsed, 3),
+        'bits_per_second': int(total * 8 / elapsed) if elapsed else 0,
+        'rtt_us': {name: round(percentile(rtts, fraction), 1)
+                   for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Network throughput and latency tester')
+    subparsers = parser.add_subparsers(dest='mode')
+    server = subparsers.add_parser('server', help='Accept tests')
+    server.add_argument('--port', type=int, default=5201, help='The TCP port to listen on')
+    server.add_argument('--idle', type=float, default=300, help='Exit after this many seconds without a new connection')
+    client = subparsers.add_parser('client', help='Test against a server')
+    client.add_argument('--target', required=True, help='The address of the server')
+    client.add_argument('--port', type=int, default=5201, help='The TCP port of the server')
+    client.add_argument('--seconds', type=float, default=3, help='The number of seconds to send for')
+    client.add_argument('--streams', type=int, default=4, help='The number of parallel TCP connections')
+    client.add_argument('--pings', type=int, default=200, help='The number of round trips to time')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'server':
+        serve(args.port, args.idle)
+    elif args.mode == 'client':
+        print(json.dumps(run_client(args.target, args.port, args.seconds, args.streams, args.pings)))
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
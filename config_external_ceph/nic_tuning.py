@@ -0,0 +1,198 @@
+import distribute
+import inventory
+import ssh_pool
+
+SCRIPT_PATH = '/usr/local/sbin/nic-tuning.sh'
+UNIT_NAME = 'nic-tuning.service'
+UNIT_PATH = f'/etc/systemd/system/{UNIT_NAME}'
+
+# Installed on the host and run at every boot, the queues and IRQs of a NIC are
+# recreated by the driver so the settings do not survive a reboot on their own
+TUNING_SCRIPT = r"""#!/bin/bash
+# Spreads the queues of the bond slaves over the cores of their own NUMA node:
+# channel count and ring sizes via ethtool, queue IRQ affinity, RPS and XPS.
+# Installed by 2_setup_net.py and run at boot by nic-tuning.service.
+bond=${1:-bond0}
+slaves=$(cat /sys/class/net/$bond/bonding/slaves 2>/dev/null)
+if [ -z "$slaves" ]; then
+    echo "$bond has no slaves" >&2
+    exit 1
+fi
+
+expand() {
+    local range
+    for range in ${1//,/ }; do
+        seq ${range%-*} ${range#*-}
+    done
+}
+
+# The sysfs hex mask of one CPU, in comma separated 32 bit words
+cpu_mask() {
+    local words=$(( ($(nproc --all) + 31) / 32 )) mask='' w
+    for ((w = words - 1; w >= 0; w--)); do
+        mask+=$(printf '%08x' $(( w == $1 / 32 ? 1 << ($1 % 32) : 0 )))
+        [ $w -gt 0 ] && mask+=,
+    done
+    echo $mask
+}
+
+# The value of a field in the maximums or current settings of ethtool -l/-g
+ethtool_field() {
+    awk -v block="$2" -v field="$3:" '/^Pre-set maximums/ {m = "max"} /^Current hardware/ {m = "current"}
+                                      m == block && $1 == field {print $2; exit}' <<< "$1"
+}
+
+# irqbalance would move the pinned IRQs again
+if systemctl is-active -q irqbalance 2>/dev/null; then
+    systemctl disable -q --now irqbalance
+    echo "irqbalance stopped"
+fi
+
+for nic in $slaves; do
+    dev=/sys/class/net/$nic/device
+    node=$(cat $dev/numa_node 2>/dev/null || echo -1)
+    cpulist=$(cat $dev/local_cpulist 2>/dev/null || cat /sys/devices/system/cpu/online)
+
+    # One CPU per physical core, the hyperthread siblings share its cache
+    cores=()
+    for cpu in $(expand $cpulist); do
+        siblings=$(cat /sys/devices/system/cpu/cpu$cpu/topology/thread_siblings_list 2>/dev/null || echo $cpu)
+        [ "${siblings%%[,-]*}" = "$cpu" ] && cores+=($cpu)
+    done
+
+    # One combined channel per local core, as far as the NIC supports
+    channels=keep
+    settings=$(ethtool -l $nic 2>/dev/null)
+    max=$(ethtool_field "$settings" max Combined)
+    current=$(ethtool_field "$settings" current Combined)
+    if [[ $max =~ ^[0-9]+$ && $current =~ ^[0-9]+$ && $max -gt 0 ]]; then
+        want=$(( ${#cores[@]} < max ? ${#cores[@]} : max ))
+        channels=$want
+        if [ "$want" != "$current" ] && ! ethtool -L $nic combined $want; then
+            channels=failed
+        fi
+    fi
+
+    # The largest rings absorb bursts, at the cost of a short link reset when changed
+    rings=keep
+    settings=$(ethtool -g $nic 2>/dev/null)
+    rx_max=$(ethtool_field "$settings" max RX)
+    tx_max=$(ethtool_field "$settings" max TX)
+    rx=$(ethtool_field "$settings" current RX)
+    tx=$(ethtool_field "$settings" current TX)
+    if [[ $rx_max =~ ^[0-9]+$ && $tx_max =~ ^[0-9]+$ ]]; then
+        rings=$rx_max/$tx_max
+        if [ "$rx/$tx" != "$rings" ] && ! ethtool -G $nic rx $rx_max tx $tx_max; then
+            rings=failed
+        fi
+    fi
+
+    # Let the slave come back before touching the next one, so the bond keeps a link
+    for i in $(seq 20); do
+        [ "$(cat /sys/class/net/$nic/carrier 2>/dev/null)" = 1 ] && break
+        sleep 0.5
+    done
+
+    # The queue IRQs carry the interface name, otherwise take every MSI of the device
+    irqs=($(awk -v nic="$nic" '$NF ~ "(^|-)" nic "-" {sub(":", "", $1); print $1}' /proc/interrupts))
+    [ ${#irqs[@]} -gt 0 ] || irqs=($(ls $dev/msi_irqs 2>/dev/null | sort -n))
+    pinned=0
+    for i in "${!irqs[@]}"; do
+        echo ${cores[$((i % ${#cores[@]}))]} > /proc/irq/${irqs[$i]}/smp_affinity_list 2>/dev/null && pinned=$((pinned + 1))
+    done
+
+    # RPS spreads each receive queue over the local node, XPS sends from the core owning the queue
+    rps=0
+    mask=$(cat $dev/local_cpus 2>/dev/null)
+    for queue in /sys/class/net/$nic/queues/rx-*; do
+        [ -n "$mask" ] && echo $mask > $queue/rps_cpus 2>/dev/null && rps=$((rps + 1))
+    done
+    xps=0
+    i=0
+    for queue in /sys/class/net/$nic/queues/tx-*; do
+        cpu_mask ${cores[$((i % ${#cores[@]}))]} > $queue/xps_cpus 2>/dev/null && xps=$((xps + 1))
+        i=$((i + 1))
+    done
+
+    echo "nic $nic node=$node cores=${#cores[@]} irqs=$pinned/${#irqs[@]} channels=$channels rings=$rings rps=$rps xps=$xps"
+done
+"""
+
+UNIT = f"""[Unit]
+Description=Pin the queues and IRQs of the bond slaves to their NUMA node
+After=network-online.target irqbalance.service
+Wants=network-online.target
+
+[Service]
+Type=oneshot
+ExecStart=/bin/bash {SCRIPT_PATH} {{bond}}
+RemainAfterExit=yes
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def parse_report(output):
+    """
+    Reads the per-NIC lines the tuning script prints.
+
+    Parameters:
+    output (str): The output of the tuning script.
+
+    Returns:
+    dict: The applied settings of every NIC by name.
+    """
+    nics = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) > 2 and fields[0] == 'nic':
+            nics[fields[1]] = dict(field.split('=', 1) for field in fields[2:] if '=' in field)
+    return nics
+
+
+def describe(nic, settings):
+    """
+    Describes the settings applied to a NIC in one line.
+
+    Parameters:
+    nic (str): The name of the NIC.
+    settings (dict): The settings of the NIC as parsed by parse_report.
+
+    Returns:
+    str: The description.
+    """
+    return (f"{nic}: node {settings.get('node')}, IRQs {settings.get('irqs')} pinned to {settings.get('cores')} cores, "
+            f"channels {settings.get('channels')}, rings {settings.get('rings')}, "
+            f"RPS {settings.get('rps')} queues, XPS {settings.get('xps')} queues")
+
+
+def tune_host(host, bond_name='bond0'):
+    """
+    Installs the NIC tuning script and its boot unit on a host and runs it once,
+    pinning the queues of every slave of the bond to cores of the slave's NUMA node.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    bond_name (str): The name of the bond interface.
+
+    Returns:
+    str: The settings applied to every slave.
+    """
+    files = [distribute.from_data(SCRIPT_PATH, TUNING_SCRIPT, 0o755),
+             distribute.from_data(UNIT_PATH, UNIT.format(bond=bond_name), 0o644)]
+    distribute.push_to_host(host, files)
+
+    exit_status, output, error = ssh_pool.pool.exec_command(
+        host, f'systemctl daemon-reload && systemctl enable -q {UNIT_NAME} && bash {SCRIPT_PATH} {bond_name}')
+    if exit_status != 0:
+        raise RuntimeError(f'NIC tuning exited with status {exit_status}: {error.strip()}')
+
+    # The queue counts of the NICs may have changed
+    inventory.cache.invalidate(host)
+
+    nics = parse_report(output)
+    if not nics:
+        raise RuntimeError(f'NIC tuning reported no slaves of {bond_name}')
+    notes = [line for line in output.splitlines() if line and not line.startswith('nic ')]
+    return '; '.join(notes + [describe(nic, settings) for nic, settings in nics.items()])
@@ -0,0 +1,261 @@
+import collections
+import json
+import re
+import inventory
+
+# From the slowest to the fastest media
+MEDIA = ('hdd', 'ssd', 'nvme')
+# Drives smaller than this are boot or vendor devices, not OSD candidates
+MIN_OSD_SIZE = 32 * 1024 ** 3
+# The number of data drives one DB device serves well, above that it becomes the bottleneck
+MAX_DATA_PER_DB = {'ssd': 5, 'nvme': 12}
+# Below this fraction of the data drive, block.db spills over to the slow device even for RBD
+MIN_DB_FRACTION = 0.01
+GiB = 1024 ** 3
+# Left free on a DB device for the LVM metadata and the extent rounding of its LVs
+LVM_RESERVE = GiB
+
+Layout = collections.namedtuple('Layout', ['data', 'db', 'osds_per_device', 'block_db_size'])
+HostPlan = collections.namedtuple('HostPlan', ['host', 'hostname', 'layouts', 'skipped', 'warnings', 'available'])
+
+
+def media(disk):
+    """
+    Tells the media of a drive from the inventory.
+
+    Parameters:
+    disk (inventory.Disk): The drive.
+
+    Returns:
+    str: 'hdd', 'ssd' or 'nvme'.
+    """
+    if disk.rotational:
+        return 'hdd'
+    return 'nvme' if disk.name.startswith('nvme') else 'ssd'
+
+
+def _size(size):
+    return f'{size / 1e12:.1f}TB' if size >= 1e12 else f'{size / 1e9:.0f}GB'
+
+
+def plan_host(facts, large_nvme_size, osds_per_nvme):
+    """
+    Decides the role of every drive of a host: the data goes on the slowest media,
+    block.db and the WAL on the fastest media when the host has both, split evenly
+    between the data drives, and media in between become OSDs of their own. Large
+    NVMe data drives get several OSDs, one OSD does not keep them busy.
+
+    Parameters:
+    facts (inventory.HostInventory): The facts of the host.
+    large_nvme_size (int): The size in bytes from which NVMe data drives get osds_per_nvme OSDs.
+    osds_per_nvme (int): The number of OSDs of a large NVMe data drive.
+
+    Returns:
+    HostPlan: The layouts of the host, the drives left out, the warnings for the review
+              and the drives cephadm may take, every drive but the system ones.
+    """
+    system = inventory.system_disks(facts)
+    available = [disk for disk in facts.disks if disk.name not in system]
+    by_media = collections.OrderedDict((kind, []) for kind in MEDIA)
+    skipped = []
+    for disk in facts.disks:
+        if disk.name in system:
+            skipped.append((disk, system[disk.name]))
+        elif disk.size < MIN_OSD_SIZE:
+            skipped.append((disk, 'too small'))
+        else:
+            by_media[media(disk)].append(disk)
+    present = [kind for kind, disks in by_media.items() if disks]
+
+    layouts = []
+    warnings = []
+    if not present:
+        return HostPlan(facts.host, facts.hostname, layouts, skipped, ['no drive for an OSD'], available)
+
+    data_media, db_media = present[0], (present[-1] if len(present) > 1 else None)
+    data, db = by_media[data_media], by_media[db_media] if db_media else []
+    if db:
+        # ceph-volume spreads the DBs round robin, the fullest DB device must fit all of its slots
+        per_db = -(-len(data) // len(db))
+        block_db_size = (min(disk.size for disk in db) - LVM_RESERVE) // per_db // GiB * GiB
+        if per_db > MAX_DATA_PER_DB[db_media]:
+            warnings.append(f'{per_db} {data_media} drives per {db_media} DB device, more than the {MAX_DATA_PER_DB[db_media]} it serves well')
+        if len(db) > len(data):
+            warnings.append(f'{len(db)} {db_media} DB devices for {len(data)} {data_media} drives, some stay idle')
+        smallest = min(disk.size for disk in data)
+        if block_db_size < MIN_DB_FRACTION * smallest:
+            warnings.append(f'block.db of {block_db_size // GiB}G is less than {MIN_DB_FRACTION:.0%} of a {_size(smallest)} drive, RocksDB will spill over')
+        db_nodes = {disk.numa_node for disk in db}
+        for node in sorted({disk.numa_node for disk in data} - db_nodes):
+            if node >= 0:
+                count = sum(1 for disk in data if disk.numa_node == node)
+                warnings.append(f'{count} {data_media} drives on NUMA node {node} have their DB on another node')
+        layouts.append(Layout(data, db, 1, block_db_size))
+    else:
+        layouts.append(Layout(data, [], _osds_per_device(data, data_media, large_nvme_size, osds_per_nvme), None))
+
+    # Media between the data and the DB media, e.g. SATA SSDs next to HDDs and NVMe
+    for kind in present[1:-1]:
+        layouts.append(Layout(by_media[kind], [], _osds_per_device(by_media[kind], kind, large_nvme_size, osds_per_nvme), None))
+    return HostPlan(facts.host, facts.hostname, layouts, skipped, warnings, available)
+
+
+def _osds_per_device(disks, kind, large_nvme_size, osds_per_nvme):
+    if kind == 'nvme' and min(disk.size for disk in disks) >= large_nvme_size:
+        return osds_per_nvme
+    return 1
+
+
+def device_filter(disks, host_disks):
+    """
+    Picks the most general cephadm device filter that selects exactly these drives on
+    the host: rotational when they are all drives of their kind, their model when no
+    other drive shares it, or their paths. cephadm only takes available drives, so
+    the system drive never matches a filter, but a drive skipped as too small does.
+
+    Parameters:
+    disks (list): The drives to select.
+    host_disks (list): All drives of the host but the system ones.
+
+    Returns:
+    dict: The filter.
+    """
+    names = {disk.name for disk in disks}
+    rotational = {disk.rotational for disk in disks}
+    if len(rotational) == 1:
+        same_kind = {disk.name for disk in host_disks if disk.rotational in rotational}
+        if same_kind == names:
+            return {'rotational': int(rotational.pop())}
+    models = {disk.model for disk in disks}
+    if len(models) == 1 and models != {''}:
+        same_model = {disk.name for disk in host_disks if disk.model in models}
+        if same_model == names:
+            return {'model': models.pop()}
+    return {'paths': sorted(f'/dev/{name}' for name in names)}
+
+
+def build_specs(plans):
+    """
+    Turns the host plans into cephadm OSD service specs, one per distinct layout,
+    placed on every host that has that layout.
+
+    Parameters:
+    plans (list): The HostPlan of every host.
+
+    Returns:
+    list: The specs as dicts, in the order of the first host of each layout.
+    """
+    specs = collections.OrderedDict()
+    for plan in plans:
+        for layout in plan.layouts:
+            spec = {'data_devices': device_filter(layout.data, plan.available)}
+            if layout.db:
+                spec['db_devices'] = device_filter(layout.db, plan.available)
+                spec['block_db_size'] = f'{layout.block_db_size // GiB}G'
+            if layout.osds_per_device > 1:
+                spec['osds_per_device'] = layout.osds_per_device
+            name = media(layout.data[0]) + (f'_{media(layout.db[0])}_db' if layout.db else '')
+            key = json.dumps(spec, sort_keys=True)
+            if key not in specs:
+                specs[key] = {'name': name, 'hosts': [], 'spec': spec}
+            specs[key]['hosts'].append(plan.hostname or plan.host)
+
+    used = collections.Counter()
+    result = []
+    for entry in specs.values():
+        used[entry['name']] += 1
+        service_id = entry['name'] if used[entry['name']] == 1 else f"{entry['name']}_{used[entry['name']]}"
+        result.append({'service_type': 'osd', 'service_id': service_id,
+                       'placement': {'hosts': entry['hosts']}, 'spec': entry['spec']})
+    return result
+
+
+def _yaml_scalar(value):
+    if isinstance(value, int):
+        return str(value)
+    if re.fullmatch(r'[A-Za-z][\w.-]*', value) and value.lower() not in ('true', 'false', 'yes', 'no', 'on', 'off', 'null'):
+        return value
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _yaml_lines(value, indent):
+    lines = []
+    for key, item in value.items():
+        if isinstance(item, dict):
+            lines.append(f'{indent}{key}:')
+            lines += _yaml_lines(item, indent + '  ')
+        elif isinstance(item, list):
+            lines.append(f'{indent}{key}:')
+            lines += [f'{indent}  - {_yaml_scalar(element)}' for element in item]
+        else:
+            lines.append(f'{indent}{key}: {_yaml_scalar(item)}')
+    return lines
+
+
+def render_specs(specs):
+    """
+    Writes the specs as the multi-document YAML ceph orch apply -i takes, by hand so
+    no YAML library is needed on the bastion.
+
+    Parameters:
+    specs (list): The specs as returned by build_specs.
+
+    Returns:
+    str: The YAML documents.
+    """
+    return ''.join('---\n' + '\n'.join(_yaml_lines(spec, '')) + '\n' for spec in specs)
+
+
+def print_plan(plans):
+    """
+    Prints the placement of every host for review: the drives of every role, how
+    many data drives share a DB device and their size, and the warnings.
+
+    Parameters:
+    plans (list): The HostPlan of every host.
+
+    Returns:
+    None
+    """
+    def drives(disks):
+        groups = collections.Counter((media(disk), _size(disk.size), disk.model) for disk in disks)
+        return ', '.join(f'{count} x {kind} {size} {model}'.rstrip() for (kind, size, model), count in groups.items())
+
+    # Hosts with the same drives share one plan, a fleet is mostly a few hardware types
+    groups = collections.OrderedDict()
+    for plan in plans:
+        lines = []
+        for layout in plan.layouts:
+            nodes = collections.Counter(disk.numa_node for disk in layout.data)
+            placement = ', '.join(f'node {node}: {count}' for node, count in sorted(nodes.items()) if node >= 0)
+            line = f'  data on {drives(layout.data)}'
+            if layout.osds_per_device > 1:
+                line += f', {layout.osds_per_device} OSDs per drive'
+            if layout.db:
+                per_db = f"{'up to ' if len(layout.data) % len(layout.db) else ''}{-(-len(layout.data) // len(layout.db))}"
+                line += (f'; DB/WAL on {drives(layout.db)}, {per_db} data drives per DB device,'
+                         f' {layout.block_db_size // GiB}G each')
+            lines.append(line + (f' (NUMA {placement})' if placement else ''))
+        lines += [f'  skipped {disk.name} ({reason})' for disk, reason in plan.skipped]
+        lines += [f'  Warning: {warning}' for warning in plan.warnings]
+        groups.setdefault('\n'.join(lines), []).append(plan.hostname or plan.host)
+
+    for lines, hosts in groups.items():
+        names = ', '.join(hosts[:8]) + (f' and {len(hosts) - 8} more' if len(hosts) > 8 else '')
+        print(f"OSD plan of {len(hosts)} host{'s' if len(hosts) > 1 else ''} ({names}):")
+        print(lines)
+
+
+def add_arguments(parser):
+    """
+    Adds the OSD spec options.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('--osd-spec', default='osd_spec.yml', help='The file to write the cephadm OSD service spec to')
+    parser.add_argument('--osds-per-nvme', type=int, default=2, help='The number of OSDs of a large NVMe data drive')
+    parser.add_argument('--large-nvme-tb', type=float, default=3.0, help='The size in TB from which NVMe data drives get --osds-per-nvme OSDs')
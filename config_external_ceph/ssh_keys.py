@@ -0,0 +1,140 @@
+import glob
+import os
+import shlex
+import ssh_pool
+
+# Installs the keys that are missing from authorized_keys and optionally generates
+# the host's own key pair, then reports what it changed
+DEPLOY_SCRIPT = r"""
+# scale-tools: deploy_keys
+generate={generate}
+umask 077
+mkdir -p ~/.ssh
+touch ~/.ssh/authorized_keys
+# A last line without newline would be glued to the first added key
+[ -s ~/.ssh/authorized_keys ] && [ -n "$(tail -c 1 ~/.ssh/authorized_keys)" ] && echo >> ~/.ssh/authorized_keys
+added=0
+for key in {keys}; do
+    blob=$(echo "$key" | awk '{{print $2}}')
+    if ! grep -qF "$blob" ~/.ssh/authorized_keys; then
+        echo "$key" >> ~/.ssh/authorized_keys
+        added=$((added + 1))
+    fi
+done
+generated=0
+if [ "$generate" = 1 ] && [ ! -f ~/.ssh/id_rsa.pub ]; then
+    ssh-keygen -q -t rsa -b 2048 -N '' -f ~/.ssh/id_rsa || exit 1
+    generated=1
+fi
+restorecon -R ~/.ssh 2>/dev/null
+echo "$added $generated"
+"""
+
+# Removes keys from authorized_keys in place, keeping the file's owner, mode and
+# SELinux context, and reports how many it removed
+REMOVE_SCRIPT = r"""
+# scale-tools: remove_keys
+umask 077
+removed=0
+for key in {keys}; do
+    blob=$(echo "$key" | awk '{{print $2}}')
+    if [ -n "$blob" ] && grep -qF "$blob" ~/.ssh/authorized_keys 2>/dev/null; then
+        grep -vF "$blob" ~/.ssh/authorized_keys > ~/.ssh/authorized_keys.remove || [ $? -eq 1 ] || exit 1
+        cat ~/.ssh/authorized_keys.remove > ~/.ssh/authorized_keys && rm -f ~/.ssh/authorized_keys.remove || exit 1
+        removed=$((removed + 1))
+    fi
+done
+echo "$removed"
+"""
+
+
+def local_public_key():
+    """
+    Reads the newest local public key, the one ssh-copy-id would install.
+
+    Returns:
+    str: The public key line.
+    """
+    paths = sorted(glob.glob(os.path.expanduser('~/.ssh/id*.pub')), key=os.path.getmtime, reverse=True)
+    if not paths:
+        raise FileNotFoundError('no public key found in ~/.ssh, create one with ssh-keygen')
+    return read_public_key(paths[0])
+
+
+def read_public_key(path):
+    """
+    Reads a public key file.
+
+    Parameters:
+    path (str): The public key file, e.g. /etc/ceph/ceph.pub.
+
+    Returns:
+    str: The public key line.
+    """
+    with open(path) as f:
+        key = f.read().strip()
+    if len(key.split()) < 2 or '\n' in key:
+        raise ValueError(f"'{path}' does not hold a single public key")
+    return key
+
+
+def add_keys(host, public_keys, generate=False):
+    """
+    Adds public keys to root's authorized_keys on a host over the pooled SSH session,
+    skipping the keys already there, and optionally generates the host's own key
+    pair, all in one round trip.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    public_keys (list): The public key lines to authorize.
+    generate (bool): Also create ~/.ssh/id_rsa on the host if it does not exist yet.
+
+    Returns:
+    tuple: The number of keys added and whether a key pair was generated.
+    """
+    script = DEPLOY_SCRIPT.format(keys=' '.join(shlex.quote(key) for key in public_keys) or "''",
+                                  generate=int(generate))
+    exit_status, output, error = ssh_pool.pool.exec_command(host, f'bash -c {shlex.quote(script)}')
+    if exit_status != 0:
+        raise RuntimeError(f'exit status {exit_status}: {error.strip()}')
+    added, generated = (int(field) for field in output.split()[-2:])
+    return added, bool(generated)
+
+
+def remove_keys(host, public_keys):
+    """
+    Removes public keys from root's authorized_keys on a host, e.g. a key that was
+    only authorized for the duration of a relay.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    public_keys (list): The public key lines to remove.
+
+    Returns:
+    int: The number of keys removed.
+    """
+    script = REMOVE_SCRIPT.format(keys=' '.join(shlex.quote(key) for key in public_keys) or "''")
+    exit_status, output, error = ssh_pool.pool.exec_command(host, f'bash -c {shlex.quote(script)}')
+    if exit_status != 0:
+        raise RuntimeError(f'exit status {exit_status}: {error.strip()}')
+    return int(output.split()[-1])
+
+
+def deploy_keys(host, public_keys, generate=False):
+    """
+    Adds public keys to root's authorized_keys on a host and optionally generates the
+    host's own key pair, see add_keys.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    public_keys (list): The public key lines to authorize.
+    generate (bool): Also create ~/.ssh/id_rsa on the host if it does not exist yet.
+
+    Returns:
+    str: What changed on the host.
+    """
+    added, generated = add_keys(host, public_keys, generate)
+    changes = [f'{added} SSH key(s) added' if added else 'SSH keys already present']
+    if generated:
+        changes.append('SSH key generated')
+    return ', '.join(changes)
@@ -0,0 +1,229 @@
+import os
+import socket
+import threading
+import logs
+import paramiko
+from timing import tracer
+
+KNOWN_HOSTS = os.path.expanduser('~/.ssh/known_hosts')
+
+
+def split_host(host):
+    """
+    Splits a hosts file entry into the address and the SSH port.
+
+    Parameters:
+    host (str): The hostname or IP address, optionally followed by ':port'.
+
+    Returns:
+    tuple: The hostname or IP address and the port, 22 if none is given.
+    """
+    name, sep, port = host.rpartition(':')
+    if sep and name and port.isdigit() and ':' not in name:
+        return name, int(port)
+    return host, 22
+
+
+def known_hosts_name(host):
+    """
+    Returns the name a host is listed under in known_hosts.
+
+    Parameters:
+    host (str): The hostname or IP address, optionally followed by ':port'.
+
+    Returns:
+    str: The hostname or IP address, as '[name]:port' for a port other than 22.
+    """
+    name, port = split_host(host)
+    return name if port == 22 else f'[{name}]:{port}'
+
+
+class SSHPool:
+    """
+    Keeps one authenticated SSH transport per host and multiplexes commands and
+    SFTP sessions onto channels of that transport, so each host only pays for
+    the TCP, key exchange and authentication handshake once per run.
+    """
+
+    def __init__(self, username=None, password=None, timeout=None, known_hosts=KNOWN_HOSTS):
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.known_hosts = known_hosts
+        self._host_keys = paramiko.HostKeys()
+        self._host_keys_stat = None
+        self._pid = os.getpid()
+        self._clients = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def configure(self, username, password, timeout=None):
+        """
+        Sets the credentials used for hosts that are not connected yet.
+
+        Parameters:
+        username (str): The username to use for SSH authentication.
+        password (str): The password to use for SSH authentication.
+        timeout (float): Seconds to wait on connect and on a silent command, None for no limit.
+
+        Returns:
+        None
+        """
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+
+    def _host_lock(self, host):
+        # Transports inherited through fork have no reader thread in the child,
+        # so a forked worker starts with an empty pool of its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._clients = {}
+            self._host_locks = {}
+            self._lock = threading.Lock()
+        with self._lock:
+            return self._host_locks.setdefault(host, threading.Lock())
+
+    def _known_keys(self, host):
+        # Parse known_hosts once and again only after it was rewritten, not on every connect
+        with self._lock:
+            try:
+                stat = os.stat(self.known_hosts)
+                stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                stat = None
+            if stat != self._host_keys_stat:
+                self._host_keys = paramiko.HostKeys(self.known_hosts) if stat else paramiko.HostKeys()
+                self._host_keys_stat = stat
+            host_keys = self._host_keys
+        return host_keys.lookup(known_hosts_name(host)) or {}
+
+    def known_host_lines(self, host):
+        """
+        Returns the known_hosts entries of a host, for a host that connects to it on
+        the bastion's behalf and must trust the same keys.
+
+        Parameters:
+        host (str): The hostname or IP address of the remote host, optionally followed by ':port'.
+
+        Returns:
+        list: The known_hosts lines, empty if the host is not known.
+        """
+        return [f'{known_hosts_name(host)} {key_type} {key.get_base64()}' for key_type, key in self._known_keys(host).items()]
+
+    def get_client(self, host, username=None, password=None, timeout=None):
+        """
+        Returns a connected SSH client for the host, opening it on first use and
+        reopening it if the transport has dropped.
+
+        Parameters:
+        host (str): The hostname or IP address of the remote host, optionally followed by ':port'.
+        username (str): Optional username overriding the pool credentials.
+        password (str): Optional password overriding the pool credentials.
+        timeout (float): Optional connect timeout overriding the pool timeout.
+
+        Returns:
+        paramiko.SSHClient: The pooled client for the host.
+        """
+        timeout = timeout or self.timeout
+        with self._host_lock(host):
+            client = self._clients.get(host)
+            if client is not None:
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client
+                client.close()
+
+            address, port = split_host(host)
+            with tracer.span('connect', host):
+                sock = socket.create_connection((address, port), timeout)
+
+            # Key exchange and authentication on the connected socket, the host must
+            # present the key recorded in known_hosts
+            client = paramiko.SSHClient()
+            for key_type, key in self._known_keys(host).items():
+                client.get_host_keys().add(known_hosts_name(host), key_type, key)
+            client.set_missing_host_key_policy(paramiko.RejectPolicy())
+            with tracer.span('auth', host):
+                try:
+                    client.connect(address, port=port, username=username or self.username, password=password or self.password,
+                                   timeout=timeout, banner_timeout=timeout, auth_timeout=timeout, sock=sock)
+                except Exception:
+                    client.close()
+                    sock.close()
+                    raise
+            self._clients[host] = client
+            return client
+
+    def exec_command(self, host, command, username=None, password=None, timeout=None, stream=False):
+        """
+        Runs a command on a new channel of the host's pooled transport.
+
+        Parameters:
+        host (str): The hostname or IP address of the remote host.
+        command (str): The command to run.
+        username (str): Optional username overriding the pool credentials.
+        password (str): Optional password overriding the pool credentials.
+        timeout (float): Optional connect and command timeout overriding the pool timeout.
+        stream (bool): Print and log the output as it arrives and only return its tail,
+                       for commands with long output such as package updates.
+
+        Returns:
+        tuple: The exit status, stdout and stderr of the command.
+        """
+        timeout = timeout or self.timeout
+        client = self.get_client(host, username, password, timeout)
+        with tracer.span('exec', host, command=command[:200]):
+            if stream:
+                channel = client.get_transport().open_session(timeout=timeout)
+                channel.exec_command(command)
+                return logs.host_logs.stream(host, command, channel, timeout)
+
+            stdin, stdout, stderr = client.exec_command(command, timeout=timeout)
+            output = stdout.read().decode()
+            error = stderr.read().decode()
+            exit_status = stdout.channel.recv_exit_status()
+            return exit_status, output, error
+
+    def open_sftp(self, host, username=None, password=None):
+        """
+        Opens an SFTP session on the host's pooled transport.
+
+        Parameters:
+        host (str): The hostname or IP address of the remote host.
+        username (str): Optional username overriding the pool credentials.
+        password (str): Optional password overriding the pool credentials.
+
+        Returns:
+        paramiko.SFTPClient: The SFTP session, to be closed by the caller.
+        """
+        return self.get_client(host, username, password).open_sftp()
+
+    def drop(self, host):
+        """
+        Closes and forgets the host's transport, e.g. before it reboots.
+
+        Parameters:
+        host (str): The hostname or IP address of the remote host.
+
+        Returns:
+        None
+        """
+        with self._host_lock(host):
+            client = self._clients.pop(host, None)
+            if client is not None:
+                client.close()
+
+    def close_all(self):
+        """
+        Closes every pooled transport.
+
+        Returns:
+        None
+        """
+        for host in list(self._clients):
+            self.drop(host)
+
+
+# Pool shared by every helper in the config_external_ceph scripts
+pool = SSHPool()
@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+import time
+
+
+class StateStore:
+    """
+    Records which steps completed on which host in a local JSON lines file, so a
+    rerun after a failure can skip the work that is already done.
+    """
+
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self._done = set()
+        self._lock = threading.Lock()
+
+        if fresh and os.path.exists(path):
+            os.remove(path)
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by an interrupted run
+                        continue
+                    self._done.add((record['host'], record['step']))
+
+    def is_done(self, host, step):
+        """
+        Checks whether the step was recorded as completed on the host.
+
+        Parameters:
+        host (str): The hostname or IP address of the host.
+        step (str): The name of the step.
+
+        Returns:
+        bool: True if the step completed on the host in an earlier run.
+        """
+        return (host, step) in self._done
+
+    def mark_done(self, host, step):
+        """
+        Records the step as completed on the host.
+
+        Parameters:
+        host (str): The hostname or IP address of the host.
+        step (str): The name of the step.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            if (host, step) in self._done:
+                return
+            self._done.add((host, step))
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'host': host, 'step': step, 'time': time.time()}) + '\n')
+
+
+def add_arguments(parser, default_path):
+    """
+    Adds the resume options shared by the config_external_ceph scripts.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+    default_path (str): The state file used when none is given.
+
+    Returns:
+    None
+    """
+    parser.add_argument('-s', '--state-file', default=default_path, help='The file recording the steps already completed on each host')
+    parser.add_argument('--fresh', action='store_true', help='Forget the recorded steps and run everything again')
@@ -0,0 +1,228 @@
+import threading
+import fanout
+import ssh_pool
+from timing import tracer
+
+# Remote scripts name themselves in a '# scale-tools: <name>' comment, it shows in the
+# logs and traces and the simulated fleet in fake_fleet.py answers to it
+PROBE_MARKER = '# scale-tools: probe'
+
+# Guards the status of a host against the pipeline of a host that was given up on
+_status_lock = threading.Lock()
+
+
+class Step:
+    """
+    A named unit of work in a host setup.
+
+    A regular step is called as func(host) and only waits for the steps it requires
+    on the same host, so every host moves through its own chain at its own pace. A
+    barrier step is called once as func(hosts) with the hosts that are ready for it,
+    after every host has finished the steps declared before it, and returns the
+    result for each host as a dict.
+
+    When the run has a state store, a step already recorded as completed on a host
+    is skipped there. The optional probe is a cheap remote command that exits 0 when
+    the step's work is already in place, which also skips the step. Steps that are
+    cheap enough to always repeat set resumable to False.
+    """
+
+    def __init__(self, name, func, requires=(), barrier=False, probe=None, resumable=True):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.barrier = barrier
+        self.probe = probe
+        self.resumable = resumable
+
+
+def remote_command(command):
+    """
+    Builds a step function running a command on the host over the shared SSH pool.
+
+    Parameters:
+    command (str): The command to run.
+
+    Returns:
+    callable: The step function, which fails the step on a non-zero exit status.
+    """
+    def run(host):
+        # The output is printed and logged as it arrives, the step result stays empty
+        exit_status, output, error = ssh_pool.pool.exec_command(host, command, stream=True)
+        if exit_status != 0:
+            raise RuntimeError(f"'{command}' exited with status {exit_status}: {error.strip()}")
+    return run
+
+
+def order_steps(steps):
+    """
+    Orders steps so every step comes after the steps it requires, keeping the
+    declared order where the dependencies allow it.
+
+    Parameters:
+    steps (list): The Step objects to order.
+
+    Returns:
+    list: The steps in dependency order.
+    """
+    names = [step.name for step in steps]
+    for step in steps:
+        for required in step.requires:
+            if required not in names:
+                raise ValueError(f"Step '{step.name}' requires unknown step '{required}'")
+
+    ordered = []
+    done = set()
+    remaining = list(steps)
+    while remaining:
+        for step in remaining:
+            if all(required in done for required in step.requires):
+                break
+        else:
+            raise ValueError(f"Steps {[step.name for step in remaining]} have circular requirements")
+        remaining.remove(step)
+        ordered.append(step)
+        done.add(step.name)
+    return ordered
+
+
+def _report(step, host, result):
+    if isinstance(result, Exception):
+        print(f"Error running step '{step.name}' on host '{host}': {str(result)}")
+    elif result:
+        print(f'{result} ({host})')
+
+
+def _already_done(step, host, state):
+    if not step.resumable:
+        return False
+    if state is not None and state.is_done(host, step.name):
+        print(f"Step '{step.name}' already completed on host '{host}'")
+        return True
+    if step.probe is not None:
+        try:
+            exit_status, output, error = ssh_pool.pool.exec_command(host, f'{step.probe} {PROBE_MARKER}')
+        except Exception:
+            return False
+        if exit_status == 0:
+            print(f"Step '{step.name}' already in place on host '{host}'")
+            return True
+    return False
+
+
+def _record(step, host, status, state, result, cancelled=()):
+    failed = isinstance(result, Exception)
+    with _status_lock:
+        # A pipeline that timed out was already reported, it no longer changes the outcome
+        if host in cancelled:
+            return
+        status[host][step.name] = 'failed' if failed else 'done'
+        if not failed and state is not None and step.resumable:
+            state.mark_done(host, step.name)
+    _report(step, host, result)
+
+
+def _run_chain(host, chain, status, state, cancelled):
+    for step in chain:
+        if host in cancelled:
+            return
+        missing = [required for required in step.requires if status[host].get(required) != 'done']
+        if missing:
+            status[host][step.name] = 'skipped'
+            print(f"Skipping step '{step.name}' on host '{host}': '{missing[0]}' did not complete")
+            continue
+
+        with tracer.step(step.name, host):
+            if _already_done(step, host, state):
+                _record(step, host, status, state, None, cancelled)
+                continue
+
+            try:
+                result = step.func(host)
+            except Exception as e:
+                result = e
+        _record(step, host, status, state, result, cancelled)
+
+
+def run_steps(steps, hosts, state=None):
+    """
+    Runs the steps on all hosts. Consecutive regular steps run as one pipeline per
+    host in the shared fan-out, and barrier steps split the pipelines where the
+    whole fleet has to be in sync.
+
+    Parameters:
+    steps (list): The Step objects to run.
+    hosts (list): The hostnames or IP addresses of the hosts.
+    state (StateStore): Optional record of the steps completed in earlier runs.
+
+    Returns:
+    dict: For each host, the status ('done', 'failed' or 'skipped') of every step.
+    """
+    status = {host: {} for host in hosts}
+    cancelled = set()
+    chain = []
+
+    def flush():
+        if chain:
+            results = fanout.engine.run(_run_chain, hosts, list(chain), status, state, cancelled)
+            for host, result in results.items():
+                if isinstance(result, Exception):
+                    # The host's pipeline timed out, whatever did not finish counts as failed and
+                    # the abandoned pipeline stops before its next step
+                    with _status_lock:
+                        cancelled.add(host)
+                        for step in chain:
+                            status[host].setdefault(step.name, 'failed')
+                    print(f"Error running steps on host '{host}': {str(result)}")
+            chain.clear()
+
+    for step in order_steps(steps):
+        if not step.barrier:
+            chain.append(step)
+            continue
+
+        flush()
+        ready = []
+        for host in hosts:
+            missing = [required for required in step.requires if status[host].get(required) != 'done']
+            if missing:
+                status[host][step.name] = 'skipped'
+                print(f"Skipping step '{step.name}' on host '{host}': '{missing[0]}' did not complete")
+            elif state is not None and step.resumable and state.is_done(host, step.name):
+                status[host][step.name] = 'done'
+                print(f"Step '{step.name}' already completed on host '{host}'")
+            else:
+                ready.append(host)
+
+        if not ready:
+            continue
+        try:
+            # A barrier works on the whole fleet, it is traced as one track
+            with tracer.step(step.name, 'all hosts'):
+                results = step.func(ready)
+        except Exception as e:
+            results = {host: e for host in ready}
+        for host in ready:
+            _record(step, host, status, state, results.get(host))
+    flush()
+
+    return status
+
+
+def print_summary(status):
+    """
+    Prints the hosts that did not complete every step.
+
+    Parameters:
+    status (dict): The per-host step status returned by run_steps.
+
+    Returns:
+    None
+    """
+    incomplete = {host: [name for name, state in steps.items() if state != 'done'] for host, steps in status.items()}
+    incomplete = {host: names for host, names in incomplete.items() if names}
+    if not incomplete:
+        print(f'All steps completed on all {len(status)} hosts')
+        return
+    for host, names in incomplete.items():
+        print(f"Host '{host}' did not complete: {', '.join(names)}")
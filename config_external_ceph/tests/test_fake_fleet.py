@@ -0,0 +1,58 @@
+import os
+import pytest
+import bench
+import fanout
+import inventory
+import known_hosts
+import ssh_pool
+from fake_fleet import FakeFleet
+
+
+@pytest.fixture
+def fleet(tmp_path, monkeypatch):
+    with FakeFleet(4, latency=0.001, seed=1) as fleet:
+        path = str(tmp_path / 'known_hosts')
+        known_hosts.update_known_hosts(fleet.hosts, path)
+        monkeypatch.setattr(ssh_pool, 'pool', ssh_pool.SSHPool('root', 'password', known_hosts=path))
+        monkeypatch.setattr(inventory, 'cache', inventory.InventoryCache(str(tmp_path / 'inventory')))
+        yield fleet
+        ssh_pool.pool.close_all()
+
+
+def test_collect(fleet):
+    facts = fanout.engine.run(inventory.cache.collect, fleet.hosts)
+    assert sorted(facts) == sorted(fleet.hosts)
+    for host, host_facts in facts.items():
+        assert host_facts.hostname == f'fake{fleet.fake_hosts[host].index:05d}'
+        assert len(host_facts.disks) == 5 and len(host_facts.volume_groups) == 4
+        assert inventory.system_disks(host_facts) == {'sda': 'mounted on /boot/efi, /boot, [SWAP], /'}
+        assert inventory.cache.get(host) == host_facts
+
+
+def test_failed_collection_is_not_cached(fleet):
+    fleet.failure_rate = 1.0
+    host = fleet.hosts[0]
+    with pytest.raises(RuntimeError, match='exited with status 1'):
+        inventory.cache.collect(host)
+    assert inventory.cache._load(host) is None
+    fleet.failure_rate = 0.0
+    assert len(inventory.cache.get(host).disks) == 5
+
+
+def test_scripts(tmp_path):
+    # Every script end to end against the simulated hosts, as bench.py runs them
+    with FakeFleet(3, latency=0.001, seed=1) as fleet:
+        hosts_file = str(tmp_path / 'hosts')
+        with open(hosts_file, 'w') as f:
+            f.write('\n'.join(fleet.hosts) + '\n')
+        known_hosts.update_known_hosts(fleet.hosts, str(tmp_path / '.ssh' / 'known_hosts'))
+        with open(tmp_path / '.ssh' / 'id_rsa.pub', 'w') as f:
+            f.write(f'ssh-rsa {fleet.key.get_base64()} test\n')
+        for name in bench.SCRIPTS:
+            result = bench.run_script(name, hosts_file, str(tmp_path), 16, 300)
+            with open(tmp_path / f'{name}.out') as f:
+                output = f.read()
+            assert result['exit'] == 0, output
+            # The bastion has no ceph configuration, but no simulated host may fail
+            assert not [line for line in output.splitlines() if line.startswith('Error') and '127.0.0.1' in line], output
+    assert os.path.exists(tmp_path / 'osd_spec.yml')
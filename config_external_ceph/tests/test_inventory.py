@@ -0,0 +1,101 @@
+import json
+import pytest
+import inventory
+
+LSBLK = {'blockdevices': [
+    {'name': 'sda', 'size': 480103981056, 'rota': False, 'model': 'SSDSC2KB480G8 ', 'serial': 'S1'},
+    {'name': 'sdb', 'size': '4000787030016', 'rota': '1', 'model': 'ST4000NM', 'serial': 'S2'},
+    {'name': 'nvme0n1', 'size': 1600321314816, 'rota': 0, 'model': None, 'serial': None},
+]}
+IP = [
+    {'ifname': 'lo', 'address': '00:00:00:00:00:00', 'operstate': 'UNKNOWN',
+     'addr_info': [{'family': 'inet', 'local': '127.0.0.1', 'prefixlen': 8}]},
+    {'ifname': 'ens1f0', 'address': '52:54:00:00:00:01', 'operstate': 'UP', 'master': 'bond0', 'addr_info': []},
+    {'ifname': 'bond0', 'address': '52:54:00:00:00:01', 'operstate': 'UP',
+     'addr_info': [{'family': 'inet6', 'local': 'fe80::1', 'prefixlen': 64},
+                   {'family': 'inet', 'local': '10.1.0.5', 'prefixlen': 16}]},
+]
+
+
+def collect_output(lsblk=LSBLK, ip=IP, vgs=None, pvs=None, skip=()):
+    sections = {
+        'host': '64\n2\nnode01',
+        'lsblk': json.dumps(lsblk),
+        'disks': 'sda 0 0\nsdb 1 0\nnvme0n1 1 2199023255040',
+        'mounts': 'sda /boot/efi /boot [SWAP] /\nsdb\nnvme0n1',
+        'ip': json.dumps(ip),
+        'nics': 'lo -1 -1 1 1\nens1f0 25000 1 16 8\nbond0 25000 -1 16 16',
+        'vgs': json.dumps({'report': [{'vg': [{'vg_name': name} for name in (vgs or {}).values()]}]}),
+        'pvs': json.dumps({'report': [{'pv': [{'pv_name': pv, 'vg_name': vg} for pv, vg in (pvs or {}).items()]}]}),
+    }
+    return ''.join(f'@@{name}@@\n{text}\n' for name, text in sections.items() if name not in skip)
+
+
+def disk(name, mountpoints=()):
+    return inventory.Disk(name, 10 ** 12, False, '', '', -1, False, list(mountpoints))
+
+
+def test_parse_inventory():
+    facts = inventory.parse_inventory('10.0.0.1', collect_output(pvs={'/dev/sdb': 'ceph-1'}, vgs={'sdb': 'ceph-1'}), 5.0)
+    assert (facts.host, facts.hostname, facts.cpus, facts.numa_nodes, facts.collected_at) == ('10.0.0.1', 'node01', 64, 2, 5.0)
+    assert facts.disks == [
+        inventory.Disk('sda', 480103981056, False, 'SSDSC2KB480G8', 'S1', 0, False, ['/boot/efi', '/boot', '[SWAP]', '/']),
+        inventory.Disk('sdb', 4000787030016, True, 'ST4000NM', 'S2', 1, False, []),
+        inventory.Disk('nvme0n1', 1600321314816, False, '', '', 1, True, []),
+    ]
+    bond = facts.interfaces[2]
+    assert (bond.name, bond.addresses, bond.speed, bond.rx_queues) == ('bond0', ['10.1.0.5/16'], 25000, 16)
+    assert (facts.interfaces[1].master, facts.interfaces[1].numa_node, facts.interfaces[1].tx_queues) == ('bond0', 1, 8)
+    assert facts.volume_groups == ['ceph-1']
+    assert facts.physical_volumes == [inventory.PhysicalVolume('/dev/sdb', 'ceph-1')]
+
+
+@pytest.mark.parametrize('output, error', [
+    (collect_output(), None),
+    (collect_output(skip=('pvs',)), 'missing pvs'),
+    (collect_output(skip=('lsblk', 'ip')), 'missing lsblk, ip'),
+    (collect_output().replace(json.dumps(IP), ''), 'no JSON in ip'),
+    ('', 'missing host'),
+])
+def test_check_output(output, error):
+    if error is None:
+        inventory.check_output(output)
+    else:
+        with pytest.raises(ValueError, match=error):
+            inventory.check_output(output)
+
+
+@pytest.mark.parametrize('name, device, expected', [
+    ('sda', '/dev/sda', True),
+    ('sda', '/dev/sda2', True),
+    ('sda', '/dev/sdaa1', False),
+    ('sda', '/dev/sdb1', False),
+    ('nvme0n1', '/dev/nvme0n1p3', True),
+    ('nvme0n1', '/dev/nvme0n10', False),
+    ('nvme0n1', '/dev/nvme0n1p', False),
+    ('nvme0n1', 'nvme0n1', False),
+])
+def test_on_disk(name, device, expected):
+    assert inventory.on_disk(disk(name), device) is expected
+
+
+@pytest.mark.parametrize('disks, pvs, expected', [
+    ([disk('sda', ['/']), disk('sdb')], {}, {'sda': 'mounted on /'}),
+    ([disk('sda', ['/boot', '[SWAP]'])], {'/dev/sda2': 'rhel'}, {'sda': 'mounted on /boot, [SWAP]'}),
+    ([disk('sda'), disk('sdb')], {'/dev/sda3': 'rhel'}, {'sda': 'LVM PV of rhel'}),
+    ([disk('sda'), disk('sdb')], {'/dev/sdb': ''}, {'sdb': 'LVM PV of no volume group'}),
+    ([disk('sda'), disk('sdb')], {'/dev/sdb': 'ceph-0d2f'}, {}),
+    ([disk('sda'), disk('sdaa')], {'/dev/sdaa1': 'rhel'}, {'sdaa': 'LVM PV of rhel'}),
+    ([disk('nvme0n1'), disk('nvme0n10')], {'/dev/nvme0n10p1': 'data'}, {'nvme0n10': 'LVM PV of data'}),
+])
+def test_system_disks(disks, pvs, expected):
+    facts = inventory.HostInventory('h', 0, 'h', 1, 1, disks, [], list(set(pvs.values())),
+                                    [inventory.PhysicalVolume(name, vg) for name, vg in pvs.items()])
+    assert inventory.system_disks(facts) == expected
+
+
+def test_cache_round_trip(tmp_path):
+    cache = inventory.InventoryCache(str(tmp_path), ttl=60)
+    facts = inventory.parse_inventory('10.0.0.1:2222', collect_output())
+    cache._store(facts)
+    assert inventory.InventoryCache(str(tmp_path), ttl=60).get('10.0.0.1:2222') == facts
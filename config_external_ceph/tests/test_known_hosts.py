@@ -0,0 +1,48 @@
+import os
+import paramiko
+import pytest
+import known_hosts
+
+KEY = paramiko.ECDSAKey.generate()
+NEW_KEY = paramiko.ECDSAKey.generate()
+
+
+def line(name, key):
+    return f'{name} {key.get_name()} {key.get_base64()}'
+
+
+@pytest.mark.parametrize('lines, key, result, remaining', [
+    ([], KEY, 'added', 1),
+    ([line('host1', KEY)], KEY, 'current', 1),
+    ([line('host1', KEY), line('host1', KEY)], KEY, 'current', 1),
+    ([line('host1', KEY)], NEW_KEY, 'replaced', 1),
+    ([line('host1,10.0.0.1', KEY)], NEW_KEY, 'replaced', 2),
+    ([line(paramiko.HostKeys.hash_host('host1'), KEY)], NEW_KEY, 'replaced', 1),
+    ([line('host2', KEY)], KEY, 'added', 2),
+    (['# comment', line('host2', KEY)], NEW_KEY, 'added', 3),
+])
+def test_merge_host_keys(tmp_path, lines, key, result, remaining):
+    path = tmp_path / 'known_hosts'
+    path.write_text(''.join(f'{entry}\n' for entry in lines))
+    assert known_hosts.merge_host_keys({'host1': key}, str(path)) == {'host1': result}
+
+    merged = path.read_text().splitlines()
+    assert len(merged) == remaining
+    # Exactly one line names the host, with the merged key
+    named = [entry for entry in merged if known_hosts._names_host(entry, 'host1')]
+    assert [entry.split()[1:] for entry in named] == [[key.get_name(), key.get_base64()]]
+
+
+def test_merge_host_keys_keeps_current_file(tmp_path):
+    path = tmp_path / 'known_hosts'
+    path.write_text(line('[127.0.0.1]:2222', KEY) + '\n')
+    inode = os.stat(path).st_ino
+    assert known_hosts.merge_host_keys({'[127.0.0.1]:2222': KEY}, str(path)) == {'[127.0.0.1]:2222': 'current'}
+    assert os.stat(path).st_ino == inode
+
+
+def test_merge_host_keys_creates_file(tmp_path):
+    path = tmp_path / '.ssh' / 'known_hosts'
+    assert known_hosts.merge_host_keys({'host1': KEY, 'host2': NEW_KEY}, str(path)) == {'host1': 'added', 'host2': 'added'}
+    assert all(entry.startswith('|1|') for entry in path.read_text().splitlines())
+    assert os.stat(path).st_mode & 0o777 == 0o600
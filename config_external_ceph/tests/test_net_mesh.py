@@ -0,0 +1,28 @@
+import itertools
+import pytest
+import net_mesh
+
+
+@pytest.mark.parametrize('count', range(0, 10))
+def test_full_schedule(count):
+    hosts = [f'host{i}' for i in range(count)]
+    rounds = net_mesh.schedule(hosts, 'full')
+    assert len(rounds) == (0 if count < 2 else count - 1 if count % 2 == 0 else count)
+    for pairs in rounds:
+        # Every host sends and receives at most once per round
+        assert len({sender for sender, receiver in pairs}) == len(pairs)
+        assert len({receiver for sender, receiver in pairs}) == len(pairs)
+        # and the two hosts of a pair test each other at the same time
+        assert {(receiver, sender) for sender, receiver in pairs} == set(pairs)
+    tested = [pair for pairs in rounds for pair in pairs]
+    assert sorted(tested) == sorted(itertools.permutations(hosts, 2))
+
+
+@pytest.mark.parametrize('hosts, expected', [
+    ([], []),
+    (['a'], []),
+    (['a', 'b'], [[('a', 'b'), ('b', 'a')]]),
+    (['a', 'b', 'c'], [[('a', 'b'), ('b', 'c'), ('c', 'a')]]),
+])
+def test_ring_schedule(hosts, expected):
+    assert net_mesh.schedule(hosts, 'ring') == expected
@@ -0,0 +1,135 @@
+import pytest
+import inventory
+import osd_spec
+
+TB = 10 ** 12
+GiB = osd_spec.GiB
+
+
+def disk(name, size, rotational=False, model='', numa_node=0, mountpoints=()):
+    return inventory.Disk(name, size, rotational, model, '', numa_node, False, list(mountpoints))
+
+
+def host(disks, pvs=None, name='h1'):
+    pvs = pvs or {}
+    return inventory.HostInventory(name, 0, name, 64, 2, disks, [], list(set(pvs.values())),
+                                   [inventory.PhysicalVolume(pv, vg) for pv, vg in pvs.items()])
+
+
+def names(disks):
+    return [disk.name for disk in disks]
+
+
+def test_plan_host_hdd_with_nvme_db():
+    hdds = [disk(f'sd{letter}', 4 * TB, True, 'HDD') for letter in 'bcdefg']
+    nvmes = [disk('nvme0n1', 800 * 10 ** 9, model='NVME'), disk('nvme1n1', 800 * 10 ** 9, model='NVME', numa_node=1)]
+    facts = host([disk('sda', 480 * 10 ** 9, mountpoints=['/'])] + hdds + nvmes)
+    plan = osd_spec.plan_host(facts, 3 * TB, 2)
+
+    [layout] = plan.layouts
+    assert names(layout.data) == names(hdds) and names(layout.db) == names(nvmes)
+    assert layout.osds_per_device == 1
+    # 3 DBs per NVMe out of what is left once LVM has its metadata
+    assert layout.block_db_size == (800 * 10 ** 9 - osd_spec.LVM_RESERVE) // 3 // GiB * GiB
+    assert [(skipped.name, reason) for skipped, reason in plan.skipped] == [('sda', 'mounted on /')]
+    assert names(plan.available) == names(hdds + nvmes)
+    # 4 TB drives need 40G of DB, 248G is plenty, and both NUMA nodes have a DB device
+    assert plan.warnings == []
+
+
+@pytest.mark.parametrize('disks, expected', [
+    # One media: no DB devices, large NVMe drives get several OSDs
+    ([disk('nvme0n1', 4 * TB), disk('nvme1n1', 4 * TB)], [(['nvme0n1', 'nvme1n1'], [], 2)]),
+    ([disk('nvme0n1', 2 * TB), disk('nvme1n1', 4 * TB)], [(['nvme0n1', 'nvme1n1'], [], 1)]),
+    ([disk('sdb', 2 * TB, True), disk('sdc', 2 * TB, True)], [(['sdb', 'sdc'], [], 1)]),
+    # Three media: SATA SSDs in between are OSDs of their own
+    ([disk('sdb', 8 * TB, True), disk('sdc', TB), disk('nvme0n1', TB)],
+     [(['sdb'], ['nvme0n1'], 1), (['sdc'], [], 1)]),
+    # Drives too small for an OSD do not become data or DB devices
+    ([disk('sdb', 8 * TB, True), disk('sdc', 16 * GiB)], [(['sdb'], [], 1)]),
+])
+def test_plan_host_layouts(disks, expected):
+    plan = osd_spec.plan_host(host(disks), 3 * TB, 2)
+    assert [(names(layout.data), names(layout.db), layout.osds_per_device) for layout in plan.layouts] == expected
+
+
+@pytest.mark.parametrize('disks, warning', [
+    ([disk('sda', 480 * 10 ** 9, mountpoints=['/'])], 'no drive for an OSD'),
+    ([disk(f'sd{letter}', 16 * TB, True) for letter in 'bcdefgh'] + [disk('sdi', 480 * 10 ** 9)],
+     '7 hdd drives per ssd DB device, more than the 5 it serves well'),
+    ([disk('sdb', 16 * TB, True), disk('nvme0n1', 100 * 10 ** 9)], 'RocksDB will spill over'),
+    ([disk('sdb', 4 * TB, True), disk('nvme0n1', TB), disk('nvme1n1', TB)], '2 nvme DB devices for 1 hdd drives, some stay idle'),
+    ([disk('sdb', 4 * TB, True, numa_node=1), disk('nvme0n1', TB, numa_node=0)], '1 hdd drives on NUMA node 1 have their DB on another node'),
+])
+def test_plan_host_warnings(disks, warning):
+    plan = osd_spec.plan_host(host(disks), 3 * TB, 2)
+    assert any(warning in entry for entry in plan.warnings), plan.warnings
+
+
+def test_plan_host_skips_non_ceph_pvs():
+    facts = host([disk('sda', TB), disk('sdb', TB), disk('sdc', TB)], {'/dev/sda2': 'rhel', '/dev/sdb': 'ceph-1'})
+    plan = osd_spec.plan_host(facts, 3 * TB, 2)
+    assert [(skipped.name, reason) for skipped, reason in plan.skipped] == [('sda', 'LVM PV of rhel')]
+    assert names(plan.layouts[0].data) == ['sdb', 'sdc']
+
+
+@pytest.mark.parametrize('selected, host_disks, expected', [
+    # All drives of their kind
+    (['sdb', 'sdc'], ['sdb', 'sdc', 'nvme0n1'], {'rotational': 1}),
+    (['nvme0n1'], ['sdb', 'sdc', 'nvme0n1'], {'rotational': 0}),
+    # A model no other drive has
+    (['nvme0n1'], ['nvme0n1', 'sdb', 'sdd'], {'model': 'NVME'}),
+    # A drive skipped as too small shares both, only paths are exact
+    (['nvme0n1', 'nvme1n1'], ['nvme0n1', 'nvme1n1', 'nvme9n1'], {'paths': ['/dev/nvme0n1', '/dev/nvme1n1']}),
+    # Drives without a model
+    (['sdd'], ['sdd', 'sde'], {'paths': ['/dev/sdd']}),
+])
+def test_device_filter(selected, host_disks, expected):
+    drives = {
+        'sdb': disk('sdb', 4 * TB, True, 'HDD'), 'sdc': disk('sdc', 4 * TB, True, 'HDD'),
+        'sdd': disk('sdd', TB), 'sde': disk('sde', TB),
+        'nvme0n1': disk('nvme0n1', TB, model='NVME'), 'nvme1n1': disk('nvme1n1', TB, model='NVME'),
+        'nvme9n1': disk('nvme9n1', 16 * GiB, model='NVME'),
+    }
+    assert osd_spec.device_filter([drives[name] for name in selected], [drives[name] for name in host_disks]) == expected
+
+
+def test_build_and_render_specs():
+    def hybrid(name, small=False):
+        disks = [disk('sdb', 4 * TB, True, 'HDD'), disk('sdc', 4 * TB, True, 'HDD'), disk('nvme0n1', TB, model='NVME')]
+        if small:
+            disks.append(disk('nvme1n1', 16 * GiB, model='NVME'))
+        return osd_spec.plan_host(host(disks, name=name), 3 * TB, 2)
+
+    plans = [hybrid('h1'), hybrid('h2'), hybrid('h3', small=True),
+             osd_spec.plan_host(host([disk('nvme0n1', 4 * TB)], name='h4'), 3 * TB, 2)]
+    specs = osd_spec.build_specs(plans)
+    assert [(spec['service_id'], spec['placement']['hosts']) for spec in specs] == [
+        ('hdd_nvme_db', ['h1', 'h2']), ('hdd_nvme_db_2', ['h3']), ('nvme', ['h4'])]
+    assert specs[1]['spec']['db_devices'] == {'paths': ['/dev/nvme0n1']}
+
+    assert osd_spec.render_specs(specs[:1] + specs[2:]) == (
+        '---\n'
+        'service_type: osd\n'
+        'service_id: hdd_nvme_db\n'
+        'placement:\n'
+        '  hosts:\n'
+        '    - h1\n'
+        '    - h2\n'
+        'spec:\n'
+        '  data_devices:\n'
+        '    rotational: 1\n'
+        '  db_devices:\n'
+        '    rotational: 0\n'
+        "  block_db_size: '465G'\n"
+        '---\n'
+        'service_type: osd\n'
+        'service_id: nvme\n'
+        'placement:\n'
+        '  hosts:\n'
+        '    - h4\n'
+        'spec:\n'
+        '  data_devices:\n'
+        '    rotational: 0\n'
+        '  osds_per_device: 2\n'
+    )
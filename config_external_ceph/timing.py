@@ -0,0 +1,238 @@
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+
+class Tracer:
+    """
+    Records timing spans of remote operations tagged by host and step, and exports
+    them as a Chrome trace / Perfetto JSON file and as a per-step summary table.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.monotonic()
+        self._wall_origin = time.time()
+
+    def enable(self):
+        """
+        Starts recording spans.
+
+        Returns:
+        None
+        """
+        self.enabled = True
+
+    def current_step(self):
+        """
+        Returns the name of the step the calling thread is working on.
+
+        Returns:
+        str: The step name, None outside of a step.
+        """
+        return getattr(self._local, 'step', None)
+
+    @contextlib.contextmanager
+    def step(self, name, host):
+        """
+        Times a step on a host. Spans recorded by the thread inside the step are
+        tagged with its name.
+
+        Parameters:
+        name (str): The name of the step.
+        host (str): The hostname or IP address of the host.
+        """
+        previous = self.current_step()
+        self._local.step = name
+        try:
+            with self.span('step', host):
+                yield
+        finally:
+            self._local.step = previous
+
+    @contextlib.contextmanager
+    def span(self, kind, host, **details):
+        """
+        Times an operation on a host.
+
+        Parameters:
+        kind (str): The kind of operation, e.g. 'connect', 'auth', 'exec', 'transfer' or 'wait'.
+        host (str): The hostname or IP address of the host.
+        **details: Extra values shown with the span in the trace viewer.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start = time.monotonic()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.add_span(kind, host, start, time.monotonic() - start, failed, **details)
+
+    def add_span(self, kind, host, start, duration, failed=False, step=None, **details):
+        """
+        Records an operation that was timed by the caller.
+
+        Parameters:
+        kind (str): The kind of operation.
+        host (str): The hostname or IP address of the host.
+        start (float): The time.monotonic() the operation started at.
+        duration (float): The number of seconds the operation took.
+        failed (bool): Whether the operation failed.
+        step (str): The step the operation belongs to, the calling thread's step if not given.
+        **details: Extra values shown with the span in the trace viewer.
+
+        Returns:
+        None
+        """
+        if not self.enabled:
+            return
+        record = {'kind': kind, 'host': host, 'step': step or self.current_step() or '-', 'start': start - self._origin,
+                  'duration': duration, 'thread': threading.get_ident(), 'failed': failed, 'details': details}
+        with self._lock:
+            self._spans.append(record)
+
+    def spans(self):
+        """
+        Returns a copy of the recorded spans.
+
+        Returns:
+        list: One dict per span with kind, host, step, start, duration, thread, failed and details.
+        """
+        with self._lock:
+            return list(self._spans)
+
+    def export_chrome_trace(self, path):
+        """
+        Writes the spans in the Chrome trace event format, which chrome://tracing
+        and ui.perfetto.dev open. Every host is shown as its own track.
+
+        Parameters:
+        path (str): The file to write.
+
+        Returns:
+        None
+        """
+        spans = self.spans()
+        hosts = sorted({span['host'] for span in spans})
+        track = {host: index + 1 for index, host in enumerate(hosts)}
+
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'hosts'}}]
+        for host in hosts:
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': track[host], 'args': {'name': host}})
+        for span in spans:
+            name = span['step'] if span['kind'] == 'step' else span['kind']
+            args = dict(span['details'], step=span['step'], failed=span['failed'])
+            events.append({'name': name, 'cat': span['kind'], 'ph': 'X', 'pid': 1, 'tid': track[span['host']],
+                           'ts': span['start'] * 1e6, 'dur': span['duration'] * 1e6, 'args': args})
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._wall_origin))}}, f)
+        os.replace(tmp_path, path)
+
+    def summary(self, slowest=5):
+        """
+        Builds the per-step summary table: count, p50, p95 and max duration of every
+        step and operation kind, and the hosts that spent the most time in it.
+
+        Parameters:
+        slowest (int): The number of slowest hosts listed per row.
+
+        Returns:
+        str: The table.
+        """
+        groups = {}
+        for span in self.spans():
+            key = (span['step'], span['kind'])
+            groups.setdefault(key, []).append(span)
+
+        rows = [('step', 'operation', 'count', 'p50 s', 'p95 s', 'max s', 'slowest hosts')]
+        for (step, kind), spans in sorted(groups.items()):
+            durations = sorted(span['duration'] for span in spans)
+            per_host = {}
+            for span in spans:
+                per_host[span['host']] = per_host.get(span['host'], 0) + span['duration']
+            hosts = sorted(per_host, key=per_host.get, reverse=True)[:slowest]
+            rows.append((step, kind, str(len(durations)), f'{percentile(durations, 50):.2f}',
+                         f'{percentile(durations, 95):.2f}', f'{durations[-1]:.2f}',
+                         ', '.join(f'{host} ({per_host[host]:.1f}s)' for host in hosts)))
+
+        widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+        return '\n'.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows)
+
+
+def percentile(sorted_values, percent):
+    """
+    Returns the nearest-rank percentile of sorted values.
+
+    Parameters:
+    sorted_values (list): The values, sorted ascending.
+    percent (float): The percentile, between 0 and 100.
+
+    Returns:
+    float: The percentile, 0 for no values.
+    """
+    if not sorted_values:
+        return 0
+    rank = max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+# Spans of every remote operation of the config_external_ceph scripts
+tracer = Tracer()
+
+
+def add_arguments(parser):
+    """
+    Adds the tracing options shared by the config_external_ceph scripts.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('--trace', metavar='FILE', help='Record the time of every remote operation, write them as a Chrome trace / Perfetto JSON file and print a per-step summary')
+
+
+def start(args):
+    """
+    Enables the tracer when the script was asked for a trace.
+
+    Parameters:
+    args (argparse.Namespace): The parsed arguments of the script.
+
+    Returns:
+    None
+    """
+    if args.trace:
+        tracer.enable()
+
+
+def finish(args):
+    """
+    Writes the trace file and prints the summary when the script was asked for a trace.
+
+    Parameters:
+    args (argparse.Namespace): The parsed arguments of the script.
+
+    Returns:
+    None
+    """
+    if args.trace:
+        tracer.export_chrome_trace(args.trace)
+        print(tracer.summary())
+        print(f'Trace written to {args.trace}, open it with ui.perfetto.dev or chrome://tracing')
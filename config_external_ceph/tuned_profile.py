@@ -0,0 +1,158 @@
+import math
+import re
+import shlex
+import ssh_pool
+
+DEFAULT_RTT_MS = 1.0
+# Kernel defaults the rendered values never go below
+MIN_BUFFER = 212992
+MIN_BUDGET = 300
+MIN_BACKLOG = 1000
+# Past these a softirq run holds the CPU too long and the backlog only adds latency
+MAX_BUDGET = 6000
+MAX_BACKLOG = 100000
+
+
+def bond_slaves(facts, bond_name='bond0'):
+    """
+    Returns the interfaces carrying the host's Ceph traffic: the slaves of the bond,
+    or the ens* interfaces that will be bonded when there is no bond yet.
+
+    Parameters:
+    facts (inventory.HostInventory): The facts of the host.
+    bond_name (str): The name of the bond interface.
+
+    Returns:
+    list: The Interface records.
+    """
+    slaves = [interface for interface in facts.interfaces if interface.master == bond_name]
+    return slaves or [interface for interface in facts.interfaces if interface.name.startswith('ens')]
+
+
+def compute_sysctls(facts, rtt_ms=DEFAULT_RTT_MS):
+    """
+    Sizes the network sysctls of a host from its facts.
+
+    The socket buffers hold twice the bandwidth-delay product of the whole bond, as
+    the kernel keeps part of every buffer for bookkeeping. The backlog and the
+    softirq budget grow with the bandwidth (100 packets and 20 packets per Gbit/s,
+    which gives the values of the baseline template on 2x25G), and the budget also
+    grows when a CPU of the NIC's NUMA node has to serve several receive queues.
+
+    Parameters:
+    facts (inventory.HostInventory): The facts of the host.
+    rtt_ms (float): The round trip time between the hosts in milliseconds.
+
+    Returns:
+    tuple: The sysctl values by name, and a one line description of the hardware they were sized for. Empty when the link speed is unknown.
+    """
+    slaves = [interface for interface in bond_slaves(facts) if interface.speed > 0]
+    if not slaves:
+        return {}, 'link speed unknown'
+
+    speed_mbit = sum(interface.speed for interface in slaves)
+    gbit = speed_mbit / 1000
+    rx_queues = sum(max(interface.rx_queues, 1) for interface in slaves)
+    local_cpus = max(facts.cpus // max(facts.numa_nodes, 1), 1)
+    queues_per_cpu = math.ceil(rx_queues / local_cpus)
+
+    buffer = max(int(2 * speed_mbit * 1e6 / 8 * rtt_ms / 1000), MIN_BUFFER)
+    budget = min(max(int(round(gbit * 20 / 100) * 100) * queues_per_cpu, MIN_BUDGET), MAX_BUDGET)
+    backlog = min(max(int(gbit * 100), MIN_BACKLOG), MAX_BACKLOG)
+
+    sysctls = {
+        'net.core.rmem_max': str(buffer),
+        'net.core.wmem_max': str(buffer),
+        'net.core.wmem_default': str(max(buffer // 4, MIN_BUFFER)),
+        'net.ipv4.tcp_rmem': f'4096 131072 {buffer}',
+        'net.ipv4.tcp_wmem': f'4096 16384 {buffer}',
+        'net.core.netdev_budget': str(budget),
+        'net.core.netdev_max_backlog': str(backlog),
+    }
+    description = (f'{len(slaves)}x{slaves[0].speed} Mb/s' if len({interface.speed for interface in slaves}) == 1
+                   else '+'.join(str(interface.speed) for interface in slaves) + ' Mb/s')
+    description += f', {rx_queues} rx queues, {facts.cpus} CPUs on {facts.numa_nodes} NUMA node(s), RTT {rtt_ms} ms'
+    return sysctls, description
+
+
+def render_profile(template, facts, rtt_ms=DEFAULT_RTT_MS):
+    """
+    Renders the tuned profile of a host from the baseline template, replacing the
+    network sysctls with the values sized for the host and adding the ones the
+    template does not have. Everything else is kept as it is.
+
+    Parameters:
+    template (str): The content of the baseline tuned.conf.
+    facts (inventory.HostInventory): The facts of the host.
+    rtt_ms (float): The round trip time between the hosts in milliseconds.
+
+    Returns:
+    tuple: The rendered profile, and every sysctl it sets by name.
+    """
+    computed, description = compute_sysctls(facts, rtt_ms)
+    pending = dict(computed)
+    lines = [f'# Rendered for {facts.host}: {description}']
+    section = None
+    last_sysctl = None
+    sysctls = {}
+
+    for line in template.splitlines():
+        header = re.match(r'\s*\[(\w+)\]', line)
+        if header:
+            section = header.group(1)
+        elif section == 'sysctl' and '=' in line and not line.lstrip().startswith('#'):
+            name, value = (field.strip() for field in line.split('=', 1))
+            if name in pending:
+                value = pending.pop(name)
+                line = f'{name} = {value}'
+            sysctls[name] = value
+            last_sysctl = len(lines)
+        lines.append(line)
+
+    # The values the template does not set go right after its last sysctl, or in a section of their own
+    added = [f'{name} = {value}' for name, value in pending.items()]
+    sysctls.update(pending)
+    if last_sysctl is not None:
+        lines[last_sysctl + 1:last_sysctl + 1] = added
+    elif added:
+        lines += ['[sysctl]'] + added
+    return '\n'.join(lines) + '\n', sysctls
+
+
+def read_sysctls(host, names):
+    """
+    Reads the live values of sysctls on a host in one command.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    names (list): The sysctl names.
+
+    Returns:
+    dict: The live value of every sysctl that exists, with whitespace normalized.
+    """
+    exit_status, output, error = ssh_pool.pool.exec_command(host, f"sysctl {' '.join(shlex.quote(name) for name in names)}")
+    values = {}
+    for line in output.splitlines():
+        name, sep, value = line.partition(' = ')
+        if sep:
+            values[name.strip()] = ' '.join(value.split())
+    return values
+
+
+def verify_sysctls(host, expected):
+    """
+    Checks that the sysctls of the rendered profile are live on a host.
+
+    Parameters:
+    host (str): The hostname or IP address of the remote host.
+    expected (dict): The sysctl values by name.
+
+    Returns:
+    str: The number of values checked.
+    """
+    live = read_sysctls(host, list(expected))
+    mismatches = [f'{name} is {live.get(name, "missing")}, expected {value}' for name, value in expected.items()
+                  if live.get(name) != ' '.join(value.split())]
+    if mismatches:
+        raise RuntimeError(f'{len(mismatches)} sysctl(s) not live: {"; ".join(mismatches)}')
+    return f'{len(expected)} sysctl values live'
@@ -0,0 +1,79 @@
+import time
+import fanout
+import ssh_pool
+from timing import tracer
+
+
+def wait_for(check, hosts, timeout, interval=1, max_interval=10, progress=None, step='wait'):
+    """
+    Polls a condition on all hosts concurrently until every host meets it or the
+    deadline passes. Each host is polled on its own schedule, starting at interval
+    and doubling up to max_interval while it is not ready, and stops being polled
+    the moment it is ready.
+
+    Parameters:
+    check (callable): Called as check(host), returns True when the host is ready. An exception counts as not ready.
+    hosts (list): The hostnames or IP addresses to wait for.
+    timeout (float): The number of seconds to wait for the slowest host.
+    interval (float): The number of seconds between the first polls of a host.
+    max_interval (float): The longest number of seconds between two polls of a host.
+    progress (callable): Optional, called as progress(ready, hosts) whenever more hosts became ready.
+    step (str): The step name the polls and waiting times are traced under.
+
+    Returns:
+    tuple: A dict with the number of seconds each ready host took, and the list of hosts that never got ready.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    next_poll = {host: start for host in hosts}
+    delay = {host: interval for host in hosts}
+    ready = {}
+
+    def poll(host):
+        try:
+            return bool(check(host))
+        except Exception:
+            return False
+
+    while next_poll:
+        now = time.monotonic()
+        due = [host for host, when in next_poll.items() if when <= now]
+        if due:
+            results = fanout.engine.run(poll, due, step=step)
+            now = time.monotonic()
+            for host, result in results.items():
+                if result is True:
+                    ready[host] = now - start
+                    del next_poll[host]
+                    tracer.add_span('wait', host, start, now - start, step=step)
+                else:
+                    next_poll[host] = now + delay[host]
+                    delay[host] = min(delay[host] * 2, max_interval)
+            if progress is not None and any(results[host] is True for host in due):
+                progress(ready, hosts)
+
+        if not next_poll or now >= deadline:
+            break
+        time.sleep(max(0, min(min(next_poll.values()), deadline) - time.monotonic()))
+
+    stragglers = [host for host in hosts if host not in ready]
+    for host in stragglers:
+        tracer.add_span('wait', host, start, time.monotonic() - start, failed=True, step=step)
+    return ready, stragglers
+
+
+def remote_probe(command, timeout=None):
+    """
+    Builds a check for wait_for that is met when a remote command exits 0.
+
+    Parameters:
+    command (str): The command to run on the host over the shared SSH pool.
+    timeout (float): Optional connect and command timeout of a single poll.
+
+    Returns:
+    callable: The check.
+    """
+    def check(host):
+        exit_status, output, error = ssh_pool.pool.exec_command(host, command, timeout=timeout)
+        return exit_status == 0
+    return check
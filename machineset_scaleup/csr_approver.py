@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import concurrent.futures
+import threading
+import time
+import kube_api
+import render_inventory
+
+CSR_PATH = '/apis/certificates.k8s.io/v1/certificatesigningrequests'
+NODES_PATH = '/api/v1/nodes'
+BOOTSTRAPPER = 'system:serviceaccount:openshift-machine-config-operator:node-bootstrapper'
+CLIENT_SIGNER = 'kubernetes.io/kube-apiserver-client-kubelet'
+SERVING_SIGNER = 'kubernetes.io/kubelet-serving'
+NODE_PREFIX = 'system:node:'
+COMMON_NAME_OID = bytes.fromhex('550403')
+
+
+def _der_element(data, offset):
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    return tag, data[offset:offset + length], offset + length
+
+
+def _der_children(data):
+    offset = 0
+    while offset < len(data):
+        tag, value, offset = _der_element(data, offset)
+        yield tag, value
+
+
+def csr_common_name(request):
+    """
+    Reads the subject common name of a certificate signing request, without a
+    crypto library: only the DER structure up to the subject is parsed.
+
+    Parameters:
+    request (str): The spec.request of a CertificateSigningRequest, a base64 encoded PEM CSR.
+
+    Returns:
+    str: The common name, None if the request has none.
+    """
+    pem = base64.b64decode(request).decode()
+    body = ''.join(line for line in pem.splitlines() if line and not line.startswith('-----'))
+    der = base64.b64decode(body)
+    # CertificationRequest ::= SEQUENCE { certificationRequestInfo SEQUENCE { version, subject, ... }, ... }
+    tag, csr, end = _der_element(der, 0)
+    tag, info, end = _der_element(csr, 0)
+    version, subject = list(_der_children(info))[:2]
+    for tag, rdn in _der_children(subject[1]):
+        for tag, attribute in _der_children(rdn):
+            (oid_tag, oid), (value_tag, value) = list(_der_children(attribute))[:2]
+            if oid == COMMON_NAME_OID:
+                return value.decode()
+    return None
+
+
+def short_name(name):
+    return name.split('.')[0]
+
+
+def is_pending(csr):
+    return not any(condition.get('type') in ('Approved', 'Denied')
+                   for condition in csr.get('status', {}).get('conditions', []) or [])
+
+
+def node_of(csr, expected):
+    """
+    Decides whether a CSR belongs to one of the new workers: a client certificate
+    requested by the node bootstrapper, or a serving certificate requested by the
+    node itself, with a common name of system:node:<expected worker>.
+
+    Parameters:
+    csr (dict): The CertificateSigningRequest.
+    expected (set): The short names of the new workers.
+
+    Returns:
+    tuple: The worker the CSR belongs to (None if it does not qualify) and the reason.
+    """
+    spec = csr.get('spec', {})
+    try:
+        common_name = csr_common_name(spec['request']) or ''
+    except (KeyError, ValueError, IndexError, UnicodeDecodeError):
+        return None, 'unreadable request'
+    if not common_name.startswith(NODE_PREFIX):
+        return None, f'common name {common_name} is not a node'
+    node = short_name(common_name[len(NODE_PREFIX):])
+    if node not in expected:
+        return None, f'{node} is not a new worker'
+    if spec.get('signerName') == CLIENT_SIGNER and spec.get('username') == BOOTSTRAPPER:
+        return node, 'client'
+    if spec.get('signerName') == SERVING_SIGNER and spec.get('username') == common_name:
+        return node, 'serving'
+    return None, f"signer {spec.get('signerName')} requested by {spec.get('username')}"
+
+
+def approve(api, csr):
+    """
+    Approves a CSR through its approval subresource, like oc adm certificate approve.
+
+    Parameters:
+    api (kube_api.KubeAPI): The client.
+    csr (dict): The CertificateSigningRequest.
+
+    Returns:
+    str: The name of the CSR.
+    """
+    name = csr['metadata']['name']
+    csr.setdefault('status', {})
+    csr['status']['conditions'] = (csr['status'].get('conditions') or []) + [{
+        'type': 'Approved', 'status': 'True', 'reason': 'ScaleUpApprove',
+        'message': 'Approved by csr_approver.py for a new worker',
+        'lastUpdateTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }]
+    api.put(f'{CSR_PATH}/{name}/approval', csr)
+    return name
+
+
+def is_ready(node):
+    return any(condition.get('type') == 'Ready' and condition.get('status') == 'True'
+               for condition in node.get('status', {}).get('conditions', []))
+
+
+class Approver:
+    """
+    Follows the CSRs and nodes of the cluster and approves the certificates of the
+    expected workers as they are requested, until all of them are Ready.
+    """
+
+    def __init__(self, api, expected, batch_window=1.0, workers=16, max_attempts=5):
+        self.api = api
+        self.expected = set(expected)
+        self.batch_window = batch_window
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.pending = {}
+        self.approved = set()
+        self.attempts = {}
+        self.given_up = {}
+        self.ready = set()
+        self.changed = threading.Condition()
+
+    def on_csr(self, event_type, csr):
+        if event_type == 'DELETED' or not is_pending(csr):
+            return
+        name = csr['metadata']['name']
+        node, reason = node_of(csr, self.expected)
+        with self.changed:
+            if node is None or name in self.approved or name in self.pending or name in self.given_up:
+                return
+            self.pending[name] = (node, reason, csr)
+            self.changed.notify_all()
+
+    def on_node(self, event_type, node):
+        name = short_name(node['metadata']['name'])
+        if name not in self.expected:
+            return
+        with self.changed:
+            if event_type != 'DELETED' and is_ready(node):
+                self.ready.add(name)
+            else:
+                self.ready.discard(name)
+            self.changed.notify_all()
+
+    def run(self, timeout=None):
+        """
+        Approves in batches: the CSRs that arrive within batch_window of each other
+        are approved together in parallel.
+
+        Parameters:
+        timeout (float): The number of seconds to wait for all workers to be Ready, no limit if None.
+
+        Returns:
+        set: The expected workers that are not Ready.
+        """
+        def settled():
+            # A worker with a CSR that was given up on does not become Ready without help
+            return self.ready | set(self.given_up.values()) >= self.expected
+
+        stop = threading.Event()
+        kube_api.start_informer(self.api, CSR_PATH, self.on_csr, stop)
+        kube_api.start_informer(self.api, NODES_PATH, self.on_node, stop)
+        deadline = time.monotonic() + timeout if timeout else None
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while True:
+                with self.changed:
+                    while not self.pending and not settled():
+                        remaining = deadline - time.monotonic() if deadline else None
+                        if remaining is not None and remaining <= 0:
+                            return self.expected - self.ready
+                        self.changed.wait(min(remaining, 10) if remaining is not None else 10)
+                    if self.ready == self.expected:
+                        print(f'all {len(self.expected)} new workers are Ready, {len(self.approved)} CSRs approved')
+                        return set()
+                    if not self.pending and settled():
+                        return self.expected - self.ready
+                # Let the rest of a burst arrive, the CSRs of a wave come within seconds
+                time.sleep(self.batch_window)
+                with self.changed:
+                    batch, self.pending = self.pending, {}
+                results = executor.map(lambda item: self._approve(*item), batch.items())
+                approved = [name for name in results if name]
+                kinds = sorted({reason for node, reason, csr in batch.values()})
+                print(f"approved {len(approved)}/{len(batch)} {' and '.join(kinds)} CSRs, "
+                      f"{len(self.ready)}/{len(self.expected)} new workers Ready")
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def _approve(self, name, item):
+        node, reason, csr = item
+        try:
+            approve(self.api, csr)
+        except kube_api.APIError as e:
+            if e.code != 409:
+                return self._retry(name, item, e)
+            # The CSR changed since it was listed, approve the current version
+            try:
+                csr = self.api.get(f'{CSR_PATH}/{name}')
+            except kube_api.APIError as e:
+                if e.code == 404:
+                    print(f"{reason} CSR '{name}' of {node} was deleted before it was approved")
+                    return None
+                return self._retry(name, item, e)
+            except Exception as e:
+                return self._retry(name, item, e)
+            if not is_pending(csr):
+                # Approved or denied by someone else in the meantime
+                print(f"{reason} CSR '{name}' of {node} is no longer pending")
+                return None
+            return self._retry(name, (node, reason, csr), None)
+        except Exception as e:
+            return self._retry(name, item, e)
+        with self.changed:
+            self.approved.add(name)
+        return name
+
+    def _retry(self, name, item, error):
+        """
+        Queues a CSR that could not be approved again, after a back off growing with
+        every failed attempt, and gives up on it after max_attempts.
+
+        Parameters:
+        name (str): The name of the CSR.
+        item (tuple): The worker, the reason and the CSR to approve next time.
+        error (Exception): The error of the attempt, None for a CSR that changed and is retried right away.
+
+        Returns:
+        None
+        """
+        node, reason, csr = item
+        with self.changed:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            attempts = self.attempts[name]
+            if attempts >= self.max_attempts:
+                self.given_up[name] = node
+        if attempts >= self.max_attempts:
+            print(f"Error approving {reason} CSR '{name}' of {node}: {str(error) if error else 'it kept changing'}, "
+                  f"giving up after {attempts} attempts, approve it with oc adm certificate approve {name}")
+            return None
+        delay = 0 if error is None else min(2 ** attempts, 30)
+        if error is not None:
+            print(f"Error approving {reason} CSR '{name}' of {node}: {str(error)}, retrying in {delay} seconds")
+
+        # Nothing else announces the CSR again, queue it for a later batch
+        def queue():
+            with self.changed:
+                self.pending.setdefault(name, item)
+                self.changed.notify_all()
+        timer = threading.Timer(delay, queue)
+        timer.daemon = True
+        timer.start()
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Approve the certificates of new workers as they are requested, until they are Ready')
+    parser.add_argument('-j', '--json-inventory', required=True, help='The scale lab JSON inventory with the nodes being added')
+    parser.add_argument('-e', '--existing-workers', type=int, required=True, help='The number of workers in the cluster before the scale up')
+    parser.add_argument('--timeout', type=float, default=None, help='The number of seconds to wait for the new workers to be Ready')
+    parser.add_argument('--batch-window', type=float, default=1.0, help='The number of seconds to collect CSRs before approving them together')
+    parser.add_argument('--max-attempts', type=int, default=5, help='The number of failed approvals after which a CSR is given up on')
+    kube_api.add_arguments(parser)
+    args = parser.parse_args()
+
+    workers = render_inventory.plan_workers(render_inventory.load_inventory(args.json_inventory), args.existing_workers)
+    api = kube_api.connect(args)
+    try:
+        missing = Approver(api, [worker['name'] for worker in workers], args.batch_window, max_attempts=args.max_attempts).run(args.timeout)
+    finally:
+        api.close()
+    if missing:
+        print(f"{len(missing)} new workers not Ready: {', '.join(sorted(missing))}")
+        raise SystemExit(1)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import copy
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CSR_PATH = '/apis/certificates.k8s.io/v1/certificatesigningrequests'
+NODES_PATH = '/api/v1/nodes'
+NAMESPACE_PATH = '/api/v1/namespaces/openshift-machine-api'
+SECRETS_PATH = f'{NAMESPACE_PATH}/secrets'
+BMH_PATH = '/apis/metal3.io/v1alpha1/namespaces/openshift-machine-api/baremetalhosts'
+MACHINESETS_PATH = '/apis/machine.openshift.io/v1beta1/namespaces/openshift-machine-api/machinesets'
+BOOTSTRAPPER = 'system:serviceaccount:openshift-machine-config-operator:node-bootstrapper'
+# The BareMetalHost states that keep ironic busy with DHCP, TFTP and agent traffic
+BUSY_STATES = ('inspecting', 'provisioning')
+
+
+def _der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        header = bytes([tag, length])
+    else:
+        size = (length.bit_length() + 7) // 8
+        header = bytes([tag, 0x80 | size]) + length.to_bytes(size, 'big')
+    return header + content
+
+
+def fake_csr_request(common_name, organization='system:nodes'):
+    """
+    Builds the spec.request of a CSR with the given subject. Only the structure is
+    real, the key and signature are filler, the fake API server does not verify them.
+
+    Parameters:
+    common_name (str): The subject common name, e.g. system:node:worker001.
+    organization (str): The subject organization.
+
+    Returns:
+    str: The base64 encoded PEM CSR.
+    """
+    def attribute(oid, value):
+        return _der(0x31, _der(0x30, _der(0x06, bytes.fromhex(oid)) + _der(0x0c, value.encode())))
+
+    subject = _der(0x30, attribute('55040a', organization) + attribute('550403', common_name))
+    key = _der(0x30, _der(0x30, _der(0x06, bytes.fromhex('2a8648ce3d0201'))) + _der(0x03, b'\0' + b'\4' * 65))
+    info = _der(0x30, _der(0x02, b'\0') + subject + key + _der(0xa0, b''))
+    der = _der(0x30, info + _der(0x30, _der(0x06, bytes.fromhex('2a8648ce3d040302'))) + _der(0x03, b'\0' + b'\1' * 70))
+    body = base64.b64encode(der).decode()
+    pem = '-----BEGIN CERTIFICATE REQUEST-----\n' + '\n'.join(body[i:i + 64] for i in range(0, len(body), 64)) + '\n-----END CERTIFICATE REQUEST-----\n'
+    return base64.b64encode(pem.encode()).decode()
+
+
+class FakeCluster:
+    """
+    The state of a simulated cluster scaling up: every new worker requests its client
+    certificate, joins as a NotReady node once it is approved, requests its serving
+    certificate and turns Ready once that one is approved, like a kubelet does.
+
+    Registered BareMetalHosts go through registering, inspecting, available,
+    provisioning and provisioned, and are provisioned as the machineset's replicas
+    ask for them. When more than capacity hosts inspect or provision at the same
+    time, the extra ones hit a simulated DHCP/TFTP timeout and retry their phase.
+    A provisioned host boots and starts requesting its certificates.
+    """
+
+    def __init__(self, workers, join_delay=0.5, ready_delay=0.5, phase_delay=1.0, capacity=20, retry_delay=3.0,
+                 machineset='scale-test-worker', replicas=0):
+        self.workers = list(workers)
+        self.join_delay = join_delay
+        self.ready_delay = ready_delay
+        self.phase_delay = phase_delay
+        self.capacity = capacity
+        self.retry_delay = retry_delay
+        self.collections = {CSR_PATH: {}, NODES_PATH: {}, SECRETS_PATH: {}, BMH_PATH: {}, MACHINESETS_PATH: {}}
+        self.events = []
+        self.version = 0
+        self.changed = threading.Condition()
+        self.requests = 0
+        self.base_replicas = replicas
+        self.retries = 0
+        self.store(MACHINESETS_PATH, {'metadata': {'name': machineset}, 'spec': {'replicas': replicas}})
+
+    def store(self, path, obj, event_type=None):
+        """
+        Adds or replaces an object and records the watch event.
+
+        Parameters:
+        path (str): The API path of the collection.
+        obj (dict): The object.
+        event_type (str): ADDED or MODIFIED, guessed if not given.
+
+        Returns:
+        dict: The stored object with its new resource version.
+        """
+        with self.changed:
+            self.version += 1
+            obj = copy.deepcopy(obj)
+            obj['metadata']['resourceVersion'] = str(self.version)
+            name = obj['metadata']['name']
+            event_type = event_type or ('MODIFIED' if name in self.collections[path] else 'ADDED')
+            self.collections[path][name] = obj
+            self.events.append((self.version, path, event_type, obj))
+            self.changed.notify_all()
+            return obj
+
+    def request_certificate(self, worker, kind):
+        name = f'csr-{kind}-{worker}'
+        if kind == 'client':
+            spec = {'signerName': 'kubernetes.io/kube-apiserver-client-kubelet', 'username': BOOTSTRAPPER}
+        else:
+            spec = {'signerName': 'kubernetes.io/kubelet-serving', 'username': f'system:node:{worker}'}
+        spec['request'] = fake_csr_request(f'system:node:{worker}')
+        spec['usages'] = ['digital signature', 'client auth'] if kind == 'client' else ['digital signature', 'server auth']
+        self.store(CSR_PATH, {'metadata': {'name': name}, 'spec': spec, 'status': {}})
+
+    def set_node(self, worker, ready):
+        status = 'True' if ready else 'False'
+        self.store(NODES_PATH, {'metadata': {'name': worker, 'labels': {'node-role.kubernetes.io/worker': ''}},
+                                'status': {'conditions': [{'type': 'Ready', 'status': status}]}})
+
+    def approved(self, csr):
+        # What the kubelet does once its certificate was issued
+        worker = csr['metadata']['name'].split('-', 2)[2]
+        if csr['metadata']['name'].startswith('csr-client-'):
+            threading.Timer(self.join_delay, lambda: (self.set_node(worker, False), self.request_certificate(worker, 'serving'))).start()
+        else:
+            threading.Timer(self.ready_delay, self.set_node, (worker, True)).start()
+
+    def set_bmh_state(self, name, state, error_count=None):
+        with self.changed:
+            bmh = copy.deepcopy(self.collections[BMH_PATH][name])
+            status = bmh.setdefault('status', {})
+            status['provisioning'] = {'state': state}
+            status['operationalStatus'] = 'OK'
+            if error_count is not None:
+                status['errorCount'] = error_count
+            self.store(BMH_PATH, bmh)
+
+    def _phase(self, name, state, next_state, after=None):
+        # Runs one busy phase, retried once per timeout when ironic is overloaded
+        with self.changed:
+            busy = sum(1 for other, bmh in self.collections[BMH_PATH].items()
+                       if other != name and bmh.get('status', {}).get('provisioning', {}).get('state') in BUSY_STATES)
+            retry = state in BUSY_STATES and busy >= self.capacity
+            self.retries += retry
+            errors = self.collections[BMH_PATH][name].get('status', {}).get('errorCount', 0) + retry
+        self.set_bmh_state(name, state, errors)
+        delay = self.phase_delay + (self.retry_delay if retry else 0)
+
+        def done():
+            self.set_bmh_state(name, next_state)
+            if after:
+                after(name)
+        threading.Timer(delay, done).start()
+
+    def bmh_created(self, name):
+        self.set_bmh_state(name, 'registering')
+        threading.Timer(self.phase_delay / 2, self._phase, (name, 'inspecting', 'available', lambda name: self.provision())).start()
+
+    def provision(self):
+        """
+        Lets the machine controller claim available hosts for the machineset's missing machines.
+
+        Returns:
+        None
+        """
+        with self.changed:
+            replicas = next(iter(self.collections[MACHINESETS_PATH].values()))['spec']['replicas']
+            states = {name: bmh.get('status', {}).get('provisioning', {}).get('state')
+                      for name, bmh in self.collections[BMH_PATH].items()}
+            claimed = sum(1 for state in states.values() if state in ('provisioning', 'provisioned'))
+            available = [name for name, state in states.items() if state == 'available']
+            claims = available[:max(replicas - self.base_replicas - claimed, 0)]
+            # Claimed right away, so a concurrent call does not claim the same hosts
+            for name in claims:
+                self.collections[BMH_PATH][name]['status']['provisioning']['state'] = 'provisioning'
+        for name in claims:
+            self._phase(name, 'provisioning', 'provisioned', lambda name: self.request_certificate(name, 'client'))
+
+    def start_workers(self, workers=None):
+        """
+        Lets workers boot and request their client certificates.
+
+        Parameters:
+        workers (list): The workers, all of them if not given.
+
+        Returns:
+        None
+        """
+        for worker in workers if workers is not None else self.workers:
+            self.request_certificate(worker, 'client')
+
+    def events_after(self, path, version, timeout):
+        """
+        Waits for changes after a resource version.
+
+        Parameters:
+        path (str): The API path of the collection.
+        version (int): The last version seen.
+        timeout (float): The number of seconds to wait for a change.
+
+        Returns:
+        tuple: The (version, event type, object) events of the collection, and the version to wait after next.
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: self.version > version, timeout)
+            return [(v, t, o) for v, p, t, o in self.events if v > version and p == path], self.version
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _collection(self, path):
+        for collection in self.server.cluster.collections:
+            if path == collection or path.startswith(collection + '/'):
+                return collection, path[len(collection) + 1:]
+        return None, None
+
+    def do_GET(self):
+        cluster = self.server.cluster
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        collection, name = self._collection(url.path)
+        with cluster.changed:
+            cluster.requests += 1
+        if collection is None:
+            return self._send(404, {'kind': 'Status', 'code': 404})
+        if name:
+            obj = cluster.collections[collection].get(name)
+            return self._send(200 if obj else 404, obj or {'kind': 'Status', 'code': 404})
+        if query.get('watch') != ['1']:
+            with cluster.changed:
+                items = list(cluster.collections[collection].values())
+                version = str(cluster.version)
+            return self._send(200, {'items': items, 'metadata': {'resourceVersion': version}})
+
+        # A watch streams one JSON object per line until it times out
+        version = int(query.get('resourceVersion', ['0'])[0] or 0)
+        deadline = time.monotonic() + float(query.get('timeoutSeconds', ['300'])[0])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        try:
+            while time.monotonic() < deadline:
+                events, version = cluster.events_after(collection, version, max(min(1, deadline - time.monotonic()), 0))
+                for event_version, event_type, obj in events:
+                    self.wfile.write(json.dumps({'type': event_type, 'object': obj}).encode() + b'\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+    def do_POST(self):
+        cluster = self.server.cluster
+        collection, name = self._collection(urllib.parse.urlparse(self.path).path)
+        with cluster.changed:
+            cluster.requests += 1
+        body = self._body()
+        if collection is None or name:
+            return self._send(404, {'kind': 'Status', 'code': 404})
+        with cluster.changed:
+            if body['metadata']['name'] in cluster.collections[collection]:
+                return self._send(409, {'kind': 'Status', 'code': 409, 'reason': 'AlreadyExists'})
+            stored = cluster.store(collection, body)
+        if collection == BMH_PATH:
+            cluster.bmh_created(body['metadata']['name'])
+        return self._send(201, stored)
+
+    def do_PATCH(self):
+        cluster = self.server.cluster
+        collection, name = self._collection(urllib.parse.urlparse(self.path).path)
+        with cluster.changed:
+            cluster.requests += 1
+        body = self._body()
+
+        def merge(target, patch):
+            for key, value in patch.items():
+                if isinstance(value, dict) and isinstance(target.get(key), dict):
+                    merge(target[key], value)
+                else:
+                    target[key] = value
+
+        with cluster.changed:
+            obj = cluster.collections.get(collection, {}).get(name)
+            if obj is None:
+                return self._send(404, {'kind': 'Status', 'code': 404})
+            obj = copy.deepcopy(obj)
+            merge(obj, body)
+            stored = cluster.store(collection, obj)
+        if collection == MACHINESETS_PATH:
+            cluster.provision()
+        return self._send(200, stored)
+
+    def do_PUT(self):
+        cluster = self.server.cluster
+        collection, name = self._collection(urllib.parse.urlparse(self.path).path)
+        with cluster.changed:
+            cluster.requests += 1
+        body = self._body()
+        if collection == CSR_PATH and name.endswith('/approval'):
+            name = name[:-len('/approval')]
+            csr = cluster.collections[CSR_PATH].get(name)
+            if csr is None:
+                return self._send(404, {'kind': 'Status', 'code': 404})
+            csr = copy.deepcopy(csr)
+            csr['status']['conditions'] = body.get('status', {}).get('conditions', [])
+            stored = cluster.store(CSR_PATH, csr)
+            if any(condition.get('type') == 'Approved' for condition in csr['status']['conditions']):
+                cluster.approved(stored)
+            return self._send(200, stored)
+        if collection and name:
+            return self._send(200, cluster.store(collection, body))
+        return self._send(404, {'kind': 'Status', 'code': 404})
+
+
+class _Server(ThreadingHTTPServer):
+    # A scale up opens many connections at once
+    request_queue_size = 256
+    daemon_threads = True
+
+
+def serve(cluster, port=0):
+    """
+    Serves a fake cluster's API on localhost in a background thread.
+
+    Parameters:
+    cluster (FakeCluster): The simulated cluster.
+    port (int): The port to listen on, a free one if 0.
+
+    Returns:
+    _Server: The server, its server_address holds the port.
+    """
+    server = _Server(('127.0.0.1', port), _Handler)
+    server.cluster = cluster
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a fake API server of a cluster adding workers, for trying csr_approver.py and scale_waves.py')
+    parser.add_argument('-n', '--workers', type=int, default=10, help='The number of new workers')
+    parser.add_argument('-e', '--existing-workers', type=int, default=0, help='The number of the first new worker')
+    parser.add_argument('--port', type=int, default=8001, help='The port to listen on')
+    parser.add_argument('--bmh', action='store_true', help='Workers only boot once their BareMetalHost is provisioned, instead of right away')
+    parser.add_argument('--phase-delay', type=float, default=1.0, help='The number of seconds inspecting and provisioning a host take')
+    parser.add_argument('--capacity', type=int, default=20, help='The number of hosts that can inspect or provision at the same time without timeouts')
+    args = parser.parse_args()
+
+    cluster = FakeCluster([f'worker{args.existing_workers + i:03d}' for i in range(args.workers)], phase_delay=args.phase_delay,
+                          capacity=args.capacity, replicas=args.existing_workers)
+    server = serve(cluster, args.port)
+    print(f'Serving on http://127.0.0.1:{server.server_address[1]}')
+    if not args.bmh:
+        cluster.start_workers()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
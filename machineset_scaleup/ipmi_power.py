@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import os
+import subprocess
+import sys
+import time
+import render_inventory
+
+STATES = {'off': 'off', 'on': 'on', 'status': None}
+
+
+def ipmitool(node, args, timeout, binary='ipmitool'):
+    """
+    Runs one ipmitool command against the BMC of a node. The password goes through
+    the environment (-E) so it does not show up in the process list.
+
+    Parameters:
+    node (dict): The node record of the inventory.
+    args (list): The ipmitool command, e.g. ['chassis', 'power', 'status'].
+    timeout (float): The number of seconds the command may take.
+    binary (str): The ipmitool executable.
+
+    Returns:
+    str: The output of the command.
+    """
+    command = [binary, '-I', 'lanplus', '-H', node['pm_addr'], '-L', 'ADMINISTRATOR', '-p', '623',
+               '-U', node['pm_user'], '-E', '-N', '5', '-R', '1'] + args
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout,
+                                   env=dict(os.environ, IPMI_PASSWORD=node['pm_password']))
+    except subprocess.TimeoutExpired:
+        raise RuntimeError(f"{' '.join(args)}: no answer from the BMC within {timeout} seconds") from None
+    if completed.returncode != 0:
+        lines = (completed.stderr or completed.stdout).strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f'exit status {completed.returncode}')
+    return completed.stdout
+
+
+def power_state(node, timeout, binary='ipmitool'):
+    """
+    Reads the chassis power state of a node.
+
+    Parameters:
+    node (dict): The node record of the inventory.
+    timeout (float): The number of seconds the command may take.
+    binary (str): The ipmitool executable.
+
+    Returns:
+    str: 'on' or 'off'.
+    """
+    output = ipmitool(node, ['chassis', 'power', 'status'], timeout, binary)
+    # Chassis Power is on
+    state = output.strip().rsplit(' ', 1)[-1].lower()
+    if state not in ('on', 'off'):
+        raise RuntimeError(f'unexpected power status: {output.strip()}')
+    return state
+
+
+def set_power(node, action, timeout=30, retries=3, verify_timeout=120, binary='ipmitool'):
+    """
+    Powers a node on or off, or reads its state, retrying a BMC that does not answer
+    and confirming that the chassis reached the requested state.
+
+    Parameters:
+    node (dict): The node record of the inventory.
+    action (str): 'on', 'off' or 'status'.
+    timeout (float): The number of seconds a single ipmitool call may take.
+    retries (int): The number of attempts per ipmitool call.
+    verify_timeout (float): The number of seconds the chassis may take to reach the state.
+    binary (str): The ipmitool executable.
+
+    Returns:
+    dict: The final state, the number of attempts and the seconds it took.
+    """
+    start = time.monotonic()
+    attempts = 0
+
+    def attempt(func, *args):
+        nonlocal attempts
+        for n in range(retries):
+            attempts += 1
+            try:
+                return func(*args)
+            except RuntimeError as e:
+                if n == retries - 1:
+                    raise RuntimeError(f'{str(e)} after {attempts} attempt(s)') from None
+                time.sleep(2 ** n)
+
+    state = attempt(power_state, node, timeout, binary)
+    wanted = STATES[action]
+    if wanted and state != wanted:
+        attempt(ipmitool, node, ['chassis', 'power', action], timeout, binary)
+        deadline = time.monotonic() + verify_timeout
+        while state != wanted:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'chassis still {state} after {verify_timeout} seconds')
+            time.sleep(2)
+            state = attempt(power_state, node, timeout, binary)
+    return {'state': state, 'attempts': attempts, 'seconds': time.monotonic() - start}
+
+
+def run_all(nodes, action, parallel=32, **options):
+    """
+    Runs set_power on all nodes, at most parallel at the same time.
+
+    Parameters:
+    nodes (list): The node records of the inventory.
+    action (str): 'on', 'off' or 'status'.
+    parallel (int): The number of BMCs worked on at the same time.
+    **options: Passed on to set_power.
+
+    Returns:
+    dict: The result of set_power, or the exception, for every BMC address.
+    """
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = {executor.submit(set_power, node, action, **options): node['pm_addr'] for node in nodes}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+    return {node['pm_addr']: results[node['pm_addr']] for node in nodes}
+
+
+def print_summary(results, action):
+    """
+    Prints the state of every node and the failures, and returns whether all nodes succeeded.
+
+    Parameters:
+    results (dict): The result of run_all.
+    action (str): 'on', 'off' or 'status'.
+
+    Returns:
+    bool: True when every node is in the requested state.
+    """
+    print(f"{'bmc':<40} {'state':>6} {'tries':>6} {'seconds':>8}  error")
+    for address, result in results.items():
+        name = address.replace('mgmt-', '')
+        if isinstance(result, Exception):
+            print(f"{name:<40} {'?':>6} {'':>6} {'':>8}  {str(result)}")
+        else:
+            print(f"{name:<40} {result['state']:>6} {result['attempts']:>6} {result['seconds']:>8.1f}")
+    failed = [address for address, result in results.items() if isinstance(result, Exception)]
+    states = [result['state'] for result in results.values() if not isinstance(result, Exception)]
+    print(f"{action}: {len(results) - len(failed)}/{len(results)} BMCs done, {states.count('on')} on, {states.count('off')} off, {len(failed)} failed")
+    return not failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Power the nodes of a scale lab inventory on or off through their BMCs in parallel')
+    parser.add_argument('action', choices=sorted(STATES), help='Power the nodes on or off, or only read their state')
+    parser.add_argument('-j', '--json-inventory', required=True, help='The scale lab JSON inventory with the nodes')
+    parser.add_argument('-P', '--parallel', type=int, default=32, help='The number of BMCs worked on at the same time')
+    parser.add_argument('--timeout', type=float, default=30, help='The number of seconds a single ipmitool call may take')
+    parser.add_argument('--retries', type=int, default=3, help='The number of attempts of every ipmitool call')
+    parser.add_argument('--verify-timeout', type=float, default=120, help='The number of seconds a chassis may take to reach the requested state')
+    parser.add_argument('--ipmitool', default='ipmitool', help='The ipmitool executable')
+    args = parser.parse_args()
+
+    nodes = render_inventory.load_inventory(args.json_inventory)
+    print(f'{args.action}: {len(nodes)} nodes from {args.json_inventory}, {args.parallel} at a time')
+    results = run_all(nodes, args.action, args.parallel, timeout=args.timeout, retries=args.retries,
+                      verify_timeout=args.verify_timeout, binary=args.ipmitool)
+    sys.exit(0 if print_summary(results, args.action) else 1)
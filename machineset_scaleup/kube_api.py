@@ -0,0 +1,214 @@
+import json
+import os
+import ssl
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Seconds a watch stays open before it is renewed, the API server closes it anyway
+WATCH_SECONDS = 300
+
+
+class APIError(RuntimeError):
+    """
+    An error status of the API server, e.g. 409 when the object already exists.
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class KubeAPI:
+    """
+    A small Kubernetes API client on the standard library, enough for listing,
+    watching and updating the resources of a scale up without polling oc.
+    """
+
+    def __init__(self, server, token=None, ca_file=None, insecure=False, timeout=30):
+        self.server = server.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self.context = None
+        if self.server.startswith('https'):
+            self.context = ssl.create_default_context(cafile=ca_file)
+            if insecure:
+                self.context.check_hostname = False
+                self.context.verify_mode = ssl.CERT_NONE
+        self.proxy = None
+
+    def _open(self, method, path, body=None, content_type='application/json', timeout=None):
+        request = urllib.request.Request(f'{self.server}{path}', method=method,
+                                         data=json.dumps(body).encode() if body is not None else None)
+        request.add_header('Accept', 'application/json')
+        if body is not None:
+            request.add_header('Content-Type', content_type)
+        if self.token:
+            request.add_header('Authorization', f'Bearer {self.token}')
+        return urllib.request.urlopen(request, timeout=timeout or self.timeout, context=self.context)
+
+    def request(self, method, path, body=None, content_type='application/json'):
+        """
+        Sends one request and returns the decoded response.
+
+        Parameters:
+        method (str): The HTTP method.
+        path (str): The API path, e.g. /api/v1/nodes.
+        body (dict): Optional request body.
+        content_type (str): The content type of the body, e.g. application/merge-patch+json for a PATCH.
+
+        Returns:
+        dict: The response object.
+        """
+        try:
+            with self._open(method, path, body, content_type) as response:
+                return json.loads(response.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            raise APIError(e.code, f'{method} {path} failed with {e.code}: {e.read().decode(errors="replace")[:200]}') from None
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, body):
+        return self.request('POST', path, body)
+
+    def put(self, path, body):
+        return self.request('PUT', path, body)
+
+    def patch(self, path, body):
+        return self.request('PATCH', path, body, 'application/merge-patch+json')
+
+    def watch(self, path, resource_version, timeout_seconds=WATCH_SECONDS):
+        """
+        Streams the changes of a collection after a resource version.
+
+        Parameters:
+        path (str): The API path of the collection.
+        resource_version (str): The version to watch from, as returned by the list.
+        timeout_seconds (int): The number of seconds the server keeps the watch open.
+
+        Returns:
+        generator: (event type, object) tuples, until the server closes the watch.
+        """
+        query = urllib.parse.urlencode({'watch': '1', 'resourceVersion': resource_version,
+                                        'allowWatchBookmarks': 'true', 'timeoutSeconds': timeout_seconds})
+        with self._open('GET', f'{path}?{query}', timeout=timeout_seconds + 30) as response:
+            for line in response:
+                if line.strip():
+                    event = json.loads(line)
+                    yield event['type'], event['object']
+
+    def close(self):
+        if self.proxy:
+            self.proxy.terminate()
+            self.proxy.wait()
+            self.proxy = None
+
+
+def start_proxy():
+    """
+    Starts oc proxy on a free local port with the credentials of the current oc login.
+
+    Returns:
+    KubeAPI: A client of the proxy, closing it stops the proxy.
+    """
+    proxy = subprocess.Popen(['oc', 'proxy', '--port=0'], stdout=subprocess.PIPE, text=True)
+    # Prints "Starting to serve on 127.0.0.1:PORT" once it listens
+    line = proxy.stdout.readline()
+    if 'Starting to serve on' not in line:
+        proxy.terminate()
+        raise RuntimeError(f'oc proxy did not start: {line.strip()}')
+    api = KubeAPI(f"http://{line.strip().rsplit(' ', 1)[-1]}")
+    api.proxy = proxy
+    return api
+
+
+def informer(api, path, callback, stop, relist_seconds=None):
+    """
+    Keeps a callback up to date with a collection: lists it once, then follows its
+    watch, and lists again when the watch expired. Runs until stop is set.
+
+    Parameters:
+    api (KubeAPI): The client.
+    path (str): The API path of the collection.
+    callback (callable): Called as callback(event type, object), with ADDED for every listed object.
+    stop (threading.Event): Ends the informer.
+    relist_seconds (float): Optional interval of full lists, as a safety net for lost events.
+
+    Returns:
+    None
+    """
+    while not stop.is_set():
+        try:
+            listing = api.get(path)
+            for item in listing.get('items', []):
+                callback('ADDED', item)
+            resource_version = listing['metadata']['resourceVersion']
+            listed_at = time.monotonic()
+            while not stop.is_set():
+                for event_type, obj in api.watch(path, resource_version):
+                    if event_type == 'ERROR':
+                        # 410 Gone, the version is too old to watch from
+                        raise LookupError(obj.get('message', 'watch expired'))
+                    resource_version = obj['metadata']['resourceVersion']
+                    if event_type != 'BOOKMARK':
+                        callback(event_type, obj)
+                    if stop.is_set():
+                        return
+                if relist_seconds and time.monotonic() - listed_at > relist_seconds:
+                    break
+        except LookupError:
+            continue
+        except Exception as e:
+            print(f'Error watching {path}: {str(e)}, retrying')
+            stop.wait(2)
+
+
+def start_informer(api, path, callback, stop, relist_seconds=None):
+    """
+    Runs an informer in a daemon thread.
+
+    Returns:
+    threading.Thread: The thread.
+    """
+    thread = threading.Thread(target=informer, args=(api, path, callback, stop, relist_seconds), daemon=True)
+    thread.start()
+    return thread
+
+
+def connect(args):
+    """
+    Connects to the API server of the options added by add_arguments: --server with
+    a token (--token, $KUBE_TOKEN or oc whoami -t), or an oc proxy otherwise.
+
+    Parameters:
+    args (argparse.Namespace): The parsed options.
+
+    Returns:
+    KubeAPI: The client.
+    """
+    if not args.server:
+        return start_proxy()
+    token = args.token or os.environ.get('KUBE_TOKEN')
+    if token is None and args.server.startswith('https'):
+        token = subprocess.run(['oc', 'whoami', '-t'], capture_output=True, text=True, check=True).stdout.strip()
+    return KubeAPI(args.server, token, args.ca_file, args.insecure)
+
+
+def add_arguments(parser):
+    """
+    Adds the API server options.
+
+    Parameters:
+    parser (argparse.ArgumentParser): The parser of the script.
+
+    Returns:
+    None
+    """
+    parser.add_argument('--server', help='The API server URL, e.g. https://api.cluster.example.com:6443, an oc proxy of the current login is used if not given')
+    parser.add_argument('--token', help='The bearer token for --server, $KUBE_TOKEN or oc whoami -t by default')
+    parser.add_argument('--ca-file', help='The CA bundle of --server')
+    parser.add_argument('--insecure', action='store_true', help='Do not verify the certificate of --server')
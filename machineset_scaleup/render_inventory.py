@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import glob
+import json
+import os
+import re
+import tempfile
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template.yml')
+IP_PREFIX = '192.168.216.'
+IP_OFFSET = 15
+
+
+def load_inventory(path):
+    """
+    Reads the nodes of a scale lab JSON inventory.
+
+    Parameters:
+    path (str): The JSON inventory file, {"nodes": [{"pm_addr": ..., "pm_user": ..., "pm_password": ..., "mac": [...]}, ...]}.
+
+    Returns:
+    list: The node records.
+    """
+    with open(path) as f:
+        nodes = json.load(f).get('nodes', [])
+    if not nodes:
+        raise ValueError(f"no nodes in '{path}'")
+    return nodes
+
+
+def plan_workers(nodes, existing_workers):
+    """
+    Names the new workers and picks their provisioning MAC, DHCP MAC and address.
+
+    Parameters:
+    nodes (list): The node records of the inventory.
+    existing_workers (int): The number of workers already in the cluster, the first new worker is numbered after them.
+
+    Returns:
+    list: One dict per node with name, ipmi_address, provisioning_mac, dhcp_mac and ip.
+    """
+    workers = []
+    for i, node in enumerate(nodes):
+        workers.append({
+            'name': f'worker{existing_workers + i:03d}',
+            'ipmi_address': node['pm_addr'],
+            'provisioning_mac': node['mac'][1],
+            'dhcp_mac': node['mac'][2],
+            'ip': f'{IP_PREFIX}{IP_OFFSET + i}',
+        })
+    return workers
+
+
+def render_workers(template, workers, user, password):
+    """
+    Renders the Secret and BareMetalHost documents of all workers into one
+    multi-document YAML.
+
+    Parameters:
+    template (str): The content of template.yml.
+    workers (list): The workers as returned by plan_workers.
+    user (str): The BMC user, stored base64 encoded in the secrets.
+    password (str): The BMC password, stored base64 encoded in the secrets.
+
+    Returns:
+    str: The YAML documents.
+    """
+    user = base64.b64encode(user.encode()).decode()
+    password = base64.b64encode(password.encode()).decode()
+    documents = []
+    for worker in workers:
+        document = (template.replace('IPMI_ADDRESS', worker['ipmi_address'])
+                            .replace('WORKER-NAME', worker['name'])
+                            .replace('PROVISIONING-MAC', worker['provisioning_mac'])
+                            .replace('IDRAC-USER', user)
+                            .replace('IDRAC-PASSWORD', password))
+        documents.append(document.strip('\n').lstrip('-\n'))
+    return ''.join(f'---\n{document}\n' for document in documents)
+
+
+def _scalar(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return {'true': True, 'false': False}.get(value, value)
+
+
+def parse_documents(text):
+    """
+    Reads YAML documents made of nested mappings and scalars, as in template.yml,
+    so the rendered workers can be sent to the API without a YAML library.
+
+    Parameters:
+    text (str): The documents, separated by --- lines.
+
+    Returns:
+    list: The documents as dicts.
+    """
+    documents = []
+    for chunk in re.split(r'^---\s*$', text, flags=re.M):
+        root = {}
+        parents = [(-1, root)]
+        for line in chunk.splitlines():
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            if line.lstrip().startswith('- '):
+                raise ValueError(f'lists are not supported: {line.strip()}')
+            indent = len(line) - len(line.lstrip())
+            key, sep, value = line.strip().partition(':')
+            while parents[-1][0] >= indent:
+                parents.pop()
+            if value.strip():
+                parents[-1][1][key] = _scalar(value.strip())
+            else:
+                parents[-1][1][key] = {}
+                parents.append((indent, parents[-1][1][key]))
+        if root:
+            documents.append(root)
+    return documents
+
+
+def merge_dhcp_hosts(lines, workers):
+    """
+    Puts the dhcp-host line of every worker into a dnsmasq configuration. A line
+    that already names the worker, its MAC or its address is replaced, so running
+    again after a failed scale up does not leave duplicates behind. New lines go
+    after the last dhcp line, like the rest of the lab's records.
+
+    Parameters:
+    lines (list): The lines of the dnsmasq configuration.
+    workers (list): The workers as returned by plan_workers.
+
+    Returns:
+    tuple: The new lines, and the number of workers whose record was added, replaced
+           and already present. A worker whose record is present next to a stale
+           line of its own counts as replaced.
+    """
+    records = {worker['name']: f"dhcp-host={worker['dhcp_mac']},{worker['ip']},{worker['name']}" for worker in workers}
+    keys = {}
+    for worker in workers:
+        for key in (worker['dhcp_mac'].lower(), worker['ip'], worker['name']):
+            keys[key] = worker['name']
+
+    present = set()
+    replaced = set()
+    kept = []
+    for line in lines:
+        match = re.match(r'\s*dhcp-host=(.*)', line)
+        fields = [field.strip().lower() for field in match.group(1).split(',')] if match else []
+        owners = {keys[field] for field in fields if field in keys}
+        if not owners:
+            kept.append(line)
+        elif line.strip() == records.get(next(iter(owners))) and len(owners) == 1:
+            present.update(owners)
+            kept.append(line)
+        else:
+            replaced.update(owners)
+
+    new = [records[worker['name']] for worker in workers if worker['name'] not in present]
+    last_dhcp = max((index for index, line in enumerate(kept) if 'dhcp' in line), default=len(kept) - 1)
+    kept[last_dhcp + 1:last_dhcp + 1] = new
+    return kept, len(set(records) - present - replaced), len(replaced), len(present - replaced)
+
+
+def write_atomic(path, content):
+    """
+    Replaces a file in one step, keeping its mode, so dnsmasq never reads half of it.
+
+    Parameters:
+    path (str): The file to write.
+    content (str): The new content.
+
+    Returns:
+    None
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def update_dnsmasq(path, workers):
+    """
+    Applies the dhcp-host records of all workers to the dnsmasq configuration in
+    one write, only when something changed.
+
+    Parameters:
+    path (str): The dnsmasq configuration, e.g. /etc/dnsmasq.d/ocp4-lab.conf.
+    workers (list): The workers as returned by plan_workers.
+
+    Returns:
+    str: A summary of the changes.
+    """
+    with open(path) as f:
+        content = f.read()
+    lines, added, replaced, present = merge_dhcp_hosts(content.splitlines(), workers)
+    if lines != content.splitlines():
+        write_atomic(path, '\n'.join(lines) + '\n')
+    return f'{added} added, {replaced} replaced, {present} already present'
+
+
+def write_workers(directory, yaml):
+    """
+    Writes the rendered documents as the only YAML file of the workers directory,
+    as oc create -f takes every file of the directory.
+
+    Parameters:
+    directory (str): The workers directory.
+    yaml (str): The rendered documents.
+
+    Returns:
+    str: The path of the written file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for old in glob.glob(os.path.join(directory, '*.yml')) + glob.glob(os.path.join(directory, '*.yaml')):
+        os.remove(old)
+    path = os.path.join(directory, 'workers.yml')
+    write_atomic(path, yaml)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the BareMetalHost and BMC secret documents and the DHCP records of new workers')
+    parser.add_argument('-j', '--json-inventory', required=True, help='The scale lab JSON inventory with the nodes to add')
+    parser.add_argument('-d', '--dnsmasq-file', help='The dnsmasq configuration to add the dhcp-host records to')
+    parser.add_argument('-e', '--existing-workers', type=int, required=True, help='The number of workers already in the cluster')
+    parser.add_argument('-t', '--template', default=TEMPLATE, help='The template of the documents of one worker')
+    parser.add_argument('-o', '--output-dir', default='workers', help='The directory to write workers.yml to')
+    args = parser.parse_args()
+
+    nodes = load_inventory(args.json_inventory)
+    workers = plan_workers(nodes, args.existing_workers)
+    with open(args.template) as f:
+        template = f.read()
+    # All BMCs of a lab allocation share the credentials of the first node
+    path = write_workers(args.output_dir, render_workers(template, workers, nodes[0]['pm_user'], nodes[0]['pm_password']))
+    print(f'{len(workers)} workers ({workers[0]["name"]} to {workers[-1]["name"]}) written to {path}')
+    if args.dnsmasq_file:
+        print(f'dhcp-host records in {args.dnsmasq_file}: {update_dnsmasq(args.dnsmasq_file, workers)}')
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+import argparse
+import math
+import threading
+import time
+import kube_api
+import render_inventory
+
+PHASES = ('registering', 'inspecting', 'available', 'provisioning', 'provisioned')
+# Other BareMetalHost states, counted as part of the phase they belong to
+STATE_ALIASES = {'ready': 'available', 'match profile': 'inspecting', 'preparing': 'provisioning'}
+# The durations reported per host, as (name, from, to)
+DURATIONS = (('registering', 'registered', 'inspecting'), ('inspecting', 'inspecting', 'available'),
+             ('waiting', 'available', 'provisioning'), ('provisioning', 'provisioning', 'provisioned'),
+             ('total', 'registered', 'provisioned'))
+
+
+def api_paths(namespace):
+    """
+    Returns the API paths of the collections a scale up works with.
+
+    Parameters:
+    namespace (str): The namespace of the machine API, normally openshift-machine-api.
+
+    Returns:
+    dict: The paths of the Secret, BareMetalHost and MachineSet collections, by kind.
+    """
+    return {
+        'Secret': f'/api/v1/namespaces/{namespace}/secrets',
+        'BareMetalHost': f'/apis/metal3.io/v1alpha1/namespaces/{namespace}/baremetalhosts',
+        'MachineSet': f'/apis/machine.openshift.io/v1beta1/namespaces/{namespace}/machinesets',
+    }
+
+
+def find_machineset(api, path, name=None):
+    """
+    Picks the machineset to scale: the one named, or the first one with test in its
+    name, like the scale lab clusters are set up.
+
+    Parameters:
+    api (kube_api.KubeAPI): The client.
+    path (str): The API path of the MachineSet collection.
+    name (str): Optional machineset name.
+
+    Returns:
+    dict: The machineset.
+    """
+    machinesets = api.get(path).get('items', [])
+    for machineset in machinesets:
+        if (machineset['metadata']['name'] == name) if name else ('test' in machineset['metadata']['name']):
+            return machineset
+    raise LookupError(f"no machineset {name or 'with test in its name'} in {[m['metadata']['name'] for m in machinesets]}")
+
+
+def documents_by_worker(documents, names):
+    """
+    Groups the documents of a workers.yml written by render_inventory.py by worker:
+    the BMC secret first, then the BareMetalHost using it.
+
+    Parameters:
+    documents (list): The parsed documents.
+    names (list): The workers.
+
+    Returns:
+    dict: The documents of every worker, by worker.
+    """
+    by_name = {(document['kind'], document['metadata']['name']): document for document in documents}
+    grouped = {}
+    for name in names:
+        bmh = by_name.get(('BareMetalHost', name))
+        if bmh is None:
+            raise LookupError(f'no BareMetalHost {name} in the documents')
+        secret = by_name.get(('Secret', bmh['spec']['bmc']['credentialsName']))
+        grouped[name] = ([secret] if secret else []) + [bmh]
+    return grouped
+
+
+def phase_of(bmh):
+    state = (bmh.get('status', {}).get('provisioning', {}) or {}).get('state') or 'registering'
+    return STATE_ALIASES.get(state, state)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class WaveScheduler:
+    """
+    Adds new workers to the cluster a window at a time: at most wave_size hosts are
+    registered and not yet provisioned at any moment, and the next host is registered
+    as soon as one of them is provisioned, fails or runs past host_timeout. The
+    machineset is scaled up as hosts become available, so every replica has a host
+    to claim. A host that cannot be registered is retried after a back off and given
+    up on after max_attempts.
+    """
+
+    def __init__(self, api, documents, paths, machineset, wave_size=20, max_errors=3, host_timeout=None,
+                 max_attempts=5):
+        self.api = api
+        self.documents = documents
+        self.paths = paths
+        self.machineset = machineset['metadata']['name']
+        self.initial_replicas = machineset['spec'].get('replicas', 0)
+        self.replicas = self.initial_replicas
+        self.wave_size = wave_size
+        self.max_errors = max_errors
+        self.host_timeout = host_timeout
+        self.max_attempts = max_attempts
+        self.attempts = {}
+        self.queue = list(documents)
+        self.seen = {name: {} for name in documents}
+        self.phase = {}
+        self.errors = {}
+        self.failed = set()
+        self.timed_out = set()
+        self.changed = threading.Condition()
+
+    def on_bmh(self, event_type, bmh):
+        name = bmh['metadata']['name']
+        if name not in self.seen or event_type == 'DELETED':
+            return
+        phase = phase_of(bmh)
+        status = bmh.get('status', {})
+        with self.changed:
+            self.phase[name] = phase
+            self.errors[name] = max(self.errors.get(name, 0), status.get('errorCount', 0) or 0)
+            self.seen[name].setdefault(phase, time.monotonic())
+            if status.get('operationalStatus') == 'error' and self.errors[name] >= self.max_errors:
+                self.failed.add(name)
+            self.changed.notify_all()
+
+    def register(self, name):
+        """
+        Creates the BMC secret and the BareMetalHost of a worker. Objects left over
+        from an earlier run are kept as they are, so a retry after a partial
+        registration only creates what is missing.
+
+        Parameters:
+        name (str): The worker.
+
+        Returns:
+        bool: True if the worker is registered, False if it is retried or given up on.
+        """
+        with self.changed:
+            self.seen[name].setdefault('registered', time.monotonic())
+        for document in self.documents[name]:
+            try:
+                self.api.post(self.paths[document['kind']], document)
+            except kube_api.APIError as e:
+                if e.code != 409:
+                    return self._retry(name, document, e)
+                print(f"{document['kind']} {document['metadata']['name']} already exists, keeping it")
+            except Exception as e:
+                return self._retry(name, document, e)
+        return True
+
+    def _retry(self, name, document, error):
+        """
+        Queues a worker that could not be registered again, after a back off growing
+        with every failed attempt, and gives up on it after max_attempts. The worker
+        leaves the window while it waits.
+
+        Parameters:
+        name (str): The worker.
+        document (dict): The document that could not be created.
+        error (Exception): The error of the attempt.
+
+        Returns:
+        bool: False.
+        """
+        with self.changed:
+            self.seen[name].pop('registered', None)
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            attempts = self.attempts[name]
+            if attempts >= self.max_attempts:
+                self.failed.add(name)
+                self.changed.notify_all()
+        if attempts >= self.max_attempts:
+            print(f"Error registering {document['kind']} {document['metadata']['name']} of {name}: {str(error)}, "
+                  f"giving up after {attempts} attempts")
+            return False
+        delay = min(2 ** attempts, 30)
+        print(f"Error registering {document['kind']} {document['metadata']['name']} of {name}: {str(error)}, "
+              f"retrying in {delay} seconds")
+
+        def queue():
+            with self.changed:
+                self.queue.insert(0, name)
+                self.changed.notify_all()
+        timer = threading.Timer(delay, queue)
+        timer.daemon = True
+        timer.start()
+        return False
+
+    def in_flight(self):
+        return [name for name in self.seen if 'registered' in self.seen[name]
+                and self.phase.get(name) != 'provisioned' and name not in self.failed]
+
+    def expire(self):
+        """
+        Gives up on the hosts that were registered more than host_timeout seconds ago
+        and are still not provisioned, freeing their place in the window.
+
+        Returns:
+        list: The hosts given up on.
+        """
+        if not self.host_timeout:
+            return []
+        now = time.monotonic()
+        expired = [name for name in self.in_flight() if now - self.seen[name]['registered'] > self.host_timeout]
+        self.failed.update(expired)
+        self.timed_out.update(expired)
+        return expired
+
+    def done(self):
+        return all(self.phase.get(name) == 'provisioned' or name in self.failed for name in self.seen)
+
+    def reached_available(self):
+        # A host given up on for taking too long is still in the pool, a machine may claim it
+        return sum(1 for name in self.seen if (name not in self.failed or name in self.timed_out)
+                   and self.phase.get(name) in ('available', 'provisioning', 'provisioned'))
+
+    def run(self, timeout=None):
+        """
+        Registers the hosts, scales the machineset and follows the hosts until all of
+        them are provisioned or failed.
+
+        Parameters:
+        timeout (float): The number of seconds the scale up may take, no limit if None.
+
+        Returns:
+        set: The workers that are not provisioned.
+        """
+        stop = threading.Event()
+        kube_api.start_informer(self.api, self.paths['BareMetalHost'], self.on_bmh, stop, relist_seconds=60)
+        deadline = time.monotonic() + timeout if timeout else None
+        progress = None
+        printed = 0
+        try:
+            while True:
+                with self.changed:
+                    for name in self.expire():
+                        print(f"{name} not provisioned {self.host_timeout:.0f} seconds after it was registered, "
+                              f"giving up on it in {self.phase.get(name, 'registering')}")
+                    slots = self.wave_size - len(self.in_flight())
+                    release, self.queue = self.queue[:max(slots, 0)], self.queue[max(slots, 0):]
+                    replicas = max(self.replicas, self.initial_replicas + self.reached_available())
+                registered = [name for name in release if self.register(name)]
+                if registered:
+                    print(f"registered {', '.join(registered)}")
+                if replicas != self.replicas:
+                    self.api.patch(f"{self.paths['MachineSet']}/{self.machineset}", {'spec': {'replicas': replicas}})
+                    print(f'scaled machineset {self.machineset} to {replicas} replicas')
+                    self.replicas = replicas
+                with self.changed:
+                    counts = {phase: list(self.phase.values()).count(phase) for phase in PHASES}
+                    line = (f"{sum(1 for seen in self.seen.values() if 'registered' in seen)}/{len(self.seen)} registered, "
+                            + ', '.join(f'{count} {phase}' for phase, count in counts.items() if count)
+                            + f', {len(self.failed)} failed')
+                    finished = not self.queue and self.done()
+                    # A line per release, or every few seconds, not one per event of a large scale up
+                    if line != progress and (release or finished or time.monotonic() - printed > 5):
+                        print(line)
+                        progress, printed = line, time.monotonic()
+                    if finished:
+                        return set(self.failed)
+                    remaining = deadline - time.monotonic() if deadline else None
+                    if remaining is not None and remaining <= 0:
+                        return {name for name in self.seen if self.phase.get(name) != 'provisioned'}
+                    self.changed.wait(min(remaining, 10) if remaining is not None else 10)
+        finally:
+            stop.set()
+
+    def durations(self, name):
+        seen = self.seen[name]
+        order = ('registered',) + PHASES
+        result = {}
+        for label, start, end in DURATIONS:
+            # A phase too short to be seen between two events ends where the next one starts
+            starts = [seen[key] for key in order[order.index(start):] if key in seen]
+            ends = [seen[key] for key in order[order.index(end):] if key in seen]
+            if starts and ends:
+                result[label] = max(ends[0] - starts[0], 0)
+        return result
+
+    def print_report(self):
+        """
+        Prints the duration of every phase of every host, then the median and the
+        slowest host of every phase.
+
+        Returns:
+        None
+        """
+        labels = [label for label, start, end in DURATIONS]
+        print(f"{'host':<12} {'state':<13} {'errors':>6} " + ' '.join(f'{label:>12}' for label in labels))
+        per_phase = {label: [] for label in labels}
+        for name in self.seen:
+            durations = self.durations(name)
+            for label, seconds in durations.items():
+                per_phase[label].append((seconds, name))
+            state = 'timed out' if name in self.timed_out else 'failed' if name in self.failed else self.phase.get(name, 'not started')
+            print(f'{name:<12} {state:<13} {self.errors.get(name, 0):>6} '
+                  + ' '.join(f"{durations[label]:>12.1f}" if label in durations else f"{'-':>12}" for label in labels))
+        for label, values in per_phase.items():
+            if values:
+                slowest, host = max(values)
+                print(f'{label:<12} p50 {percentile([seconds for seconds, name in values], 0.5):8.1f}s   max {slowest:8.1f}s ({host})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add the new workers of a scale lab inventory in waves and report how long every phase took')
+    parser.add_argument('-j', '--json-inventory', required=True, help='The scale lab JSON inventory with the nodes to add')
+    parser.add_argument('-e', '--existing-workers', type=int, required=True, help='The number of workers already in the cluster')
+    parser.add_argument('-t', '--template', default=render_inventory.TEMPLATE, help='The template of the documents of one worker')
+    parser.add_argument('-f', '--workers-file', help='The documents written by render_inventory.py, e.g. workers/workers.yml, rendered from --template if not given')
+    parser.add_argument('-w', '--wave-size', type=int, default=20, help='The number of hosts registered and not yet provisioned at the same time')
+    parser.add_argument('--max-errors', type=int, default=3, help='The number of errors after which a host in error is given up on')
+    parser.add_argument('--max-attempts', type=int, default=5, help='The number of failed registrations after which a host is given up on')
+    parser.add_argument('--machineset', help='The machineset to scale, the first one with test in its name by default')
+    parser.add_argument('--namespace', default='openshift-machine-api', help='The namespace of the machine API')
+    parser.add_argument('--host-timeout', type=float, default=3600, help='The number of seconds a host may take from registered to provisioned before it is given up on')
+    parser.add_argument('--timeout', type=float, default=None, help='The number of seconds the scale up may take, by default --host-timeout for every --wave-size hosts')
+    kube_api.add_arguments(parser)
+    args = parser.parse_args()
+
+    nodes = render_inventory.load_inventory(args.json_inventory)
+    workers = render_inventory.plan_workers(nodes, args.existing_workers)
+    if args.workers_file:
+        # The documents that were reviewed and saved are the ones registered
+        with open(args.workers_file) as f:
+            documents = documents_by_worker(render_inventory.parse_documents(f.read()), [worker['name'] for worker in workers])
+    else:
+        with open(args.template) as f:
+            template = f.read()
+        documents = {}
+        for worker in workers:
+            rendered = render_inventory.render_workers(template, [worker], nodes[0]['pm_user'], nodes[0]['pm_password'])
+            documents[worker['name']] = render_inventory.parse_documents(rendered)
+    for worker_documents in documents.values():
+        for document in worker_documents:
+            document['metadata']['namespace'] = args.namespace
+
+    paths = api_paths(args.namespace)
+    api = kube_api.connect(args)
+    try:
+        machineset = find_machineset(api, paths['MachineSet'], args.machineset)
+        print(f"adding {len(workers)} workers to machineset {machineset['metadata']['name']}, {args.wave_size} at a time")
+        scheduler = WaveScheduler(api, documents, paths, machineset, args.wave_size, args.max_errors, args.host_timeout,
+                                   args.max_attempts)
+        missing = scheduler.run(args.timeout or args.host_timeout * math.ceil(len(workers) / args.wave_size))
+    finally:
+        api.close()
+    scheduler.print_report()
+    if missing:
+        print(f"{len(missing)} new workers not provisioned: {', '.join(sorted(missing))}")
+        raise SystemExit(1)
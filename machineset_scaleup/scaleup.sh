@@ -1,9 +1,8 @@
 #!/bin/bash
-declare idrac_password
-declare idrac_user
 declare dnsmasq_file
 declare json_inventory
 declare power_off="no"
+declare wave_size=20
 declare existing_worker_nodes=$((`oc get node --no-headers|grep worker|wc -l`))
 function ctrl_c() {
         echo "** CTRL-C detected"
@@ -28,10 +27,15 @@ while [ $# -gt 0 ]; do
 	      exit
       fi
       ;;
+    --wave-size*|-w*)
+      if [[ "$1" != *=* ]]; then shift; fi
+      wave_size="${1#*=}"
+      ;;
     --help|-h)
       echo "--dnsmasq-file   -d   ocp dnsmasq conf file normally found at /etc/dnsmasq.d/ocp4-lab.conf"
       echo "--json-inventory -j   scale lab json inventory file that contains only the nodes you wish to add"
       echo "--power-off -p   power off all new worker nodes before starting yes/no default is no"
+      echo "--wave-size -w   how many new nodes are registered and deploying at the same time default is 20"
       exit 0
       ;;
     *)
@@ -45,9 +49,11 @@ done
 declare how_many_new_nodes=(`jq '.[] | length' ${json_inventory}`)
 
 scale_up(){
-deployment_name=(`oc get machineset -n openshift-machine-api |grep test|awk '{print $1}'`)
-echo "scaling ${deployment_name} up to $(( ${how_many_new_nodes} + `oc get node --no-headers|grep worker|wc -l`)) worker nodes"
-oc scale --replicas=$(( ${how_many_new_nodes} + `oc get node --no-headers|grep worker|wc -l`))  machineset ${deployment_name} -n openshift-machine-api
+echo "adding ${how_many_new_nodes} worker nodes ${wave_size} at a time"
+# Registers the BareMetalHosts as earlier ones finish provisioning, instead of all at once,
+# scales the test machineset as hosts become available and reports how long each phase took,
+# the documents are the ones generate_workers_config saved to workers/workers.yml
+python3 "$(dirname "$0")/scale_waves.py" -j "${json_inventory}" -e "${existing_worker_nodes}" -f workers/workers.yml --wave-size "${wave_size}"
 }
 
 function box_out()
@@ -68,25 +74,10 @@ function box_out()
 }
 
 acceept_new_workers_certificates(){
-echo "approving new workers certificates for ${how_many_new_nodes} nodes - note this will keep running in the background"
-until [ $(oc get nodes | grep "\bReady\s*worker" | wc -l) == ${json_inventory} ]
-do
-    csr_output=$(oc get csr -ojson | jq -r '.items[] | select(.status == {} ) | .metadata.name')
-    if [ -n "$csr_output" ]
-    then
-    	echo "$csr_output" | xargs oc adm certificate approve
-    fi
-    sleep 5
-done
-}
-
-get_idrac_credentials(){
-        if [ -z "${json_inventory}" ];  then
-        echo "somthing went wrong with the json file , exiting.."
-        exit
-fi
-        idrac_user=`jq -r '.nodes[0] | .pm_user' ${json_inventory} |xargs echo -n |base64`
-        idrac_password=`jq -r '.nodes[0] | .pm_password' ${json_inventory}|xargs echo -n|base64`
+echo "approving new workers certificates for ${how_many_new_nodes} nodes - note this will keep running in the background until they are all Ready"
+# Follows the CSR and node events of the API server through oc proxy and only approves
+# the client and serving certificates of the new workers
+python3 "$(dirname "$0")/csr_approver.py" -j "${json_inventory}" -e "${existing_worker_nodes}"
 }
 
 generate_workers_config(){
@@ -95,50 +86,16 @@ if [ -z "${json_inventory}" ];  then
         exit
 fi
 
-ip_offset=15
-first_node_to_add=$((1 + `oc get node --no-headers|grep worker|wc -l`))
-
-cleanup(){
-        rm -rf workers/
-        mkdir workers/
-}
-
-add_dns(){
-        dnsmasq_mac=$1
-        current_node=$2
-	worker_name=$3
-	last_dhcp_line=$(( $(awk '/dhcp/ { ln = FNR } END { print ln }' ${dnsmasq_file}) ))
-	sed -i "$last_dhcp_line a dhcp-host=$dnsmasq_mac,192.168.216.$(( ip_offset + current_node )),${worker_name}" ${dnsmasq_file}
-}
-
-
-add_bmh(){
-        provisioning_mac=$1
-	worker_name=$2
-        ipmi_dns=$3
-	sed -e "s/IPMI_ADDRESS/${ipmi_dns}/g" -e "s/WORKER-NAME/${worker_name}/g" -e "s/PROVISIONING-MAC/${provisioning_mac}/g" -e "s/IDRAC-USER/${idrac_user}/g" -e "s/IDRAC-PASSWORD/${idrac_password}/g" template.yml >> workers/${worker_name}.yml
-}
-
-
-cleanup
-
-for (( i=0; i< $(( ${how_many_new_nodes} )); i++ )) ; do
-	worker_name=$(echo "worker"$(printf "%.3d" $(( existing_worker_nodes + i ))))
-        provisioning_mac=$( jq -r .nodes[$i].mac[1] ${json_inventory} )
-        dnsmasq_mac=$( jq -r .nodes[$i].mac[2] ${json_inventory} )
-        ipmi_controller_dns=$( jq -r .nodes[$i].pm_addr ${json_inventory} )
-        add_dns "$dnsmasq_mac" "$i" "${worker_name}"
-        add_bmh "${provisioning_mac}" "${worker_name}" "${ipmi_controller_dns}"
-done
+# One pass over the inventory: all BareMetalHost and secret documents in workers/workers.yml
+# and every dhcp-host record written to the dnsmasq file at once
+python3 "$(dirname "$0")/render_inventory.py" -j "${json_inventory}" -d "${dnsmasq_file}" -e "${existing_worker_nodes}" -o workers || exit 1
 }
 
 ipmi_power_off(){
 if [ ${power_off} = "yes" ] ; then
 	echo "powering off all ${how_many_new_nodes} worker nodes found in ${json_inventory}"
-	for ((i=0; i<${how_many_new_nodes}; i++)); do
-		echo "powering off `jq -r .nodes[$i].pm_addr ${json_inventory}|sed 's/mgmt-//g'`"
-	ipmitool -I lanplus -H `jq -r .nodes[$i].pm_addr ${json_inventory}` -L ADMINISTRATOR -p 623 -U `echo -n "${idrac_user}"|base64 -d` -P `echo -n "${idrac_password}"|base64 -d` chassis power off > /dev/null 2>&1
-done
+	# All BMCs in parallel, retried, and confirmed off, with a summary per node
+	python3 "$(dirname "$0")/ipmi_power.py" off -j "${json_inventory}"
 else
 	echo "skipping worker nodes shutdown note that workers nodes should be powered off during deployment"
 fi
@@ -151,16 +108,13 @@ read -r -p "Are you sure you wish to continue? [y/N] " response
 case "$response" in
     [yY][eE][sS]|[yY])
 	
-        scale_up	
-        echo "getting cloud credentials"
-	get_idrac_credentials
 	echo "generating worker nodes yaml files and adding dns information to ${dnsmasq_file}"
 	generate_workers_config
 	echo "restarting dnsmasq"
 	service dnsmasq restart
 	ipmi_power_off
 	acceept_new_workers_certificates &
-	oc create -f workers
+	scale_up
 	box_out "you can follow the deployment progress using \"oc get bmh -n openshift-machine-api\""
 
 
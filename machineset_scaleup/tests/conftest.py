@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts import their modules flat, from the directory they run in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+import base64
+import pytest
+import csr_approver
+import fake_kube_api
+
+# Made with openssl req -new -newkey ec -subj "/O=system:nodes/CN=system:node:worker007.example.com"
+OPENSSL_CSR = """-----BEGIN CERTIFICATE REQUEST-----
+MIH9MIGlAgEAMEMxFTATBgNVBAoMDHN5c3RlbTpub2RlczEqMCgGA1UEAwwhc3lz
+dGVtOm5vZGU6d29ya2VyMDA3LmV4YW1wbGUuY29tMFkwEwYHKoZIzj0CAQYIKoZI
+zj0DAQcDQgAE8MSlJJNImRRMAXSlF7cMlvBHdCYhbUXzqxrZ9UFdW+GGyo5+KoKx
+rO7KMUfoIkVQpPLgTknkv9Ju6CKeeoPhx6AAMAoGCCqGSM49BAMCA0cAMEQCIGdG
+ntNbeOBIgwc9ZM51tO/RR2QCrAOlT9q70Z0KEkZyAiAuI7hmJYJUlCUlLoNIcyLR
+8lKcZ5Dz22lyUDur9qRCtg==
+-----END CERTIFICATE REQUEST-----
+"""
+
+
+@pytest.mark.parametrize('request_, expected', [
+    (base64.b64encode(OPENSSL_CSR.encode()).decode(), 'system:node:worker007.example.com'),
+    (fake_kube_api.fake_csr_request('system:node:worker001'), 'system:node:worker001'),
+    # Subjects long enough for the long form of the DER lengths
+    (fake_kube_api.fake_csr_request('system:node:' + 'w' * 300), 'system:node:' + 'w' * 300),
+    (fake_kube_api.fake_csr_request('system:node:worker001', organization='o' * 200), 'system:node:worker001'),
+])
+def test_csr_common_name(request_, expected):
+    assert csr_approver.csr_common_name(request_) == expected
+
+
+def csr(common_name, signer, username):
+    return {'metadata': {'name': 'csr-1'},
+            'spec': {'request': fake_kube_api.fake_csr_request(common_name), 'signerName': signer, 'username': username}}
+
+
+@pytest.mark.parametrize('request_csr, expected', [
+    (csr('system:node:worker001', csr_approver.CLIENT_SIGNER, csr_approver.BOOTSTRAPPER), ('worker001', 'client')),
+    (csr('system:node:worker001.lab.example.com', csr_approver.SERVING_SIGNER, 'system:node:worker001.lab.example.com'),
+     ('worker001', 'serving')),
+    (csr('system:node:worker009', csr_approver.CLIENT_SIGNER, csr_approver.BOOTSTRAPPER), (None, 'worker009 is not a new worker')),
+    (csr('admin', csr_approver.CLIENT_SIGNER, csr_approver.BOOTSTRAPPER), (None, 'common name admin is not a node')),
+    # A serving certificate for a node asked for by someone else
+    (csr('system:node:worker001', csr_approver.SERVING_SIGNER, 'system:node:worker002'),
+     (None, 'signer kubernetes.io/kubelet-serving requested by system:node:worker002')),
+    (csr('system:node:worker001', csr_approver.CLIENT_SIGNER, 'system:admin'),
+     (None, 'signer kubernetes.io/kube-apiserver-client-kubelet requested by system:admin')),
+    ({'metadata': {'name': 'csr-1'}, 'spec': {'request': 'bm90IGEgY3Ny'}}, (None, 'unreadable request')),
+    ({'metadata': {'name': 'csr-1'}, 'spec': {}}, (None, 'unreadable request')),
+])
+def test_node_of(request_csr, expected):
+    assert csr_approver.node_of(request_csr, {'worker001', 'worker002'}) == expected
+
+
+@pytest.mark.parametrize('conditions, expected', [
+    ([], True),
+    (None, True),
+    ([{'type': 'Approved'}], False),
+    ([{'type': 'Denied'}], False),
+    ([{'type': 'Failed'}], True),
+])
+def test_is_pending(conditions, expected):
+    assert csr_approver.is_pending({'status': {'conditions': conditions}}) is expected
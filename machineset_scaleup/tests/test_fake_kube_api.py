@@ -0,0 +1,80 @@
+import threading
+import urllib.error
+import pytest
+import csr_approver
+import fake_kube_api
+import kube_api
+import render_inventory
+import scale_waves
+
+WORKERS = [f'worker{i:03d}' for i in range(8)]
+
+
+@pytest.fixture
+def cluster():
+    return fake_kube_api.FakeCluster(WORKERS, join_delay=0.05, ready_delay=0.05, phase_delay=0.1, capacity=3, retry_delay=0.2)
+
+
+@pytest.fixture
+def api(cluster):
+    server = fake_kube_api.serve(cluster)
+    yield kube_api.KubeAPI(f'http://127.0.0.1:{server.server_address[1]}')
+    server.shutdown()
+
+
+def documents(names):
+    with open(render_inventory.TEMPLATE) as f:
+        template = f.read()
+    nodes = [{'pm_addr': f'mgmt-{name}', 'mac': ['', f'52:54:00:00:01:{i:02x}', f'52:54:00:00:02:{i:02x}']}
+             for i, name in enumerate(names)]
+    workers = render_inventory.plan_workers(nodes, 0)
+    return {worker['name']: render_inventory.parse_documents(render_inventory.render_workers(template, [worker], 'root', 'pw'))
+            for worker in workers}
+
+
+def test_approver(cluster, api):
+    cluster.start_workers()
+    approver = csr_approver.Approver(api, WORKERS, batch_window=0.05)
+    assert approver.run(timeout=30) == set()
+    assert approver.ready == set(WORKERS)
+    assert len(approver.approved) == 2 * len(WORKERS)
+
+
+def test_scale_waves(cluster, api):
+    paths = scale_waves.api_paths('openshift-machine-api')
+    machineset = scale_waves.find_machineset(api, paths['MachineSet'])
+    scheduler = scale_waves.WaveScheduler(api, documents(WORKERS), paths, machineset, wave_size=3, host_timeout=30)
+    # The provisioned hosts boot and ask for their certificates
+    approver = csr_approver.Approver(api, WORKERS, batch_window=0.05)
+    approved = threading.Thread(target=approver.run, args=(30,), daemon=True)
+    approved.start()
+
+    assert scheduler.run(timeout=60) == set()
+    assert all(scheduler.phase[name] == 'provisioned' for name in WORKERS)
+    assert scheduler.replicas == len(WORKERS)
+    approved.join(30)
+    assert approver.ready == set(WORKERS)
+
+
+def test_scale_waves_retries_registration(cluster, api):
+    paths = scale_waves.api_paths('openshift-machine-api')
+    machineset = scale_waves.find_machineset(api, paths['MachineSet'])
+    failures = {'worker000': 1, 'worker001': 10}
+    post = api.post
+
+    def flaky_post(path, body):
+        name = body['metadata']['name']
+        if failures.get(name, 0) > 0:
+            failures[name] -= 1
+            raise urllib.error.URLError('connection refused') if name == 'worker001' else kube_api.APIError(503, 'unavailable')
+        return post(path, body)
+
+    api.post = flaky_post
+    scheduler = scale_waves.WaveScheduler(api, documents(WORKERS[:3]), paths, machineset, wave_size=2,
+                                          host_timeout=30, max_attempts=2)
+    assert scheduler.run(timeout=60) == {'worker001'}
+    assert scheduler.attempts == {'worker000': 1, 'worker001': 2}
+    assert scheduler.phase['worker000'] == scheduler.phase['worker002'] == 'provisioned'
+    # The secret created by the first attempt is kept, the BareMetalHost is created on the second
+    assert 'worker000-bmc-secret' in cluster.collections[fake_kube_api.SECRETS_PATH]
+    assert 'worker001' not in cluster.collections[fake_kube_api.BMH_PATH]
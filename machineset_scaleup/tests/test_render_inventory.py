@@ -0,0 +1,130 @@
+import base64
+import json
+import os
+import pytest
+import render_inventory
+import scale_waves
+
+
+def nodes(count):
+    return [{'pm_addr': f'mgmt-h{i}.example.com', 'pm_user': 'root', 'pm_password': 'secret',
+             'mac': ['52:54:00:00:00:%02x' % i, '52:54:00:00:01:%02x' % i, '52:54:00:00:02:%02x' % i]}
+            for i in range(count)]
+
+
+def record(worker):
+    return f"dhcp-host={worker['dhcp_mac']},{worker['ip']},{worker['name']}"
+
+
+def test_load_inventory(tmp_path):
+    path = tmp_path / 'inventory.json'
+    path.write_text(json.dumps({'nodes': nodes(2)}))
+    assert render_inventory.load_inventory(str(path)) == nodes(2)
+    path.write_text(json.dumps({'nodes': []}))
+    with pytest.raises(ValueError, match='no nodes'):
+        render_inventory.load_inventory(str(path))
+
+
+@pytest.mark.parametrize('existing, index, expected', [
+    (0, 0, {'name': 'worker000', 'ipmi_address': 'mgmt-h0.example.com', 'provisioning_mac': '52:54:00:00:01:00',
+            'dhcp_mac': '52:54:00:00:02:00', 'ip': '192.168.216.15'}),
+    (95, 4, {'name': 'worker099', 'ipmi_address': 'mgmt-h4.example.com', 'provisioning_mac': '52:54:00:00:01:04',
+             'dhcp_mac': '52:54:00:00:02:04', 'ip': '192.168.216.19'}),
+    (998, 4, {'name': 'worker1002', 'ipmi_address': 'mgmt-h4.example.com', 'provisioning_mac': '52:54:00:00:01:04',
+              'dhcp_mac': '52:54:00:00:02:04', 'ip': '192.168.216.19'}),
+])
+def test_plan_workers(existing, index, expected):
+    workers = render_inventory.plan_workers(nodes(5), existing)
+    assert len(workers) == 5
+    assert workers[index] == expected
+
+
+WORKERS = render_inventory.plan_workers(nodes(3), 0)
+W0, W1, W2 = (record(worker) for worker in WORKERS)
+
+
+@pytest.mark.parametrize('lines, expected, counts', [
+    # New records go after the last dhcp line
+    (['domain=lab', 'dhcp-range=a', 'server=1.1.1.1'], ['domain=lab', 'dhcp-range=a', W0, W1, W2, 'server=1.1.1.1'], (3, 0, 0)),
+    ([], [W0, W1, W2], (3, 0, 0)),
+    # Running again changes nothing
+    (['dhcp-range=a', W0, W1, W2], ['dhcp-range=a', W0, W1, W2], (0, 0, 3)),
+    # A record naming the worker, its MAC or its address is replaced
+    (['dhcp-range=a', 'dhcp-host=aa:bb:cc:dd:ee:ff,10.0.0.9,worker000', W1, W2], ['dhcp-range=a', W1, W2, W0], (0, 1, 2)),
+    (['dhcp-host=52:54:00:00:02:01,10.0.0.9,old-name', W0], [W0, W1, W2], (1, 1, 1)),
+    (['dhcp-host=aa:bb:cc:dd:ee:ff,192.168.216.17,old-name'], [W0, W1, W2], (2, 1, 0)),
+    # A stale duplicate next to the exact record goes, and counts as replaced
+    ([W0, 'dhcp-host=aa:bb:cc:dd:ee:ff,192.168.216.15,worker000', W1, W2], [W0, W1, W2], (0, 1, 2)),
+    # A line naming two workers is replaced by both records
+    (['dhcp-host=52:54:00:00:02:00,192.168.216.16,x'], [W0, W1, W2], (1, 2, 0)),
+    # Only dhcp-host lines are records, whatever else names a worker stays
+    (['# worker000 192.168.216.15', 'dhcp-host=other', 'address=/worker001/192.168.216.16'],
+     ['# worker000 192.168.216.15', 'dhcp-host=other', W0, W1, W2, 'address=/worker001/192.168.216.16'], (3, 0, 0)),
+])
+def test_merge_dhcp_hosts(lines, expected, counts):
+    merged, *result = render_inventory.merge_dhcp_hosts(lines, WORKERS)
+    assert merged == expected
+    assert tuple(result) == counts
+    assert sum(counts) == len(WORKERS)
+
+
+@pytest.mark.parametrize('content, written, summary', [
+    ('dhcp-range=a\n', True, '3 added, 0 replaced, 0 already present'),
+    (f'dhcp-range=a\n{W0}\n{W1}\n{W2}\n', False, '0 added, 0 replaced, 3 already present'),
+    (f'dhcp-range=a\n{W0}\n{W1}\n{W2}\ndhcp-host=aa:bb:cc:dd:ee:ff,192.168.216.17,stale\n', True,
+     '0 added, 1 replaced, 2 already present'),
+])
+def test_update_dnsmasq(tmp_path, content, written, summary):
+    path = tmp_path / 'ocp4-lab.conf'
+    path.write_text(content)
+    os.chmod(path, 0o640)
+    inode = os.stat(path).st_ino
+    assert render_inventory.update_dnsmasq(str(path), WORKERS) == summary
+    assert (os.stat(path).st_ino != inode) is written
+    assert path.read_text() == f'dhcp-range=a\n{W0}\n{W1}\n{W2}\n'
+    assert os.stat(path).st_mode & 0o777 == 0o640
+
+
+def test_render_and_parse_documents():
+    with open(render_inventory.TEMPLATE) as f:
+        template = f.read()
+    documents = render_inventory.parse_documents(render_inventory.render_workers(template, WORKERS[:2], 'root', 'p:w'))
+    assert [(document['kind'], document['metadata']['name']) for document in documents] == [
+        ('Secret', 'worker000-bmc-secret'), ('BareMetalHost', 'worker000'),
+        ('Secret', 'worker001-bmc-secret'), ('BareMetalHost', 'worker001')]
+    secret, bmh = documents[:2]
+    assert base64.b64decode(secret['data']['password']) == b'p:w'
+    assert secret['type'] == 'Opaque'
+    assert bmh['spec']['online'] is True
+    assert bmh['spec']['bmc'] == {'address': 'ipmi://mgmt-h0.example.com:623', 'credentialsName': 'worker000-bmc-secret'}
+    assert bmh['spec']['bootMACAddress'] == '52:54:00:00:01:00'
+    assert bmh['spec']['userData'] == {'name': 'worker-user-data', 'namespace': 'openshift-machine-api'}
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a: 1\n', [{'a': '1'}]),
+    ("---\na: 'x: y'\n---\n# only a comment\n---\nb: \"false\"\nc: false\n", [{'a': 'x: y'}, {'b': 'false', 'c': False}]),
+    ('a:\n  b:\n    c: d\n  e: f\ng: h\n', [{'a': {'b': {'c': 'd'}, 'e': 'f'}, 'g': 'h'}]),
+    ('a:\n\n  b: c\n', [{'a': {'b': 'c'}}]),
+])
+def test_parse_documents(text, expected):
+    assert render_inventory.parse_documents(text) == expected
+
+
+def test_parse_documents_rejects_lists():
+    with pytest.raises(ValueError, match='lists are not supported'):
+        render_inventory.parse_documents('a:\n  - b\n')
+
+
+def test_write_workers_and_documents_by_worker(tmp_path):
+    with open(render_inventory.TEMPLATE) as f:
+        template = f.read()
+    (tmp_path / 'old.yaml').write_text('stale')
+    path = render_inventory.write_workers(str(tmp_path), render_inventory.render_workers(template, WORKERS, 'root', 'pw'))
+    assert os.listdir(tmp_path) == ['workers.yml']
+    with open(path) as f:
+        documents = scale_waves.documents_by_worker(render_inventory.parse_documents(f.read()), ['worker002', 'worker000'])
+    assert {name: [document['kind'] for document in worker_documents] for name, worker_documents in documents.items()} == {
+        'worker002': ['Secret', 'BareMetalHost'], 'worker000': ['Secret', 'BareMetalHost']}
+    with pytest.raises(LookupError, match='no BareMetalHost worker003'):
+        scale_waves.documents_by_worker(render_inventory.parse_documents(template), ['worker003'])